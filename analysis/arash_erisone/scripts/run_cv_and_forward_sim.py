@@ -1,57 +1,18 @@
-'''Make the lsf file for cross validation.
+'''Make the jobs for cross validation.
 
-WARNING: THIS FILE ONLY WORKS IF THE OS CONTAINS AN LSF JOB SUBMISSION SYSTEM.
+A fold is run as a graph of jobs: the cross-validation inference, then the conversion
+of the trace into numpy arrays and the posterior visualization, then the forward
+simulation of the held out subject. The jobs are submitted to LSF (`--backend lsf`,
+the default) or run on this machine (`--backend local`). Jobs whose outputs already
+exist are skipped, so rerunning this script only reruns what is missing.
+
+WARNING: THE LSF BACKEND ONLY WORKS IF THE OS CONTAINS AN LSF JOB SUBMISSION SYSTEM.
 THIS IS A INTERNAL DOCUMENT. FOR IDENTICAL RESULTS THAT DO NOT REQUIRE RUNNING
 LSF, RUN THE SCRIPT `MDSINE2/figures_analysis/run_cv.sh`.
 '''
 
-lsfstr = '''#!/bin/bash
-#BSUB -J {jobname}
-#BSUB -o {stdout_loc}
-#BSUB -e {stderr_loc}
-
-#BSUB -q {cv_queue}
-#BSUB -n {cv_cpus}
-#BSUB -M {cv_mem}
-#BSUB -R rusage[mem={cv_mem}]
-#BSUB -m bwhpath_hg
-
-#
-echo '---PROCESS RESOURCE LIMITS---'
-ulimit -a
-echo '---SHARED LIBRARY PATH---'
-echo $LD_LIBRARY_PATH
-echo '---APPLICATION SEARCH PATH:---'
-echo $PATH
-echo '---LSF Parameters:---'
-printenv | grep '^LSF'
-echo '---LSB Parameters:---'
-printenv | grep '^LSB'
-echo '---LOADED MODULES:---'
-module list
-echo '---SHELL:---'
-echo $SHELL
-echo '---HOSTNAME:---'
-hostname
-echo '---GROUP MEMBERSHIP (files are created in the first group listed):---'
-groups
-echo '---DEFAULT FILE PERMISSIONS (UMASK):---'
-umask
-echo '---CURRENT WORKING DIRECTORY:---'
-pwd
-echo '---DISK SPACE QUOTA---'
-df .
-echo '---TEMPORARY SCRATCH FOLDER ($TMPDIR):---'
-echo $TMPDIR
-
-
-# Load the environment
-#module load anaconda/4.8.2
-source activate {environment_name}
-cd {code_basepath}
-
 # Run a fold in cross validation
-python analysis/helpers/run_cv_inference.py \
+cv_command = '''python analysis/helpers/run_cv_inference.py \
     --dataset {dset_fileloc} \
     --cv-basepath {cv_basepath} \
     --dset-basepath {dset_basepath} \
@@ -64,38 +25,40 @@ python analysis/helpers/run_cv_inference.py \
     --leave-out-subject {leave_out_subject} \
     --interaction-ind-prior {interaction_prior} \
     --perturbation-ind-prior {perturbation_prior}
+'''
 
 # Make the posterior as numpy arrays
-python analysis/helpers/convert_trace_to_numpy.py \
+numpy_command = '''python analysis/helpers/convert_trace_to_numpy.py \
     --chain {chain_path} \
     --output-basepath {numpy_basepath} \
     --section posterior
+'''
 
 # Visualize the posterior
-mdsine2 visualize-posterior \
+posterior_command = '''mdsine2 visualize-posterior \
     --chain {chain_path} \
     --section posterior \
-    --output-basepath {posterior_basepath} \
+    --output-basepath {posterior_basepath}
+'''
 
-# Compute forward simulations for this fold
-python analysis/erisone/scripts/run_forward_sim_for_fold.py \
-    --chain {numpy_basepath} \
+# Full forward simulation of the held out subject
+fsim_command = '''python analysis/helpers/forward_sim_validation.py \
+    --input {numpy_basepath} \
     --validation {validation_subject} \
-    --n-days {max_tla} \
+    --simulation-dt {sim_dt} \
+    --start None \
+    --n-days None \
     --output-basepath {fsim_basepath} \
-    --environment-name {environment_name} \
-    --code-basepath {code_basepath} \
-    --queue {fsim_queue} \
-    --memory {fsim_mem} \
-    --n-cpus {fsim_cpus} \
-    --lsf-basepath {fsim_lsf_basepath}
-
-
+    --save-intermediate-times 0
 '''
 
 import mdsine2 as md2
 import argparse
 import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'helpers'))
+import job_scheduler as js
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(usage=__doc__)
@@ -109,8 +72,6 @@ if __name__ == '__main__':
         help='This is the basepath to save the output')
     parser.add_argument('--dset-basepath', '-db', type=str, dest='input_basepath',
         help='This is the basepath to load and save the cv datasets')
-    parser.add_argument('--lsf-basepath', '-l', type=str, dest='lsf_basepath',
-        help='This is the basepath to save the lsf files', default='lsf_files/')
     parser.add_argument('--leave-out-subject', '-lo', type=str, dest='leave_out_subj',
         help='This is the subject to leave out')
     parser.add_argument('--negbin', type=str, dest='negbin',
@@ -140,10 +101,7 @@ if __name__ == '__main__':
         help='Timesteps we go in during forward simulation', default=0.01)
 
     #ErisOne arguments
-    parser.add_argument('--environment-name', dest='environment_name', type=str,
-        help='Name of the conda environment to activate when the job starts')
-    parser.add_argument('--code-basepath', type=str, dest='code_basepath',
-        help='Where the `run_cross_validation` script is located')
+    js.add_backend_args(parser, resources=False)
     parser.add_argument('--cv-queue', type=str, dest='cv_queue',
         help='ErisOne queue this job gets submitted to for cross-validation')
     parser.add_argument('--cv-memory', type=str, dest='cv_memory',
@@ -167,12 +125,6 @@ if __name__ == '__main__':
     os.makedirs(lsf_basepath, exist_ok=True)
 
     jobname = dset + '-cv' + args.leave_out_subj
-    script_path = os.path.join(lsf_basepath, 'scripts')
-    stdout_loc = os.path.join(lsf_basepath, 'stdout', jobname + '.out')
-    stderr_loc = os.path.join(lsf_basepath, 'stderr', jobname + '.err')
-    os.makedirs(script_path, exist_ok=True)
-    os.makedirs(stdout_loc, exist_ok=True)
-    os.makedirs(stderr_loc, exist_ok=True)
 
     # Make parameters for time-lookahead
     chain_path = os.path.join(args.output_basepath, jobname, 'mcmc.pkl')
@@ -180,32 +132,42 @@ if __name__ == '__main__':
     posterior_basepath = os.path.join(args.output_basepath, jobname, 'posterior')
     validation_subject = os.path.join(args.input_basepath, jobname + '-validate.pkl')
     fsim_basepath = os.path.join(args.output_basepath, 'forward_sims')
-    fsim_lsf_basepath = os.path.join(os.getcwd(), lsf_basepath, 'fsim')
 
     os.makedirs(numpy_basepath, exist_ok=True)
     os.makedirs(fsim_basepath, exist_ok=True)
-    os.makedirs(fsim_lsf_basepath, exist_ok=True)
-
-    lsfname = os.path.join(script_path, jobname + '.lsf')
-    f = open(lsfname, 'w')
-    f.write(lsfstr.format(
-        jobname=jobname, stdout_loc=stdout_loc, stderr_loc=stderr_loc,
-        environment_name=args.environment_name,
-        cv_queue=args.cv_queue, cv_cpus=args.cv_cpus, cv_mem=args.cv_memory,
-        code_basepath=args.code_basepath,
-        dset_fileloc=args.dataset, cv_basepath=args.output_basepath,
-        dset_basepath=args.input_basepath, negbin_run=args.negbin,
-        seed=args.seed, burnin=args.burnin, n_samples=args.n_samples,
-        checkpoint=args.checkpoint, mp=args.mp,
-        leave_out_subject=args.leave_out_subj,
-        interaction_prior=args.interaction_prior,
-        perturbation_prior=args.perturbation_prior,
-        chain_path=chain_path, numpy_basepath=numpy_basepath,
-        posterior_basepath=posterior_basepath, validation_subject=validation_subject,
-        max_tla=args.max_tla, fsim_basepath=fsim_basepath, fsim_queue=args.fsim_queue, 
-        fsim_mem=args.fsim_memory, fsim_cpus=args.fsim_cpus, 
-        fsim_lsf_basepath=fsim_lsf_basepath))
-    f.close()
-    command = 'bsub < {}'.format(lsfname)
-    print(command)
-    os.system(command)
+
+    graph = js.make_graph(args, lsf_basepath=lsf_basepath)
+    graph.add(js.Task(
+        jobname,
+        cv_command.format(
+            dset_fileloc=args.dataset, cv_basepath=args.output_basepath,
+            dset_basepath=args.input_basepath, negbin_run=args.negbin,
+            seed=args.seed, burnin=args.burnin, n_samples=args.n_samples,
+            checkpoint=args.checkpoint, mp=args.mp,
+            leave_out_subject=args.leave_out_subj,
+            interaction_prior=args.interaction_prior,
+            perturbation_prior=args.perturbation_prior),
+        outputs=[chain_path, validation_subject],
+        queue=args.cv_queue, cpus=args.cv_cpus, memory=args.cv_memory,
+        bsub_options=['-m bwhpath_hg']))
+    graph.add(js.Task(
+        jobname + '-numpy',
+        numpy_command.format(chain_path=chain_path, numpy_basepath=numpy_basepath),
+        dependencies=[jobname],
+        outputs=[os.path.join(numpy_basepath, 'growth.npy'),
+                 os.path.join(numpy_basepath, 'interactions.npy')],
+        queue=args.cv_queue, cpus=args.cv_cpus, memory=args.cv_memory))
+    graph.add(js.Task(
+        jobname + '-posterior',
+        posterior_command.format(chain_path=chain_path, posterior_basepath=posterior_basepath),
+        dependencies=[jobname],
+        queue=args.cv_queue, cpus=args.cv_cpus, memory=args.cv_memory))
+    graph.add(js.Task(
+        jobname + '-full',
+        fsim_command.format(
+            numpy_basepath=numpy_basepath, validation_subject=validation_subject,
+            sim_dt=args.simulation_dt, fsim_basepath=fsim_basepath),
+        dependencies=[jobname + '-numpy'],
+        queue=args.fsim_queue, cpus=args.fsim_cpus, memory=args.fsim_memory))
+
+    graph.run(js.make_backend(args, lsf_basepath=lsf_basepath))
@@ -1,53 +1,12 @@
 '''Run keystoneness given the chain.
-'''
-
-lsfstr = '''#!/bin/bash
-#BSUB -J {jobname}
-#BSUB -g /gibson/keystoneness
-#BSUB -o {stdout_loc}
-#BSUB -e {stderr_loc}
-
-#BSUB -q {queue}
-#BSUB -n {cpus}
-#BSUB -M {mem}
-#BSUB -R rusage[mem={mem}]
-
-# 
-echo '---PROCESS RESOURCE LIMITS---'
-ulimit -a
-echo '---SHARED LIBRARY PATH---'
-echo $LD_LIBRARY_PATH
-echo '---APPLICATION SEARCH PATH:---'
-echo $PATH
-echo '---LSF Parameters:---'
-printenv | grep '^LSF'
-echo '---LSB Parameters:---'
-printenv | grep '^LSB'
-echo '---LOADED MODULES:---'
-module list
-echo '---SHELL:---'
-echo $SHELL
-echo '---HOSTNAME:---'
-hostname
-echo '---GROUP MEMBERSHIP (files are created in the first group listed):---'
-groups
-echo '---DEFAULT FILE PERMISSIONS (UMASK):---'
-umask
-echo '---CURRENT WORKING DIRECTORY:---'
-pwd
-echo '---DISK SPACE QUOTA---'
-df .
-echo '---TEMPORARY SCRATCH FOLDER ($TMPDIR):---'
-echo $TMPDIR
 
-
-# Load the environment
-module load anaconda/4.8.2
-source activate {environment_name}
-cd {code_basepath}
+One forward simulation job is made per leave-out (plus the baseline, `none`). The
+jobs are submitted to LSF (`--backend lsf`, the default) or run on this machine
+(`--backend local`).
+'''
 
 # Run time lookahead
-python keystoneness.py \
+keystoneness_command = '''python keystoneness.py \
     --input {chain} \
     --study {study} \
     --leave-out-table {leaveouttable} \
@@ -64,6 +23,10 @@ python keystoneness.py \
 import mdsine2 as md2
 import argparse
 import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'helpers'))
+import job_scheduler as js
 
 if __name__ == '__main__':
 
@@ -85,18 +48,7 @@ if __name__ == '__main__':
         help='separator for the leave out table')
 
     # ErisOne parameters
-    parser.add_argument('--environment-name', dest='environment_name', type=str,
-        help='Name of the conda environment to activate when the job starts')
-    parser.add_argument('--code-basepath', type=str, dest='code_basepath',
-        help='Where the `run_cross_validation` script is located')
-    parser.add_argument('--queue', '-q', type=str, dest='queue',
-        help='ErisOne queue this job gets submitted to')
-    parser.add_argument('--memory', '-mem', type=str, dest='memory',
-        help='Amount of memory to reserve on ErisOne')
-    parser.add_argument('--n-cpus', '-cpus', type=str, dest='cpus',
-        help='Number of cpus to reserve on ErisOne')
-    parser.add_argument('--lsf-basepath', '-l', type=str, dest='lsf_basepath',
-        help='This is the basepath to save the lsf files', default='lsf_files/')
+    js.add_backend_args(parser)
     args = parser.parse_args()
 
     curr_path_table = args.leave_out_table
@@ -108,40 +60,18 @@ if __name__ == '__main__':
     study = md2.Study.load(args.study)
     leave_outs = ['none'] + [str(i) for i in range(nlines)]
 
-    lsfdir = args.lsf_basepath
-    os.makedirs(lsfdir, exist_ok=True)
-    script_path = os.path.join(lsfdir, 'scripts')
-    stdout_loc = os.path.join(lsfdir, 'stdout')
-    stderr_loc = os.path.join(lsfdir, 'stderr')
-    os.makedirs(script_path, exist_ok=True)
-    os.makedirs(stdout_loc, exist_ok=True)
-    os.makedirs(stderr_loc, exist_ok=True)
-
     # Dispatch keystoneness
-    for i, leave_out in enumerate(leave_outs):
-        print("[Submitting job: Leave-out {} ({} of {})]".format(leave_out, i + 1, len(leave_outs)))
+    graph = js.make_graph(args)
+    for leave_out in leave_outs:
         jobname = study.name + '-keystone-{}'.format(leave_out)
-
-        stdout_name = os.path.join(stdout_loc, jobname + '.out')
-        stderr_name = os.path.join(stderr_loc, jobname + '.err')
-        lsfname = os.path.join(script_path, jobname + '.lsf')
-
-        f = open(lsfname, 'w')
-        f.write(lsfstr.format(
-            jobname=jobname, stdout_loc=stdout_name, 
-            stderr_loc=stderr_name, queue=args.queue, cpus=args.cpus, mem=args.memory,
-            environment_name=args.environment_name, code_basepath=args.code_basepath,
-            chain=args.chain, study=args.study, leaveouttable=args.leave_out_table,
-            leaveoutindex=leave_out, forward_sim=1, maketable=0, compute_keystoneness=0,
-            sep=args.sep, sim_dt=args.simulation_dt, n_days=args.n_days, 
-            basepath=args.basepath))
-        f.close()
-        command = 'bsub < {}'.format(lsfname)
-        print(command)
-        os.system(command)
-
-
-
-
-
-
+        graph.add(js.Task(
+            jobname,
+            keystoneness_command.format(
+                chain=args.chain, study=args.study, leaveouttable=args.leave_out_table,
+                leaveoutindex=leave_out, forward_sim=1, maketable=0, compute_keystoneness=0,
+                sep=args.sep, sim_dt=args.simulation_dt, n_days=args.n_days,
+                basepath=args.basepath),
+            bsub_options=['-g /gibson/keystoneness']))
+
+    print("[Running {} keystoneness jobs]".format(len(graph)))
+    graph.run(js.make_backend(args, setup='module load anaconda/4.8.2'))
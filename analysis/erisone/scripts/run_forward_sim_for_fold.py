@@ -1,56 +1,12 @@
-'''Run time lookahead prediction and a full trajectory prediction given the chain 
-and data. Submit a job for every forward prediction task.
+'''Run time lookahead prediction and a full trajectory prediction given the chain
+and data. Make a job for every forward prediction task.
 
-This is called after cross validation is done for the fold and is automatically
-called from the lsf script in `run_cv.py`
+This is called after cross validation is done for the fold. The jobs are submitted
+to LSF (`--backend lsf`, the default) or run on this machine (`--backend local`).
 '''
 
-lsfstr = '''#!/bin/bash
-#BSUB -J {jobname}
-#BSUB -o {stdout_loc}
-#BSUB -e {stderr_loc}
-
-#BSUB -q {queue}
-#BSUB -n {cpus}
-#BSUB -M {mem}
-#BSUB -R rusage[mem={mem}]
-
-# 
-echo '---PROCESS RESOURCE LIMITS---'
-ulimit -a
-echo '---SHARED LIBRARY PATH---'
-echo $LD_LIBRARY_PATH
-echo '---APPLICATION SEARCH PATH:---'
-echo $PATH
-echo '---LSF Parameters:---'
-printenv | grep '^LSF'
-echo '---LSB Parameters:---'
-printenv | grep '^LSB'
-echo '---LOADED MODULES:---'
-module list
-echo '---SHELL:---'
-echo $SHELL
-echo '---HOSTNAME:---'
-hostname
-echo '---GROUP MEMBERSHIP (files are created in the first group listed):---'
-groups
-echo '---DEFAULT FILE PERMISSIONS (UMASK):---'
-umask
-echo '---CURRENT WORKING DIRECTORY:---'
-pwd
-echo '---DISK SPACE QUOTA---'
-df .
-echo '---TEMPORARY SCRATCH FOLDER ($TMPDIR):---'
-echo $TMPDIR
-
-
-# Load the environment
-#module load anaconda/4.8.2
-source activate {environment_name}
-cd {code_basepath}
-
 # Run time lookahead
-python analysis/helpers/forward_sim_validation.py \
+fsim_command = '''python analysis/helpers/forward_sim_validation.py \
     --input {chain} \
     --validation {validation_path} \
     --simulation-dt {sim_dt} \
@@ -64,8 +20,12 @@ import mdsine2 as md2
 from mdsine2.logger import logger
 import argparse
 import os
+import sys
 import numpy as np
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'helpers'))
+import job_scheduler as js
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(usage=__doc__)
     parser.add_argument('--chain', '-c', type=str, dest='chain',
@@ -87,18 +47,7 @@ if __name__ == '__main__':
         help='This is where you are saving the posterior renderings')
 
     # ErisOne parameters
-    parser.add_argument('--environment-name', dest='environment_name', type=str,
-        help='Name of the conda environment to activate when the job starts')
-    parser.add_argument('--code-basepath', type=str, dest='code_basepath',
-        help='Where the `run_cross_validation` script is located')
-    parser.add_argument('--queue', '-q', type=str, dest='queue',
-        help='ErisOne queue this job gets submitted to')
-    parser.add_argument('--memory', '-mem', type=str, dest='memory',
-        help='Amount of memory to reserve on ErisOne')
-    parser.add_argument('--n-cpus', '-cpus', type=str, dest='cpus',
-        help='Number of cpus to reserve on ErisOne')
-    parser.add_argument('--lsf-basepath', '-l', type=str, dest='lsf_basepath',
-        help='This is the basepath to save the lsf files', default='lsf_files/')
+    js.add_backend_args(parser)
 
     args = parser.parse_args()
     n_days =args.n_days
@@ -115,51 +64,20 @@ if __name__ == '__main__':
         times.append(subj.times)
     times = np.sort(np.unique(times))
 
-    lsfdir = args.lsf_basepath
-    os.makedirs(lsfdir, exist_ok=True)
-    script_path = os.path.join(lsfdir, 'scripts')
-    stdout_loc = os.path.join(lsfdir, 'stdout')
-    stderr_loc = os.path.join(lsfdir, 'stderr')
-    os.makedirs(script_path, exist_ok=True)
-    os.makedirs(stdout_loc, exist_ok=True)
-    os.makedirs(stderr_loc, exist_ok=True)
+    graph = js.make_graph(args)
 
     # Do time lookahead (do not include last time point)
     #commented out for now since we aren't doing time look ahead forward sim
     #for start in times[:-1]:
     #    jobname = study.name + '-{}-{}'.format(start, n_days)
-
-    #    stdout_name = os.path.join(stdout_loc, jobname + '.out')
-    #    stderr_name = os.path.join(stderr_loc, jobname + '.err')
-    #    lsfname = os.path.join(script_path, jobname + '.lsf')
-    #    f = open(lsfname, 'w')
-    #    f.write(lsfstr.format(
-    #        jobname=jobname, stdout_loc=stdout_name, stderr_loc=stderr_name,
-    #        queue=args.queue, cpus=args.cpus, mem=args.memory,
-    #        environment_name=args.environment_name, code_basepath=args.code_basepath,
+    #    graph.add(js.Task(jobname, fsim_command.format(
     #        chain=args.chain, validation_path=args.validation, sim_dt=args.simulation_dt,
-    #        start=start, n_days=n_days, basepath=basepath, save_intermed_times=1))
-    #    f.close()
-    #    command = 'bsub < {}'.format(lsfname)
-    #    print(command)
-    #    os.system(command)
+    #        start=start, n_days=n_days, basepath=basepath, save_intermed_times=1)))
 
     # Do full simulation
     jobname = study.name + '-full'
-    stdout_name = os.path.join(stdout_loc, jobname + '.out')
-    stderr_name = os.path.join(stderr_loc, jobname + '.err')
-    lsfname = os.path.join(script_path, jobname + '.lsf')
-    f = open(lsfname, 'w')
-    f.write(lsfstr.format(
-        jobname=jobname, stdout_loc=stdout_name, stderr_loc=stderr_name,
-        queue=args.queue, cpus=args.cpus, mem=args.memory,
-        environment_name=args.environment_name, code_basepath=args.code_basepath,
+    graph.add(js.Task(jobname, fsim_command.format(
         chain=args.chain, validation_path=args.validation, sim_dt=args.simulation_dt,
-        start=None, n_days=None, basepath=basepath, save_intermed_times=0))
-    f.close()
-    command = 'bsub < {}'.format(lsfname)
-    print(command)
-    os.system(command)
-
-
+        start=None, n_days=None, basepath=basepath, save_intermed_times=0)))
 
+    graph.run(js.make_backend(args))
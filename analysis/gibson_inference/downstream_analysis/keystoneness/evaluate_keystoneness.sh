@@ -5,11 +5,16 @@ source gibson_inference/settings.sh
 
 echo "Running Keystoneness forward simulations for Healthy dataset."
 
+stage keystoneness-initial-condition-healthy \
+--outputs $DOWNSTREAM_ANALYSIS_OUT_DIR/keystoneness/healthy-initial_condition.tsv \
+-- \
 mdsine2 extract-abundances \
 --study "${MDSINE_FIXED_CLUSTER_OUT_DIR}/healthy/subjset.pkl" \
 -t 19 \
--o $DOWNSTREAM_ANALYSIS_OUT_DIR/keystoneness/healthy-initial_condition.tsv \
+-o $DOWNSTREAM_ANALYSIS_OUT_DIR/keystoneness/healthy-initial_condition.tsv
 
+stage keystoneness-healthy \
+-- \
 mdsine2 evaluate-keystoneness \
 --fixed-cluster-mcmc-path "${MDSINE_FIXED_CLUSTER_OUT_DIR}/healthy/mcmc.pkl" \
 --study "${MDSINE_FIXED_CLUSTER_OUT_DIR}/healthy/subjset.pkl" \
@@ -23,11 +28,16 @@ mdsine2 evaluate-keystoneness \
 
 echo "Running Keystoneness forward simulations for Dysbiotic dataset."
 
+stage keystoneness-initial-condition-uc \
+--outputs $DOWNSTREAM_ANALYSIS_OUT_DIR/keystoneness/uc-initial_condition.tsv \
+-- \
 mdsine2 extract-abundances \
 --study "${MDSINE_FIXED_CLUSTER_OUT_DIR}/uc/subjset.pkl" \
 -t 19 \
--o $DOWNSTREAM_ANALYSIS_OUT_DIR/keystoneness/uc-initial_condition.tsv \
+-o $DOWNSTREAM_ANALYSIS_OUT_DIR/keystoneness/uc-initial_condition.tsv
 
+stage keystoneness-uc \
+-- \
 mdsine2 evaluate-keystoneness \
 --fixed-cluster-mcmc-path "${MDSINE_FIXED_CLUSTER_OUT_DIR}/uc/mcmc.pkl" \
 --study "${MDSINE_FIXED_CLUSTER_OUT_DIR}/uc/subjset.pkl" \
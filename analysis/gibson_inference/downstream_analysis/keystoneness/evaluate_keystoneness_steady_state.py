@@ -0,0 +1,137 @@
+"""
+Compute the keystoneness steady states (one cluster removed at a time) directly, instead of forward simulating
+the full trajectory. Outputs the same table as `mdsine2 evaluate-keystoneness` (ExcludedCluster, OTU, SampleIdx,
+StableState), plus a table of convergence diagnostics.
+"""
+import argparse
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import mdsine2 as md2
+from mdsine2.names import STRNAMES
+from tqdm import tqdm
+
+sys.path.append(str(Path(__file__).resolve().parents[3] / 'helpers'))
+import steady_state
+import study_matrices
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Compute the steady states after excluding a cluster from the day-20 levels.")
+    parser.add_argument('--fixed-cluster-mcmc-path', '-f', type=str, dest='mcmc_path', required=True,
+                        help='<Required> Location of the MDSINE2.BaseMCMC chain of the fixed cluster run.')
+    parser.add_argument('--study', '-s', type=str, dest='study', required=True,
+                        help='<Required> Path to the Study object to use for initial conditions')
+    parser.add_argument('--out-dir', '-o', type=str, dest='out_dir', required=True,
+                        help='<Required> The directory to which to save the calculated DataFrame of '
+                             'steady states.')
+
+    # ================ Optional params
+    parser.add_argument('--method', type=str, dest='method', required=False,
+                        choices=['auto', 'fixed_point', 'integrate'], default='auto',
+                        help='How to compute the steady states. `auto` uses the fixed point when it is '
+                             'guaranteed to be globally stable and integrates otherwise. Default: auto')
+    parser.add_argument('--gibbs-subsample', '-g', type=int, dest='gibbs_subsample', required=False,
+                        default=1,
+                        help='The frequency at which to subsample from the provided MCMC samples. '
+                             'Default: 1 (uses every sample)')
+    parser.add_argument('--initial-day', type=int, dest='initial_day', required=False, default=19,
+                        help='The (index of the) timepoint to use as the initial condition. Default: 19')
+
+    # Other Simulation params
+    parser.add_argument('--n-days', dest='n_days', type=int, required=False,
+                        help='Maximum number of days to simulate for (if integrating)', default=64)
+    parser.add_argument('--simulation-dt', type=float, dest='simulation_dt', required=False,
+                        help='Timesteps we go in during forward simulation', default=0.01)
+    parser.add_argument('--limit-of-detection', dest='limit_of_detection', required=False,
+                        help='If any of the taxa have a 0 abundance at the start, then we ' \
+                             'set it to this value.', default=1e5, type=float)
+    parser.add_argument('--sim-max', dest='sim_max', type=float, required=False,
+                        help='Maximum value', default=1e20)
+    parser.add_argument('--steady-state-tol', dest='steady_state_tol', type=float, required=False,
+                        help='Change of the log-abundance per day of every taxon below which an integration '
+                             'is considered converged.',
+                        default=1e-6)
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    mcmc = md2.BaseMCMC.load(args.mcmc_path)
+    study = study_matrices.load_study(args.study)
+    clustering = mcmc.graph[STRNAMES.CLUSTERING_OBJ]
+
+    growth = mcmc.graph[STRNAMES.GROWTH_VALUE].get_trace_from_disk(section="posterior")
+    self_interactions = mcmc.graph[STRNAMES.SELF_INTERACTION_VALUE].get_trace_from_disk(section="posterior")
+    interactions = mcmc.graph[STRNAMES.INTERACTIONS_OBJ].get_trace_from_disk(section="posterior")
+    interactions[np.isnan(interactions)] = 0
+    self_interactions = -np.absolute(self_interactions)
+    for i in range(self_interactions.shape[1]):
+        interactions[:, i, i] = self_interactions[:, i]
+    gibbs_indices = list(range(0, growth.shape[0], args.gibbs_subsample))
+
+    M = study_matrices.study_matrices(study).matrix(dtype='abs', agg='mean', times='intersection',
+                                                   qpcr_unnormalize=True)
+    initial_conditions = M[:, args.initial_day].copy()
+    initial_conditions[initial_conditions < args.limit_of_detection] = args.limit_of_detection
+
+    # "None" is the baseline, where every cluster is present.
+    excluded_clusters = [("None", [])] + [(cluster.id, list(cluster.members)) for cluster in clustering]
+
+    otu_names = np.array([otu.name for otu in study.taxa], dtype=object)
+    stable_states = np.empty((len(excluded_clusters), len(gibbs_indices), len(otu_names)))
+    diagnostics_df_entries = []
+    for cidx, (excluded_id, excluded_members) in enumerate(tqdm(excluded_clusters, desc="Excluded cluster")):
+        cluster_initial_conditions = initial_conditions.copy()
+        cluster_initial_conditions[excluded_members] = 0
+
+        for gidx, gibbs_idx in enumerate(gibbs_indices):
+            stable_states[cidx, gidx], info = steady_state.steady_state(
+                growth=growth[gibbs_idx],
+                interactions=interactions[gibbs_idx],
+                initial_conditions=cluster_initial_conditions,
+                dt=args.simulation_dt,
+                n_days=args.n_days,
+                method=args.method,
+                sim_max=args.sim_max,
+                rel_tol=args.steady_state_tol
+            )
+
+            info["ExcludedCluster"] = excluded_id
+            info["SampleIdx"] = gibbs_idx
+            diagnostics_df_entries.append(info)
+
+    # One row per (excluded cluster, gibbs sample, OTU), built by columns.
+    n_clusters, n_gibbs, n_otus = stable_states.shape
+    fwsim_df = pd.DataFrame({
+        "ExcludedCluster": np.repeat(np.array([cid for cid, _ in excluded_clusters], dtype=object),
+                                     n_gibbs * n_otus),
+        "OTU": np.tile(otu_names, n_clusters * n_gibbs),
+        "SampleIdx": np.tile(np.repeat(np.asarray(gibbs_indices, dtype=int), n_otus), n_clusters),
+        "StableState": stable_states.ravel()
+    })
+
+    diagnostics_df = pd.DataFrame(diagnostics_df_entries)
+    print("Steady states: {} solved as fixed points, {} integrated ({} did not converge).".format(
+        np.sum(diagnostics_df["method"] == "fixed_point"),
+        np.sum(diagnostics_df["method"] == "integrate"),
+        np.sum(~diagnostics_df["converged"])
+    ))
+
+    out_dir = Path(args.out_dir)
+    out_dir.mkdir(exist_ok=True, parents=True)
+    fwsim_df.to_hdf(
+        str(out_dir / "{}-fwsim.h5".format(study.name)), key='df', mode='w'
+    )
+    diagnostics_df.to_hdf(
+        str(out_dir / "{}-convergence.h5".format(study.name)), key='df', mode='w'
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+#!/bin/bash
+
+set -e
+source gibson_inference/settings.sh
+
+echo "Computing Keystoneness steady states for Healthy dataset."
+
+stage keystoneness-steady-state-healthy \
+--outputs $DOWNSTREAM_ANALYSIS_OUT_DIR/keystoneness/healthy-fwsim.h5 \
+-- \
+python gibson_inference/downstream_analysis/keystoneness/evaluate_keystoneness_steady_state.py \
+--fixed-cluster-mcmc-path "${MDSINE_FIXED_CLUSTER_OUT_DIR}/healthy/mcmc.pkl" \
+--study "${MDSINE_FIXED_CLUSTER_OUT_DIR}/healthy/subjset.pkl" \
+--out-dir $DOWNSTREAM_ANALYSIS_OUT_DIR/keystoneness \
+--method auto \
+--initial-day 19 \
+--n-days 64 \
+--simulation-dt 0.01 \
+--limit-of-detection 10000 \
+--sim-max 1e20 \
+--steady-state-tol 1e-6
+
+
+echo "Computing Keystoneness steady states for Dysbiotic dataset."
+
+stage keystoneness-steady-state-uc \
+--outputs $DOWNSTREAM_ANALYSIS_OUT_DIR/keystoneness/uc-fwsim.h5 \
+-- \
+python gibson_inference/downstream_analysis/keystoneness/evaluate_keystoneness_steady_state.py \
+--fixed-cluster-mcmc-path "${MDSINE_FIXED_CLUSTER_OUT_DIR}/uc/mcmc.pkl" \
+--study "${MDSINE_FIXED_CLUSTER_OUT_DIR}/uc/subjset.pkl" \
+--out-dir $DOWNSTREAM_ANALYSIS_OUT_DIR/keystoneness \
+--method auto \
+--initial-day 19 \
+--n-days 64 \
+--simulation-dt 0.01 \
+--limit-of-detection 10000 \
+--sim-max 1e20 \
+--steady-state-tol 1e-6
@@ -2,8 +2,9 @@
 Forward simulate by perturbing a random collection of taxa.
 """
 import argparse
+import sys
 from pathlib import Path
-from typing import List, Dict, Iterator, Tuple
+from typing import List, Tuple
 
 import numpy as np
 from random import seed, randint
@@ -13,6 +14,11 @@ import mdsine2 as md2
 from mdsine2.names import STRNAMES
 from tqdm import tqdm
 
+sys.path.append(str(Path(__file__).resolve().parents[3] / 'helpers'))
+import simulation_tables
+import steady_state
+import study_matrices
+
 
 class Seed(object):
     def __init__(self, init: int = 0, min_value: int = 0, max_value: int = 1000000):
@@ -69,6 +75,11 @@ def parse_args():
                              'set it to this value.', default=1e5, type=float)
     parser.add_argument('--sim-max', dest='sim_max', type=float, required=False,
                         help='Maximum value', default=1e20)
+    parser.add_argument('--steady-state-tol', dest='steady_state_tol', type=float, required=False,
+                        help='If specified, stop each simulation (after the perturbation ends) once the '
+                             'change of the log-abundance per day of every taxon falls below this tolerance '
+                             'and use the final state as the steady state. Otherwise simulate for `--n-days` '
+                             'and average the last 50 timepoints.', default=None)
 
     return parser.parse_args()
 
@@ -77,209 +88,206 @@ def main():
     args = parse_args()
 
     mcmc = md2.BaseMCMC.load(args.input_mcmc)
-    study = md2.Study.load(args.study)
+    study = study_matrices.load_study(args.study)
     master_seed = Seed(args.seed)
     gibbs_indices = list(range(0, mcmc.n_samples, args.gibbs_subsample))
 
     alphas = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7]  # Fraction of otus to perturb
-    trials = list(range(args.num_trials))
 
     initial_conditions = generate_initial_condition(study, limit_of_detection=args.limit_of_detection)
+    otu_names = np.array([otu.name for otu in study.taxa])
 
-    fwsim_df_entries = []
-    metadata_df_entries = []
-    for alpha in alphas:
-        for trial in tqdm(trials, desc=f"Alpha={alpha}", total=len(trials)):
-            for fwsim_entries, perturbed_otus in forward_simulation_results(
-                    mcmc,
-                    study,
-                    alpha,
-                    args.pert_strength,
-                    pert_start_day=args.pert_start_day,
-                    pert_end_day=args.pert_end_day,
-                    initial_conditions=initial_conditions,
-                    dt=args.simulation_dt,
-                    sim_max=args.sim_max,
-                    n_days=args.n_days,
-                    gibbs_indices=gibbs_indices,
-                    master_seed=master_seed
-            ):
-                for fwsim_entry in fwsim_entries:
-                    fwsim_entry['PerturbedFrac'] = alpha
-                    fwsim_entry['Perturbation'] = args.pert_strength
-                    fwsim_entry['Trial'] = trial
-                    fwsim_df_entries.append(fwsim_entry)
-
-                perturbed_otus = set(perturbed_otus)
-
-                for oidx, otu in enumerate(mcmc.graph.data.taxa):
-                    metadata_df_entries.append({
-                        'PerturbedFrac': alpha,
-                        'Perturbation': args.pert_strength,
-                        'Trial': trial,
-                        'OTU': otu.name,
-                        'IsPerturbed': oidx in perturbed_otus
-                    })
+    print("Loading parameters of {} Gibbs samples.".format(len(gibbs_indices)))
+    growth, interactions = load_parameters(mcmc, gibbs_indices)
 
     out_dir = Path(args.out_dir)
+    out_dir.mkdir(exist_ok=True, parents=True)
+
+    # Results are appended to the (columnar) Parquet tables one alpha at a time, partitioned by the
+    # perturbation parameters.
+    fwsim_writer = simulation_tables.TableWriter(out_dir / "fwsim.parquet")
+    metadata_writer = simulation_tables.TableWriter(out_dir / "metadata.parquet")
+    for alpha in tqdm(alphas, desc="Alphas"):
+        perturbations = sample_perturbations(
+            n_otus=len(study.taxa),
+            frac_otus_to_perturb=alpha,
+            pert_strength=args.pert_strength,
+            num_trials=args.num_trials,
+            master_seed=master_seed
+        )
+        steady_states, converged = perturbed_steady_states(
+            growth,
+            interactions,
+            perturbations,
+            pert_start_day=args.pert_start_day,
+            pert_end_day=args.pert_end_day,
+            initial_conditions=initial_conditions,
+            dt=args.simulation_dt,
+            sim_max=args.sim_max,
+            n_days=args.n_days,
+            steady_state_tol=args.steady_state_tol
+        )
+        if args.steady_state_tol is not None and not np.all(converged):
+            print("Alpha={}: {}/{} simulations did not reach the steady state tolerance within {} days.".format(
+                alpha, np.sum(~converged), converged.size, args.n_days))
 
-    fwsim_df = pd.DataFrame(fwsim_df_entries)
-    del fwsim_df_entries
-    fwsim_df.to_hdf(str(out_dir / "fwsim.h5"), key='df', mode='w')
-
-    metadata_df = pd.DataFrame(metadata_df_entries)
-    del metadata_df_entries
-    metadata_df.to_hdf(str(out_dir / "metadata.h5"), key='df', mode='w')
+        fwsim_writer.append(steady_state_table(steady_states, alpha, args.pert_strength, gibbs_indices, otu_names))
+        metadata_writer.append(metadata_table(perturbations, alpha, otu_names))
 
 
 def generate_initial_condition(study, limit_of_detection: float):
     print("Generating initial conditions from Day 20 measurements.")
-    M = study.matrix(dtype='abs', agg='mean', times='intersection', qpcr_unnormalize=True)
-    initial_conditions = M[:, 19]
+    M = study_matrices.study_matrices(study).matrix(dtype='abs', agg='mean', times='intersection',
+                                                   qpcr_unnormalize=True)
+    initial_conditions = M[:, 19].copy()
     initial_conditions[initial_conditions < limit_of_detection] = limit_of_detection
     return initial_conditions
 
 
-def forward_simulation_results(
-        mcmc: md2.BaseMCMC,
-        study: md2.Study,
-        alpha: float,
-        pert: float,
-        pert_start_day,
-        pert_end_day,
-        initial_conditions,
-        dt,
-        sim_max,
-        n_days,
-        gibbs_indices: List[int],
-        master_seed: Seed
-) -> Iterator[Dict]:
+def steady_state_table(steady_states: np.ndarray,
+                       alpha: float,
+                       pert: float,
+                       gibbs_indices: List[int],
+                       otu_names: np.ndarray) -> pd.DataFrame:
     """
-    Compute the steady state for the specified simulation, for each taxa.
+    Flatten the (n_gibbs, n_trials, n_taxa) steady states of a single alpha into the long-format table
+    (one row per trial, gibbs sample and taxa, in that order).
     """
-    for gibbs_idx, forward_sim, perturbed_otus in perturbed_forward_sims(
-            mcmc,
-            study,
-            frac_otus_to_perturb=alpha,
-            pert_strength=pert,
-            pert_start_day=pert_start_day,
-            pert_end_day=pert_end_day,
-            initial_conditions=initial_conditions,
-            dt=dt,
-            sim_max=sim_max,
-            n_days=n_days,
-            gibbs_indices=gibbs_indices,
-            master_seed=master_seed
-    ):
-        stable_levels = forward_sim[:, -50:].mean(axis=1)  # Last 50 timepoints
-
-        fwsim_entries = []
-        for oidx, otu in enumerate(mcmc.graph.data.taxa):
-            fwsim_entries.append({
-                "OTU": otu.name,
-                "SampleIdx": gibbs_idx,
-                "SteadyState": stable_levels[oidx]
-            })
-
-        yield fwsim_entries, perturbed_otus
-
+    n_gibbs, n_trials, n_otus = steady_states.shape
+    return pd.DataFrame({
+        'OTU': pd.Categorical.from_codes(np.tile(np.arange(n_otus), n_trials * n_gibbs), categories=otu_names),
+        'SampleIdx': np.tile(np.repeat(gibbs_indices, n_otus), n_trials),
+        'SteadyState': steady_states.transpose(1, 0, 2).ravel(),
+        'PerturbedFrac': np.full(n_trials * n_gibbs * n_otus, alpha),
+        'Perturbation': np.full(n_trials * n_gibbs * n_otus, pert),
+        'Trial': np.repeat(np.arange(n_trials), n_gibbs * n_otus)
+    })
+
+
+def metadata_table(perturbations: List[Tuple[np.ndarray, float]],
+                   alpha: float,
+                   otu_names: np.ndarray) -> pd.DataFrame:
+    """
+    Flatten the perturbations (one per trial) of a single alpha into the long-format table.
+    """
+    n_trials, n_otus = len(perturbations), len(otu_names)
+    is_perturbed = np.zeros(shape=(n_trials, n_otus), dtype=bool)
+    strengths = np.zeros(n_trials)
+    for trial, (otus_to_perturb, pert_strength) in enumerate(perturbations):
+        is_perturbed[trial, otus_to_perturb] = True
+        strengths[trial] = pert_strength
+
+    return pd.DataFrame({
+        'PerturbedFrac': np.full(n_trials * n_otus, alpha),
+        'Perturbation': np.repeat(strengths, n_otus),
+        'Trial': np.repeat(np.arange(n_trials), n_otus),
+        'OTU': pd.Categorical.from_codes(np.tile(np.arange(n_otus), n_trials), categories=otu_names),
+        'IsPerturbed': is_perturbed.ravel()
+    })
+
+
+def load_parameters(mcmc: md2.BaseMCMC, gibbs_indices: List[int]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Load the growth rates and interactions (with the self-interactions on the diagonal) of the subsampled Gibbs
+    samples. The full traces are only held in memory while they are being sliced.
+
+    Returns
+    -------
+    np.ndarray(n_gibbs, n_taxa)
+        Growth rates
+    np.ndarray(n_gibbs, n_taxa, n_taxa)
+        Interactions
+    """
+    growth = mcmc.graph[STRNAMES.GROWTH_VALUE].get_trace_from_disk(section="posterior")[gibbs_indices]
+    self_interactions = mcmc.graph[STRNAMES.SELF_INTERACTION_VALUE].get_trace_from_disk(
+        section="posterior")[gibbs_indices]
+    interactions = mcmc.graph[STRNAMES.INTERACTIONS_OBJ].get_trace_from_disk(section="posterior")[gibbs_indices]
+    interactions[np.isnan(interactions)] = 0
+    self_interactions = -np.absolute(self_interactions)
+    for i in range(self_interactions.shape[1]):
+        interactions[:, i, i] = self_interactions[:, i]
+    return growth, interactions
 
 
-def perturbed_forward_sims(
-        mcmc: md2.BaseMCMC,
-        study: md2.Study,
+def sample_perturbations(
+        n_otus: int,
         frac_otus_to_perturb: float,
         pert_strength: float,
+        num_trials: int,
+        master_seed: Seed
+) -> List[Tuple[np.ndarray, float]]:
+    """
+    Sample the OTUs to perturb for each trial. (Key idea: Re-sample perturbed OTUs for each trial.)
+
+    Returns
+    -------
+    list of (np.ndarray, float)
+        For each trial, the indices of the perturbed OTUs and the strength of the perturbation.
+    """
+    n_otus_perturb = max(0, int(n_otus * frac_otus_to_perturb))
+    perturbations = []
+    for _ in range(num_trials):
+        rng = np.random.default_rng(master_seed.next_value())
+        otus_to_perturb = rng.choice(
+            a=n_otus,
+            size=n_otus_perturb,
+            replace=False
+        )
+        perturbations.append((otus_to_perturb, pert_strength))
+    return perturbations
+
+
+def perturbed_steady_states(
+        growth: np.ndarray,
+        interactions: np.ndarray,
+        perturbations: List[Tuple[np.ndarray, float]],
         pert_start_day,
         pert_end_day,
         initial_conditions,
         dt,
         sim_max,
         n_days,
-        gibbs_indices: List[int],
-        master_seed: Seed
-) -> Iterator[Tuple[int, np.ndarray]]:
-    growth = mcmc.graph[STRNAMES.GROWTH_VALUE].get_trace_from_disk(section="posterior")
-    self_interactions = mcmc.graph[STRNAMES.SELF_INTERACTION_VALUE].get_trace_from_disk(section="posterior")
-    interactions = mcmc.graph[STRNAMES.INTERACTIONS_OBJ].get_trace_from_disk(section="posterior")
-    interactions[np.isnan(interactions)] = 0
-    self_interactions = -np.absolute(self_interactions)
-    for i in range(self_interactions.shape[1]):
-        interactions[:, i, i] = self_interactions[:, i]
-
-    # Create the perturbation effect matrix. (Key idea: Re-sample perturbed OTUs for each gibbs sample.)
-    n_otus_perturb = max(0, int(len(study.taxa) * frac_otus_to_perturb))
-    rng = np.random.default_rng(master_seed.next_value())
-    otus_to_perturb = rng.choice(
-        a=len(study.taxa),
-        size=n_otus_perturb,
-        replace=False
-    )
-    perturbations = np.zeros(shape=(growth.shape[0], len(study.taxa)))
-    perturbations[:, otus_to_perturb] = pert_strength
-
-    for gibbs_idx in gibbs_indices:
-        yield gibbs_idx, _forward_sim(
-            growth=growth,
-            interactions=interactions,
-            perturbations=perturbations,
-            pert_start_day=pert_start_day,
-            pert_end_day=pert_end_day,
-            initial_conditions=initial_conditions,
-            dt=dt,
-            sim_max=sim_max,
-            n_days=n_days,
-            gibbs_idx=gibbs_idx
-        ), otus_to_perturb
-
-
-def _forward_sim(growth,
-                 interactions,
-                 perturbations,
-                 pert_start_day,
-                 pert_end_day,
-                 initial_conditions,
-                 dt,
-                 sim_max,
-                 n_days,
-                 gibbs_idx):
-    '''Forward simulate with the given dynamics. First start with the perturbation
-    off, then on, then off.
+        steady_state_tol: float = None
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Forward simulate every perturbation (trial) for every Gibbs sample as one batch.
 
     Parameters
     ----------
     growth : np.ndarray(n_gibbs, n_taxa)
-        Growth parameters
+        Growth rates of the subsampled Gibbs samples
     interactions : np.ndarray(n_gibbs, n_taxa, n_taxa)
-        Interaction parameters
-    perturbations : np.ndarray(n_gibbs, n_taxa)
-        Perturbation effect
-    initial_conditions : np.ndarray(n_taxa)
-        Initial conditions of the taxa
-    dt : float
-        Step size to forward simulate with
-    sim_max : float, None
-        Maximum clip for forward sim
-    pert_start_day : float
-        Day to start the perturbation
-    pert_end_day : float
-        Day to end the perturbation
-    n_days : float
-        Total number of days
-    '''
-    dyn = md2.model.gLVDynamicsSingleClustering(growth=None, interactions=None,
-                                                perturbation_ends=[pert_end_day], perturbation_starts=[pert_start_day],
-                                                start_day=0, sim_max=sim_max)
-    initial_conditions = initial_conditions.reshape(-1, 1)
-
-    dyn.growth = growth[gibbs_idx]
-    dyn.interactions = interactions[gibbs_idx]
-    dyn.perturbations = [perturbations[gibbs_idx]]
-
-    x = md2.integrate(dynamics=dyn, initial_conditions=initial_conditions,
-                      dt=dt, n_days=n_days, subsample=False)
-    gibbs_step_sim = x['X']
-    return gibbs_step_sim
+        Interactions of the subsampled Gibbs samples
+    perturbations : list of (np.ndarray, float)
+        For each trial, the indices of the perturbed OTUs and the strength of the perturbation.
+
+    Returns
+    -------
+    np.ndarray(n_gibbs, n_trials, n_taxa)
+        The steady states. If `steady_state_tol` is None, this is the average of the last 50 timepoints,
+        otherwise the state at which the simulation converged.
+    np.ndarray(n_gibbs, n_trials), bool
+        Whether each simulation converged
+    """
+    # Perturbation effect of each trial (shared by every Gibbs sample).
+    perturbation_effects = np.zeros(shape=(len(perturbations), growth.shape[1]))
+    for trial, (otus_to_perturb, pert_strength) in enumerate(perturbations):
+        perturbation_effects[trial, otus_to_perturb] = pert_strength
+
+    ret = steady_state.integrate_to_steady_state(
+        growth=growth[:, None, :],
+        interactions=interactions,
+        initial_conditions=initial_conditions,
+        dt=dt,
+        n_days=n_days,
+        perturbation=perturbation_effects,
+        pert_start_day=pert_start_day,
+        pert_end_day=pert_end_day,
+        sim_max=sim_max,
+        rel_tol=steady_state_tol,
+        average_last=50 if steady_state_tol is None else None  # Last 50 timepoints
+    )
+    return ret['X'], ret['converged']
 
 
 if __name__ == "__main__":
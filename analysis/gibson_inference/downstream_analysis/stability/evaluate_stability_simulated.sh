@@ -5,6 +5,9 @@ source gibson_inference/settings.sh
 
 echo "Running forward simulations for Healthy dataset."
 
+stage stability-healthy \
+--outputs $DOWNSTREAM_ANALYSIS_OUT_DIR/stability/healthy/fwsim.parquet $DOWNSTREAM_ANALYSIS_OUT_DIR/stability/healthy/metadata.parquet \
+-- \
 python gibson_inference/downstream_analysis/stability/evaluate_stability_simulated.py \
 --input-mcmc $MDSINE_OUT_DIR/healthy-seed0/mcmc.pkl \
 --study $MDSINE_OUT_DIR/healthy-seed0/subjset.pkl \
@@ -23,6 +26,9 @@ python gibson_inference/downstream_analysis/stability/evaluate_stability_simulat
 
 echo "Running forward simulations for Dysbiotic dataset."
 
+stage stability-uc \
+--outputs $DOWNSTREAM_ANALYSIS_OUT_DIR/stability/uc/fwsim.parquet $DOWNSTREAM_ANALYSIS_OUT_DIR/stability/uc/metadata.parquet \
+-- \
 python gibson_inference/downstream_analysis/stability/evaluate_stability_simulated.py \
 --input-mcmc $MDSINE_OUT_DIR/uc-seed0/mcmc.pkl \
 --study $MDSINE_OUT_DIR/uc-seed0/subjset.pkl \
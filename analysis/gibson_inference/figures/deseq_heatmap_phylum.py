@@ -1,28 +1,16 @@
 import numpy as np
 import pandas as pd
-import seaborn as sns
-import matplotlib.pyplot as plt
 import matplotlib as mpl
 import argparse
+import sys
+from pathlib import Path
 import os
 
-from matplotlib import rcParams
-from matplotlib import font_manager
 
-rcParams['pdf.fonttype'] = 42
-
-font_dirs = ['gibson_inference/figures/arial_fonts']
-font_files = font_manager.findSystemFonts(fontpaths=font_dirs)
-#print(font_files)
-
-for font_file in font_files:
-    #print(font_file)
-    ff = font_file.split("/")[-1]
-    if "._" not in ff:
-        font_manager.fontManager.addfont(font_file)
-
-# change font
-rcParams['font.family'] = 'Arial'
+sys.path.append(str(Path(__file__).resolve().parents[2] / 'helpers'))
+import plot_setup
+plt = plot_setup.lazy_import('matplotlib.pyplot')
+sns = plot_setup.lazy_import('seaborn')
 
 def parse_args():
 
@@ -173,6 +161,7 @@ def make_heatmap(df, axes, label_x=False, title=None, label_y=False):
 
 if __name__ =="__main__":
 
+    plot_setup.use_arial_fonts()
     args = parse_args()
     deseq_loc = args.deseq_loc
     file = open("{}/{}.txt".format(deseq_loc, args.txt_file))
@@ -199,7 +188,6 @@ if __name__ =="__main__":
     uc_df_non_abundant = make_df(deseq_loc, names_not_abundant, "uc")
 
 
-
     if args.abundance == "high":
         make_plot(healthy_df_abundant, uc_df_abundant, args.abundance,
             args.taxonomy, args.output_name, args.output_loc)
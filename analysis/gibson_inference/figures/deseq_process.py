@@ -2,13 +2,6 @@
 import numpy as np
 import pandas as pd
 
-import seaborn as sns
-import matplotlib.pyplot as plt
-import matplotlib as mpl
-import argparse
-from matplotlib import rcParams
-from matplotlib import font_manager
-
 
 def get_deseq_info_phylum(loc, donor):
 
@@ -11,17 +11,13 @@ import pandas as pd
 import numpy as np
 import argparse
 import os
+import sys
+from pathlib import Path
 import matplotlib
-from matplotlib import rcParams
-from matplotlib import font_manager
 
 #import matplotlib.font_manager
-import matplotlib.pyplot as plt
-import seaborn as sns
 from matplotlib.patches import Rectangle
 
-import matplotlib.pyplot as plt
-import seaborn as sns
 import matplotlib.ticker as plticker
 from matplotlib.ticker import ScalarFormatter, LogFormatter, LogFormatterSciNotation, FixedLocator
 import matplotlib.patches as patches
@@ -37,23 +33,12 @@ from matplotlib.colors import LogNorm
 import matplotlib.image as mpimg
 from matplotlib.offsetbox import TextArea, DrawingArea, OffsetImage, AnnotationBbox
 from matplotlib.gridspec import GridSpec
-from matplotlib import rcParams
-from matplotlib import font_manager
 
-rcParams['pdf.fonttype'] = 42
-
-font_dirs = ['gibson_inference/figures/arial_fonts']
-font_files = font_manager.findSystemFonts(fontpaths=font_dirs)
-#print(font_files)
-
-for font_file in font_files:
-    #print(font_file)
-    ff = font_file.split("/")[-1]
-    if "._" not in ff:
-        font_manager.fontManager.addfont(font_file)
-
-# change font
-rcParams['font.family'] = 'Arial'
+sys.path.append(str(Path(__file__).resolve().parents[2] / 'helpers'))
+import taxa_aggregation
+import plot_setup
+plt = plot_setup.lazy_import('matplotlib.pyplot')
+sns = plot_setup.lazy_import('seaborn')
 
 
 TAXLEVEL = "family"
@@ -87,88 +72,23 @@ def parse_args():
     return parser.parse_args()
 
 
-def _cnt_times(df, times, times_cnts, t2idx):
-    """counts the number of times data at a given point were collected"""
-
-    for col in df.columns:
-        if col in times:
-            times_cnts[t2idx[col]] += 1
-    #print(times_cnts)
-
-    return times_cnts
-
-def _add_unequal_col_dataframes(df, dfother, times, times_cnts, t2idx):
-    '''
-    Add the contents of both the dataframes. This controls for the
-    columns in the dataframes `df` and `dfother` being different.
-    '''
-
-    times_cnts = _cnt_times(dfother, times, times_cnts, t2idx)
-    if df is None:
-        return dfother, times_cnts
-
-    cols_toadd_df = []
-    cols_toadd_dfother = []
-    for col in dfother.columns:
-        if col not in df.columns:
-            cols_toadd_df.append(col)
-    for col in df.columns:
-        if col not in dfother.columns:
-            cols_toadd_dfother.append(col)
-
-    df = pd.concat([df,
-        pd.DataFrame(np.zeros(shape=(len(df.index), len(cols_toadd_df))),
-            index=df.index, columns=cols_toadd_df)], axis=1)
-    dfother = pd.concat([dfother,
-        pd.DataFrame(np.zeros(shape=(len(dfother.index), len(cols_toadd_dfother))),
-            index=dfother.index, columns=cols_toadd_dfother)], axis=1)
-
-    return dfother.reindex(df.index) + df, times_cnts
-
-def _get_top(df, cutoff_frac_abundance, taxlevel, taxaname_map=None):
+def _get_top(df, cutoff_frac_abundance, taxlevel):
     """
        selects the data associated with taxon (at taxlevel) whose abundace is
-       greater than the cutoff_frac_abundance
+       greater than the cutoff_frac_abundance; the remaining taxa are summed
+       into a single row
     """
-    matrix = df.values
-    abunds = np.sum(matrix, axis=1)
-    namemap = {}
-
-    a = abunds / abunds.sum()
-    a = np.sort(a)[::-1]
+    return taxa_aggregation.top_groups(df, cutoff_frac_abundance=cutoff_frac_abundance,
+        other_label='{} with <{}% total abund'.format(TAXLEVEL_PLURALS[taxlevel],
+        cutoff_frac_abundance*100))
 
-    cutoff_num = None
-    for i in range(len(a)):
-        if a[i] < cutoff_frac_abundance:
-            cutoff_num = i
-            break
-    if cutoff_num is None:
-        raise ValueError('Error')
-    #Number of taxa whose abundance is greater than the threshold
-    #print('Cutoff Num:', cutoff_num)
-
-    idxs = np.argsort(abunds)[-cutoff_num:][::-1]
-    dfnew = df.iloc[idxs, :]
-
-    if taxaname_map is not None:
-        indexes = df.index
-        for idx in idxs:
-            namemap[indexes[idx]] = taxaname_map[indexes[idx]]
-
-    # Add everything else as 'Other'
-    vals = None
-    for idx in range(len(df.index)):
-        if idx not in idxs:
-            if vals is None:
-                vals = df.values[idx, :]
-            else:
-                vals += df.values[idx, :]
+def _index_formatter():
+    """format of the names of the taxa at TAXLEVEL"""
 
-    dfother = pd.DataFrame([vals], columns=df.columns, index=['{} with <{}% total abund'.format(
-        TAXLEVEL_PLURALS[taxlevel], cutoff_frac_abundance*100)])
-    df = dfnew.append(dfother)
-
-    return df
+    taxidx = TAXLEVEL_REV_IDX[TAXLEVEL]
+    upper_tax = TAXLEVEL_INTS[taxidx+1]
+    lower_tax = TAXLEVEL_INTS[taxidx]
+    return '%({})s %({})s'.format(upper_tax, lower_tax)
 
 def get_df(subjset):
     """
@@ -176,29 +96,9 @@ def get_df(subjset):
        @parameters
        subjset : (pl.Subject)
     """
-    taxidx = TAXLEVEL_REV_IDX[TAXLEVEL]
-    upper_tax = TAXLEVEL_INTS[taxidx+1]
-    lower_tax = TAXLEVEL_INTS[taxidx]
-
-    df = None
-    times = []
-    for subj in subjset:
-        times = np.append(times, subj.times)
-
-    times = np.sort(np.unique(times))#the times at which samples were collected
-    t2idx = {}
-    for i,t in enumerate(times):
-        t2idx[t] = i
-    times_cnts = np.zeros(len(times)) #the times at which samples were taken
-
-    #update the data frame for each subject
-    for subj in subjset:
-        dfnew, taxaname_map = subj.cluster_by_taxlevel(dtype='abs',
-        taxlevel=TAXLEVEL, index_formatter='%({})s %({})s'.format(upper_tax,
-        lower_tax), smart_unspec=False)
-
-        df, times_cnts = _add_unequal_col_dataframes(df=df, dfother=dfnew,
-             times=times, times_cnts=times_cnts, t2idx=t2idx)
+    #sum the abundances of all the subjects at TAXLEVEL
+    df, taxaname_map = taxa_aggregation.aggregate_taxlevel(subjset.taxa, subjset,
+        index_formatter=_index_formatter(), dtype='abs')
 
     df = df / df.sum(axis=0)
 
@@ -290,10 +190,6 @@ def plot_rel_and_qpcr(subjset, subjset_inoc, df, dset_type, axqpcr, axrel, axper
     plots the relative abundance and perturbation
     """
 
-    taxidx = TAXLEVEL_REV_IDX[TAXLEVEL]
-    upper_tax = TAXLEVEL_INTS[taxidx+1]
-    lower_tax = TAXLEVEL_INTS[taxidx]
-
     final_labels = []
     labels = None
     if labels_order is None:
@@ -380,11 +276,10 @@ def plot_rel_and_qpcr(subjset, subjset_inoc, df, dset_type, axqpcr, axrel, axper
         inoc = subjset_inoc["Ulcerative Colitis"]
 
     #print("Adding inoculum")
-    df_inoc, taxa_map_inoc = inoc.cluster_by_taxlevel(dtype='raw',
-            taxlevel=TAXLEVEL, index_formatter='%({})s %({})s'.format(upper_tax,
-            lower_tax), smart_unspec=False)
+    df_inoc, taxa_map_inoc = taxa_aggregation.aggregate_taxlevel(subjset_inoc.taxa,
+            [inoc], index_formatter=_index_formatter(), dtype='raw')
     df_inoc = _get_top(df_inoc, cutoff_frac_abundance=CUTOFF_FRAC_ABUNDANCE,
-        taxlevel=TAXLEVEL, taxaname_map = taxa_map_inoc)
+        taxlevel=TAXLEVEL)
 
     matrix_inoc = df_inoc.to_numpy()
     matrix_inoc = np.flipud(matrix_inoc)
@@ -690,6 +585,7 @@ def get_deseq_info(loc, donor):
 
 def main():
 
+    plot_setup.use_arial_fonts()
     print("Making Figure 2")
     XKCD_COLORS1 = sns.color_palette('muted', n_colors=10)
     XKCD_COLORS2 = sns.color_palette("dark", n_colors=10)
@@ -791,4 +687,5 @@ def main():
 
     print("Done Making Figure 2")
 
-main()
+if __name__ == "__main__":
+    main()
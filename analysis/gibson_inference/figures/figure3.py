@@ -1,37 +1,25 @@
 import numpy as np
-import matplotlib.pyplot as plt
 import os
-from scipy import stats
 import pickle as pkl
 import pandas as pd
-import seaborn as sns
 import matplotlib.gridspec as gridspec
-from statsmodels.stats import multitest
 import matplotlib.lines as mlines
 import argparse
-from matplotlib import rcParams
-from matplotlib import font_manager
+import sys
+from pathlib import Path
 
-rcParams['pdf.fonttype'] = 42
-
-font_dirs = ['gibson_inference/figures/arial_fonts']
-font_files = font_manager.findSystemFonts(fontpaths=font_dirs)
-#print(font_files)
-
-for font_file in font_files:
-    #print(font_file)
-    ff = font_file.split("/")[-1]
-    if "._" not in ff:
-        font_manager.fontManager.addfont(font_file)
-
-# change font
-rcParams['font.family'] = 'Arial'
+sys.path.append(str(Path(__file__).resolve().parents[2] / 'helpers'))
+import plot_setup
+plt = plot_setup.lazy_import('matplotlib.pyplot')
+sns = plot_setup.lazy_import('seaborn')
+stats = plot_setup.lazy_import('scipy.stats')
+multitest = plot_setup.lazy_import('statsmodels.stats.multitest')
 
 REL_ORDER = ["MDSINE2", "cLV", "LRA", "gLV-RA", "gLV-ridge", "gLV-elastic\n net"]
 ABS_ORDER = ["MDSINE2", "gLV-ridge", "gLV-elastic\n net"]
 
-HEX_REL = sns.color_palette("tab10").as_hex()
-HEX_ABS = sns.color_palette("tab10").as_hex()
+HEX_REL = plot_setup.TAB10_HEX
+HEX_ABS = plot_setup.TAB10_HEX
 
 PAL_REL = {"MDSINE2":HEX_REL[0], "cLV":HEX_REL[3], "LRA":HEX_REL[4],
    "gLV-RA":HEX_REL[5], "gLV-ridge":HEX_REL[1], "gLV-elastic\n net":HEX_REL[2]}
@@ -302,6 +290,7 @@ def export_df(order, p_values, p_values_adjusted, name):
 
 def main():
 
+    plot_setup.use_arial_fonts()
     healthy_subjs = ["2", "3", "4", "5"]
     uc_subjs = ["6", "7", "8", "9", "10"]
     prior = "mixed"
@@ -360,4 +349,5 @@ def main():
 
     print("Done Making Figure 3")
 
-main()
+if __name__ == "__main__":
+    main()
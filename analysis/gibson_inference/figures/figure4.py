@@ -1,17 +1,15 @@
 '''Figure 4 of the gibson paper
 '''
 
-import matplotlib.pyplot as plt
-import seaborn as sns
 import mdsine2 as md2
 from mdsine2.names import STRNAMES
 import numpy as np
 import sys
+from pathlib import Path
 import os
 import pandas as pd
 import argparse
 from mdsine2.pylab.inference import BaseMCMC
-import ete3
 from Bio import Phylo
 
 
@@ -22,23 +20,13 @@ from matplotlib.lines import Line2D
 import matplotlib.colors as colors
 from matplotlib.collections import PatchCollection
 
-from matplotlib import rcParams
-from matplotlib import font_manager
 
-rcParams['pdf.fonttype'] = 42
-
-font_dirs = ['gibson_inference/figures/arial_fonts']
-font_files = font_manager.findSystemFonts(fontpaths=font_dirs)
-#print(font_files)
-
-for font_file in font_files:
-    #print(font_file)
-    ff = font_file.split("/")[-1]
-    if "._" not in ff:
-        font_manager.fontManager.addfont(font_file)
-
-# change font
-rcParams['font.family'] = 'Arial'
+sys.path.append(str(Path(__file__).resolve().parents[2] / 'helpers'))
+import plot_setup
+import study_matrices
+plt = plot_setup.lazy_import('matplotlib.pyplot')
+sns = plot_setup.lazy_import('seaborn')
+ete3 = plot_setup.lazy_import('ete3')
 
 
 def phylogenetic_heatmap_gram_split(inoc_pkl, healthy_pkl, uc_pkl, chain_healthy,
@@ -109,7 +97,6 @@ def phylogenetic_heatmap_gram_split(inoc_pkl, healthy_pkl, uc_pkl, chain_healthy
     healthy_ncols = 16 #heatmap_width - uc_ncols
 
 
-
     inoc_cols = 1
 
     max_uc, min_uc = get_scale(chain_uc)
@@ -404,7 +391,7 @@ def _make_inoc_heatmap(pkl, subject_name, ax, order, fig, vmax, vmin, make_color
         taxa_idx_dict[taxas[i].name] = i
 
     subj = pkl[subject_name]
-    inoc_abundance = subj.matrix()["rel"]
+    inoc_abundance = study_matrices.subject_matrices(subj).rel
     inoc_abundance_order = []
     for otu in order:
         inoc_abundance_order.append(inoc_abundance[taxa_idx_dict[otu.strip()]])
@@ -730,7 +717,7 @@ def get_scale(name):
     subjset = chain.graph.data.subjects
     rel_abund = np.zeros(len(subjset.taxa))
     for subj in subjset:
-        M = subj.matrix()['rel']
+        M = study_matrices.subject_matrices(subj).rel
         start_idx = np.searchsorted(subj.times, 14)
         end_idx = np.searchsorted(subj.times, 21.5)
 
@@ -745,7 +732,7 @@ def get_scale(name):
 def is_zero_abundance(order, studyset, dict_):
     zero_abundant = {}
     for subj in studyset:
-        M = subj.matrix()['rel']
+        M = study_matrices.subject_matrices(subj).rel
         #print(M.shape)
         for otu in order:
             idx = dict_[otu.strip()]
@@ -782,7 +769,7 @@ def _make_cluster_membership_heatmap(chainname, study_pkl, ax, order, binary, fi
     if not binary:
         rel_abund = np.zeros(len(subjset.taxa))
         for subj in subjset:
-            M = subj.matrix()['rel']
+            M = study_matrices.subject_matrices(subj).rel
             start_idx = np.searchsorted(subj.times, 14)
             end_idx = np.searchsorted(subj.times, 21.5)
 
@@ -948,6 +935,7 @@ def parse_args():
 
 if __name__ == '__main__':
 
+    plot_setup.use_arial_fonts()
     print("Making Figure 4")
     args = parse_args()
     study_inoc = md2.Study.load(args.study_inoc)
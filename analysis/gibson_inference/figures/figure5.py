@@ -6,26 +6,14 @@ python make_plots.py -file1 "seed0_mult_sparse_3/distance.csv" \
 
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
 import argparse
+import sys
+from pathlib import Path
 import os
-from matplotlib import rcParams
-from matplotlib import font_manager
 
-rcParams['pdf.fonttype'] = 42
-
-font_dirs = ['gibson_inference/figures/arial_fonts']
-font_files = font_manager.findSystemFonts(fontpaths=font_dirs)
-#print(font_files)
-
-for font_file in font_files:
-    #print(font_file)
-    ff = font_file.split("/")[-1]
-    if "._" not in ff:
-        font_manager.fontManager.addfont(font_file)
-
-# change font
-rcParams['font.family'] = 'Arial'
+sys.path.append(str(Path(__file__).resolve().parents[2] / 'helpers'))
+import plot_setup
+plt = plot_setup.lazy_import('matplotlib.pyplot')
 
 
 def parse_args():
@@ -79,6 +67,7 @@ def plot(x, y1, y2, p5, p95, x_lab, y_lab, title, leg1, leg2, savename):
 
 def main():
 
+    plot_setup.use_arial_fonts()
     print("Making Figure 5")
     args = parse_args()
     thresh_pd = pd.read_csv(args.thresholds, index_col = 0)
@@ -102,4 +91,5 @@ def main():
     print("Done Making Figure 5")
 
 
-main()
+if __name__ == "__main__":
+    main()
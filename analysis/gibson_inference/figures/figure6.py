@@ -5,10 +5,14 @@ import numpy as np
 import scipy
 import scipy.stats
 import pandas as pd
+import sys
 from pathlib import Path
 from tqdm.notebook import tqdm
 import seaborn as sns
 
+sys.path.append(str(Path(__file__).resolve().parents[2] / 'helpers'))
+import simulation_tables
+
 
 # COLORS
 _default_colors = sns.color_palette()
@@ -24,7 +28,8 @@ def stat_annotate(x1, x2, y, h, color, ax, lw=1.0, desc='*'):
 class PerturbationSimFigure():
     """Render figures for perturbation simulations. (Figures 6A,6B)"""
 
-    def __init__(self, data_dir: Path, healthy_color=_default_healthy_color, uc_color=_default_uc_color):
+    def __init__(self, data_dir: Path, healthy_color=_default_healthy_color, uc_color=_default_uc_color,
+                 perturbation=-2.0):
         self.healthy_color = healthy_color
         self.uc_color = uc_color
 
@@ -33,130 +38,89 @@ class PerturbationSimFigure():
 
         # ============ Preprocessing
         print("Loading dataframes from disk.")
-        healthy_random_pert_metadata_df = pd.read_hdf(
-            data_dir / 'healthy_metadata.h5', key="df", mode="r")
-        healthy_random_pert_fwsim_df = pd.read_hdf(
-            data_dir / 'healthy_fwsim.h5', key="df", mode="r"
+        healthy_random_pert_fwsim_df = self.load_random_pert_tables(
+            data_dir / 'healthy_fwsim.parquet', perturbation=perturbation
+        )
+        uc_random_pert_fwsim_df = self.load_random_pert_tables(
+            data_dir / 'uc_fwsim.parquet', perturbation=perturbation
         )
 
-        uc_random_pert_metadata_df = pd.read_hdf(
-            data_dir / 'uc_metadata.h5', key="df", mode="r"
+        print("Building the steady state arrays.")
+        healthy_random_pert_arrays = self.posthoc_random_pert_helper(
+            healthy_random_pert_fwsim_df, perturbation=perturbation
         )
-        uc_random_pert_fwsim_df = pd.read_hdf(
-            data_dir / 'uc_fwsim.h5', key="df", mode="r"
+        uc_random_pert_arrays = self.posthoc_random_pert_helper(
+            uc_random_pert_fwsim_df, perturbation=perturbation
         )
 
-        print("Merging dataframes.")
-        healthy_random_pert_merged_df = self.posthoc_random_pert_helper(healthy_random_pert_fwsim_df, healthy_random_pert_metadata_df)
-        uc_random_pert_merged_df = self.posthoc_random_pert_helper(uc_random_pert_fwsim_df, uc_random_pert_metadata_df)
-
         print("Computing difference levels.")
-        self.random_pert_concat_df = self.random_pert_diff_figure_df(healthy_random_pert_merged_df, uc_random_pert_merged_df)
+        self.random_pert_concat_df = self.random_pert_diff_figure_df(healthy_random_pert_arrays, uc_random_pert_arrays)
 
         print("Computing diversities.")
         self.random_pert_diversity_df, self.healthy_random_pert_baseline_diversity, self.uc_random_pert_baseline_diversity = self.precompute_diversities(
-            healthy_random_pert_fwsim_df, uc_random_pert_fwsim_df
+            healthy_random_pert_arrays, uc_random_pert_arrays
         )
 
         print("Finished initialization.")
 
     @staticmethod
-    def posthoc_random_pert_helper(fwsim: pd.DataFrame, metadata: pd.DataFrame):
-        merged_df = fwsim.loc[(fwsim["PerturbedFrac"] != 0.0), :].merge(
-            fwsim.loc[(fwsim["PerturbedFrac"] == 0.0), ["OTU", "SteadyState", "Died", "SampleIdx"]],
-            left_on=["OTU", "SampleIdx"],
-            right_on=["OTU", "SampleIdx"],
-            how="inner",
-            suffixes=["", "Base"]
-        ).merge(
-            metadata.loc[
-                :,
-                ["OTU", "PerturbedFrac", "Perturbation", "Trial", "IsPerturbed"]
-            ],
-            left_on=["OTU", "PerturbedFrac", "Perturbation", "Trial"],
-            right_on=["OTU", "PerturbedFrac", "Perturbation", "Trial"]
-        ).set_index(["OTU", "PerturbedFrac", "Perturbation", "Trial", "SampleIdx"])
+    def load_random_pert_tables(fwsim_path: Path, perturbation=-2.0):
+        """
+        Load only the columns that the figures use, of the simulations with the given perturbation strength and
+        of the unperturbed baseline (PerturbedFrac = 0).
+        """
+        fwsim_df = simulation_tables.read_table(
+            fwsim_path,
+            columns=["OTU", "PerturbedFrac", "Perturbation", "Trial", "SampleIdx", "SteadyState"],
+            filters=[[("Perturbation", "==", perturbation)], [("PerturbedFrac", "==", 0.0)]]
+        )
+        return fwsim_df
 
-        merged_df["SteadyStateDiff"] = np.abs(np.log10(merged_df["SteadyState"] + 1e5) - np.log10(merged_df["SteadyStateBase"] + 1e5))
+    @staticmethod
+    def posthoc_random_pert_helper(fwsim: pd.DataFrame, perturbation=-2.0):
+        """
+        Arrange the steady states into dense (alpha, trial, gibbs, otu) arrays, with the baselines as
+        (baseline trial, gibbs, otu).
+        """
+        return simulation_tables.RandomPertArrays(fwsim, perturbation=perturbation)
 
-        return merged_df
+    @staticmethod
+    def alpha_trial_df(arrays: simulation_tables.RandomPertArrays, values: np.ndarray, name: str, dataset: str):
+        """Long-format table of a (alpha, trial) array."""
+        n_alpha, n_trials = values.shape
+        return pd.DataFrame({
+            "PerturbedFrac": np.repeat(arrays.alphas, n_trials),
+            "Perturbation": np.full(n_alpha * n_trials, arrays.perturbation),
+            "Trial": np.tile(arrays.trials, n_alpha),
+            name: values.ravel(),
+            "Dataset": dataset
+        })
 
     @staticmethod
-    def random_pert_diff_figure_df(healthy_merged_df: pd.DataFrame, uc_merged_df: pd.DataFrame, perturbation=-2.0):
-        #   OTU 	PerturbedFrac 	Perturbation 	Trial 	SampleIdx
-
-        healthy_agg_df = healthy_merged_df.loc[
-            (slice(None), slice(None), perturbation, slice(None), slice(None)),
-            ["SteadyStateDiff"]
-        ].groupby(
-            level=[1, 2, 3, 4]  # "PerturbedFrac", "Perturbation", "Trial", "SampleIdx"
-        ).mean().groupby(
-            level=[0, 1, 2]  # "PerturbedFrac", "Perturbation", "Trial"
-        ).mean()
-
-        uc_agg_df = uc_merged_df.loc[
-            (slice(None), slice(None), perturbation, slice(None), slice(None)),
-            ["SteadyStateDiff"]
-        ].groupby(
-            level=[1, 2, 3, 4]  # "PerturbedFrac", "Perturbation", "Trial", "SampleIdx"
-        ).mean().groupby(
-            level=[0, 1, 2]  # "PerturbedFrac", "Perturbation", "Trial"
-        ).mean()
-
-        healthy_agg_df["Dataset"] = "Healthy"
-        uc_agg_df["Dataset"] = "UC"
+    def random_pert_diff_figure_df(healthy_arrays: simulation_tables.RandomPertArrays,
+                                   uc_arrays: simulation_tables.RandomPertArrays):
+        # Mean over the OTUs, then over the gibbs samples, of each (PerturbedFrac, Trial)
         concat_df = pd.concat([
-            healthy_agg_df.reset_index(),
-            uc_agg_df.reset_index()
+            PerturbationSimFigure.alpha_trial_df(healthy_arrays, healthy_arrays.steady_state_diff(),
+                                                 "SteadyStateDiff", "Healthy"),
+            PerturbationSimFigure.alpha_trial_df(uc_arrays, uc_arrays.steady_state_diff(),
+                                                 "SteadyStateDiff", "UC")
         ])
 
         concat_df["key"] = r'$\alpha$:' + concat_df["PerturbedFrac"].astype(str) + "\nPert:" + concat_df["Perturbation"].astype(str)
         return concat_df
 
     @staticmethod
-    def precompute_diversities(healthy_fwsim_df, uc_fwsim_df, perturbation=-2.0):
-        def agg(x):
-            p = x["SteadyState"].to_numpy()
-            u = np.ones(p.shape[0])
-            return scipy.stats.entropy(p) / scipy.stats.entropy(u)
-
+    def precompute_diversities(healthy_arrays: simulation_tables.RandomPertArrays,
+                               uc_arrays: simulation_tables.RandomPertArrays):
         # ======= Altered
-        healthy_diversity = healthy_fwsim_df.loc[
-            (healthy_fwsim_df["PerturbedFrac"] != 0.0) & (healthy_fwsim_df["Perturbation"] == perturbation),
-            ["Trial", "SampleIdx", "SteadyState", "PerturbedFrac"]
-        ].groupby(["PerturbedFrac", "Trial", "SampleIdx"]).apply(
-            agg
-        ).groupby(level=[0, 1]).mean()
-        healthy_diversity = pd.DataFrame({"Diversity": healthy_diversity})
-        healthy_diversity["Dataset"] = "Healthy"
-
-        uc_diversity = uc_fwsim_df.loc[
-            (uc_fwsim_df["PerturbedFrac"] != 0.0) & (uc_fwsim_df["Perturbation"] == perturbation),
-            ["Trial", "SampleIdx", "SteadyState", "PerturbedFrac"]
-        ].groupby(["PerturbedFrac", "Trial", "SampleIdx"]).apply(
-            agg
-        ).groupby(level=[0, 1]).mean()
-        uc_diversity = pd.DataFrame({"Diversity": uc_diversity})
-        uc_diversity["Dataset"] = "UC"
-
-        diversities = pd.concat([healthy_diversity.reset_index(), uc_diversity.reset_index()]).reset_index()
+        diversities = pd.concat([
+            PerturbationSimFigure.alpha_trial_df(healthy_arrays, healthy_arrays.diversity(), "Diversity", "Healthy"),
+            PerturbationSimFigure.alpha_trial_df(uc_arrays, uc_arrays.diversity(), "Diversity", "UC")
+        ]).drop(columns="Perturbation").reset_index()
 
         # ======= Baselines
-        healthy_baseline_diversity = healthy_fwsim_df.loc[
-            healthy_fwsim_df["PerturbedFrac"] == 0.0,
-            ["SampleIdx", "SteadyState"]
-        ].groupby("SampleIdx").apply(
-            agg
-        ).mean()
-
-        uc_baseline_diversity = uc_fwsim_df.loc[
-            uc_fwsim_df["PerturbedFrac"] == 0.0,
-            ["SampleIdx", "SteadyState"]
-        ].groupby("SampleIdx").apply(
-            agg
-        ).mean()
-
-        return diversities, healthy_baseline_diversity, uc_baseline_diversity
+        return diversities, healthy_arrays.baseline_diversity(), uc_arrays.baseline_diversity()
 
     def plot_deviations(
         self,
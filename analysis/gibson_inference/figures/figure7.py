@@ -1,7 +1,8 @@
 #@title
+import sys
+from pathlib import Path
+
 import numpy as np
-import mdsine2 as md2
-from tqdm.notebook import tqdm
 import pandas as pd
 
 import matplotlib
@@ -10,29 +11,8 @@ from matplotlib import cm, gridspec
 import matplotlib.colors as mcolors
 import seaborn as sns
 
-
-def cluster_nonmembership_df(md):
-    entries = []
-    for cluster in md.get_clustering():
-        for otu in md.taxa:
-            if otu.idx not in cluster.members:
-                entries.append({
-                    "ClusterID": cluster.id,
-                    "OTU": otu.name
-                })
-    return pd.DataFrame(entries)
-
-
-def cluster_membership_df(md):
-    entries = []
-    for cluster in md.get_clustering():
-        for oidx in cluster.members:
-            otu = md.get_taxa(oidx)
-            entries.append({
-                "ClusterOfOTU": cluster.id,
-                "OTU": otu.name
-            })
-    return pd.DataFrame(entries)
+sys.path.append(str(Path(__file__).resolve().parents[2] / 'helpers'))
+import study_matrices
 
 
 def create_cmap(tag, nan_value="red"):
@@ -45,12 +25,17 @@ class KeystonenessFigure():
     def __init__(self, dataset_name: str, mcmc_pickle_path, subjset_path, fwsim_path):
         print("Loading pickle files.")
         self.md = MdsineOutput(dataset_name, mcmc_pickle_path)
-        self.study = md2.Study.load(subjset_path)
+        self.study = study_matrices.load_study(subjset_path)
 
         print("Loading dataframe from disk.")
         self.fwsim_df = pd.read_hdf(fwsim_path, key='df', mode='r')
 
+        print("Compiling stable state array.")
+        self.otu_cluster = self.get_otu_cluster_index()
+        self.sample_idx, self.stable_states = self.get_stable_state_array()
+
         print("Compiling dataframe.")
+        self.ky_samples = self.get_ky_samples()
         self.ky_df = self.generate_keystoneness_df()
 
         print("Compiling abundance data.")
@@ -62,99 +47,83 @@ class KeystonenessFigure():
         print("Extracting baseline abundances.")
         self.day20_array = self.get_day20_abundances()
 
-    def generate_keystoneness_df(self):
+    def get_otu_cluster_index(self):
+        """The idx of the cluster of each OTU (by OTU idx)."""
+        otu_cluster = np.full(len(self.md.taxa), -1, dtype=int)
+        for cluster in self.md.get_clustering():
+            otu_cluster[list(cluster.members)] = cluster.idx
+        return otu_cluster
+
+    def get_stable_state_array(self):
+        """
+        Arrange the stable states into a (removed cluster, gibbs sample, OTU) array. Index 0 of the first axis is the
+        baseline (no cluster removed) and index i + 1 is the removal of the cluster with idx i. Entries that were not
+        simulated are NaN.
+        """
         md = self.md
         fwsim_df = self.fwsim_df
 
-        nonmembers_df = cluster_nonmembership_df(md)
-
-        baseline = fwsim_df.loc[fwsim_df["ExcludedCluster"] == "None"]
-
-        altered = fwsim_df.loc[fwsim_df["ExcludedCluster"] != "None"]
-        altered = altered.merge(
-            right=nonmembers_df,
-            how="inner",
-            left_on=["ExcludedCluster", "OTU"],
-            right_on=["ClusterID", "OTU"]
-        )
-
-        merged = altered.merge(
-            baseline[["OTU", "SampleIdx", "StableState"]],
-            how="left",
-            left_on=["OTU", "SampleIdx"],
-            right_on=["OTU", "SampleIdx"],
-            suffixes=["", "Base"]
-        )
-
-        merged["DiffStableState"] = np.log10(merged["StableStateBase"] + 1e5) - np.log10(merged["StableState"] + 1e5)
+        removed_index = {"None": 0}
+        removed_index.update({cluster.id: cluster.idx + 1 for cluster in md.get_clustering()})
+        otu_index = {otu.name: otu.idx for otu in md.taxa}
+
+        removed = fwsim_df["ExcludedCluster"].map(removed_index).to_numpy()
+        otus = fwsim_df["OTU"].map(otu_index).to_numpy()
+        rows = ~(pd.isnull(removed) | pd.isnull(otus))
+        sample_idx, gibbs = np.unique(fwsim_df["SampleIdx"].to_numpy()[rows], return_inverse=True)
+
+        stable_states = np.full((len(removed_index), len(sample_idx), len(md.taxa)), np.nan)
+        stable_states[
+            removed[rows].astype(int), gibbs, otus[rows].astype(int)
+        ] = fwsim_df["StableState"].to_numpy()[rows]
+        return sample_idx, stable_states
+
+    def get_ky_samples(self):
+        """
+        Keystoneness of each cluster in each gibbs sample: the difference from the baseline of the (log) stable states
+        of the OTUs that are not in the removed cluster, averaged over the OTUs. NaN where not simulated.
+        """
+        baseline = self.stable_states[0]
+        altered = self.stable_states[1:]
+
+        diff = np.log10(baseline + 1e5) - np.log10(altered + 1e5)
+        nonmember = self.otu_cluster[None, :] != np.arange(altered.shape[0])[:, None]
+        simulated = nonmember[:, None, :] & ~np.isnan(altered)
+        with np.errstate(invalid="ignore"):
+            ky = np.nansum(np.where(simulated, diff, np.nan), axis=2) / np.sum(simulated & ~np.isnan(diff), axis=2)
+        ky[~simulated.any(axis=2)] = np.nan
+        return ky
 
-        return merged[
-            ["ExcludedCluster", "SampleIdx", "DiffStableState"]
-        ].groupby(
-            ["ExcludedCluster", "SampleIdx"]
-        ).mean().rename(columns={"DiffStableState": "Ky"})
+    def generate_keystoneness_df(self):
+        cluster_ids = np.array([cluster.id for cluster in self.md.get_clustering()])
+        removed, gibbs = np.nonzero(~np.isnan(self.ky_samples))
+        return pd.DataFrame({
+            "ExcludedCluster": cluster_ids[removed],
+            "SampleIdx": self.sample_idx[gibbs],
+            "Ky": self.ky_samples[removed, gibbs]
+        }).set_index(["ExcludedCluster", "SampleIdx"]).sort_index()
 
     def get_abundance_array(self):
-        md = self.md
-        fwsim_df = self.fwsim_df
-
-        clustering = md.get_clustering()
-        membership_df = cluster_membership_df(md)
-        merged_df = fwsim_df.merge(
-            membership_df,
-            how="left",
-            left_on="OTU",
-            right_on="OTU"
-        )
-
-        abund_array = np.zeros(shape=(len(clustering) + 1, len(clustering)))
-
-        # Baseline abundances (no cluster removed) -- sum across OTUs (per sample), median across samples.
-        subset_df = merged_df.loc[merged_df["ExcludedCluster"] == "None"]
-        subset_df = subset_df[
-            ["ClusterOfOTU", "SampleIdx", "StableState"]
-        ].groupby(
-            ["ClusterOfOTU", "SampleIdx"]
-        ).sum(
-            # Aggregate over OTUs  (e.g. Baseline abundance of a cluster is the sum of its constituents.)
-        ).groupby(
-            level=0
-        ).median(
-            # Aggregate over samples
-        )
-        for cluster in clustering:
-            abund_array[0, cluster.idx] = subset_df.loc[cluster.id]
-
-        # Altered abundances (remove 1 cluster at a time)
-        for removed_cluster in tqdm(clustering, total=len(clustering), desc="Heatmap Abundances"):
-            subset_df = merged_df.loc[merged_df["ExcludedCluster"] == removed_cluster.id]
-
-            # Compute the total abundance (over OTUs) for each cluster, for each sample. Then aggregate (median) across samples.
-            subset_df = subset_df[
-                ["ClusterOfOTU", "SampleIdx", "StableState"]
-            ].groupby(
-                ["ClusterOfOTU", "SampleIdx"]
-            ).sum(
-                # Aggregate over OTUs
-            ).groupby(
-                level=0
-            ).median(
-                # Aggregate over samples
-            )
-
-            for cluster in clustering:
-                abund_array[removed_cluster.idx + 1, cluster.idx] = subset_df.loc[cluster.id]
-        return abund_array
+        n_clusters = len(self.md.get_clustering())
+        members = np.zeros((len(self.otu_cluster), n_clusters))
+        assigned = self.otu_cluster >= 0
+        members[np.nonzero(assigned)[0], self.otu_cluster[assigned]] = 1
+
+        # Total abundance of each cluster (sum over its OTUs) for each removed cluster and sample, then the median
+        # across the samples. Row 0 is the baseline (no cluster removed), row i + 1 is the removal of cluster i.
+        stable_states = self.stable_states
+        cluster_abundances = np.nan_to_num(stable_states) @ members
+        simulated = (~np.isnan(stable_states)).astype(float) @ members > 0
+        cluster_abundances[~simulated] = np.nan
+        return np.nanmedian(cluster_abundances, axis=1)
 
     def get_ky_array(self):
-        # Group by Cluster, aggregate (mean/median) across samples.
-        agg_ky_df = self.ky_df.groupby(level=0).median()
-        return np.array(
-            [agg_ky_df.loc[cluster.id, "Ky"] for cluster in self.md.get_clustering()]
-        )
+        # Aggregate (median) across samples.
+        return np.nanmedian(self.ky_samples, axis=1)
 
     def get_day20_abundances(self):
-        M = self.study.matrix(dtype='abs', agg='mean', times='intersection', qpcr_unnormalize=True)
+        M = study_matrices.study_matrices(self.study).matrix(dtype='abs', agg='mean', times='intersection',
+                                                             qpcr_unnormalize=True)
         day20_state = M[:, 19]
         cluster_day20_abundances = np.zeros(len(self.md.get_clustering()))
 
@@ -0,0 +1,16 @@
+#!/bin/bash
+
+set -e
+source gibson_inference/settings.sh
+
+# Render all of the main and supplemental figures (the ones of the other make_*.sh
+# scripts) in one pool of worker processes. Only the figures whose script,
+# arguments or inputs changed since they were last made are rendered again. Set
+# PIPELINE_FORCE=1 to render all of them, or pass the names of the figures to
+# render with --only (e.g. --only figure2 supplemental-figure1).
+MAX_WORKERS="4"
+
+python helpers/build_figures.py \
+    --cache-dir "${PIPELINE_CACHE_DIR}" \
+    --max-workers $MAX_WORKERS \
+    "$@"
@@ -14,10 +14,10 @@ source gibson_inference/settings.sh
 #tar -xzvf "other_files.tgz"
 
 python gibson_inference/figures/figure3.py \
-    --mdsine_path "output/gibson/forward_sim/"\
-    --clv_elas_path "output/gibson/zenodo/clv_results/results_rel_elastic/"\
-    --clv_ridge_path "output/gibson/zenodo/clv_results/results_rel_ridge/"\
-    --glv_elas_path "output/gibson/zenodo/clv_results/results_abs_elastic/"\
-    --glv_ridge_path "output/gibson/zenodo/clv_results/results_abs_ridge/forward_sims_abs_ridge/"\
+    --mdsine_path "output/gibson/forward_sim/" \
+    --clv_elas_path "output/gibson/zenodo/clv_results/results_rel_elastic/" \
+    --clv_ridge_path "output/gibson/zenodo/clv_results/results_rel_ridge/" \
+    --glv_elas_path "output/gibson/zenodo/clv_results/results_abs_elastic/" \
+    --glv_ridge_path "output/gibson/zenodo/clv_results/results_abs_ridge/forward_sims_abs_ridge/" \
     --output_path "${PLOTS_OUT_DIR}/"
 
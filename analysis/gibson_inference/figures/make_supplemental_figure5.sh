@@ -7,5 +7,7 @@ source gibson_inference/settings.sh
 python gibson_inference/figures/supplemental_figure5.py \
     -loc1 "${MDSINE_FIXED_CLUSTER_OUT_DIR}/healthy/mcmc.pkl" \
     -loc2 "${MDSINE_FIXED_CLUSTER_OUT_DIR}/uc/mcmc.pkl" \
+    -ploc1 "${MDSINE_OUT_DIR}/healthy-seed0/mcmc.pkl" \
+    -ploc2 "${MDSINE_OUT_DIR}/uc-seed0/mcmc.pkl" \
     -o_loc "${PLOTS_OUT_DIR}"
 
@@ -6,7 +6,6 @@ python supplemental_figure4.py -file1 "../../processed_data/gibson_healthy_agg_t
 
 import mdsine2 as md2
 
-import matplotlib.pyplot as plt
 import matplotlib.lines as mlines
 import matplotlib.colors as mcolors
 import matplotlib.patches as patches
@@ -15,37 +14,24 @@ from matplotlib.gridspec import GridSpec
 from matplotlib.patches import Rectangle
 from matplotlib.collections import PatchCollection
 
-import seaborn as sns
 
 import numpy as np
 import pickle
 import os
 
-from scipy.stats import mannwhitneyu
-from statsmodels.stats.multitest import multipletests, fdrcorrection
-import skbio
-import skbio.diversity
-import skbio.stats.distance
-import skbio.diversity
 #import pylab as pl
 import argparse
-from matplotlib import rcParams
-from matplotlib import font_manager
+import sys
+from pathlib import Path
 
-rcParams['pdf.fonttype'] = 42
-
-font_dirs = ['gibson_inference/figures/arial_fonts']
-font_files = font_manager.findSystemFonts(fontpaths=font_dirs)
-#print(font_files)
-
-for font_file in font_files:
-    #print(font_file)
-    ff = font_file.split("/")[-1]
-    if "._" not in ff:
-        font_manager.fontManager.addfont(font_file)
-
-# change font
-rcParams['font.family'] = 'Arial'
+sys.path.append(str(Path(__file__).resolve().parents[2] / 'helpers'))
+import diversity
+import study_matrices
+import plot_setup
+plt = plot_setup.lazy_import('matplotlib.pyplot')
+sns = plot_setup.lazy_import('seaborn')
+stats = plot_setup.lazy_import('scipy.stats')
+multitest = plot_setup.lazy_import('statsmodels.stats.multitest')
 
 
 HEALTHY_SUBJECTS = ['2','3','4','5']
@@ -148,24 +134,10 @@ def _set_type_of_point_bc(t, subj, subjset):
     else:
         return 6
 
-def unbias_var_estimate(vals):
-    '''
-       @parameters
-       -----------------------------------------------------------------------
-       vals : (list[float])
-
-       @returns
-       (float) Unbiased variance estimate of the values in vals
-    '''
-
-    vals = np.asarray(vals)
-    mean = np.mean(vals)
-    a = np.sum((vals - mean)**2)
-    return a / (len(vals)-1)
-
 def compute_alpha_diversity_time(subjset):
     """
-       computes the alpha diversity over time for each subject
+       computes the alpha diversity (normalized entropy) over time for each
+       subject
 
        @parameters
        -----------------------------------------------------------------------
@@ -173,49 +145,39 @@ def compute_alpha_diversity_time(subjset):
 
        @returns
        -----------------------------------------------------------------------
-       (dict (float) -> [float])
+       (pd.DataFrame) alpha diversity values (time x subject)
     """
 
-    div_values = {}
-    for subj in subjset:
-        for t in subj.times:
-            val = md2.diversity.alpha.normalized_entropy(subj.reads[t])
-            if t not in div_values:
-                div_values[t] = []
-            div_values[t].append(val)
-
-    return div_values
+    table = diversity.alpha_diversity_table(subjset)
+    return table.pivot(index = "time", columns = "subject",
+        values = "normalized_entropy")
 
-def compute_mean_std(alpha_values_d, time_li):
+def compute_mean_std(alpha_values_df, time_li):
 
     """
        @parameters
        -----------------------------------------------------------------------
-       alpha_values_d : (dict (float) -> [float]) alpha diversity values for
-                        each subject at each time
+       alpha_values_df : (pd.DataFrame) alpha diversity values for each
+                        subject at each time (time x subject)
        time_li : ([time]) times at which samples are collected
 
        @returns
        -----------------------------------------------------------------------
-       (lists of floats) : Mean and Standard deviation in alpha_values_d
+       (lists of floats) : Mean and Standard deviation in alpha_values_df
     """
 
-    mean_li = []
-    std_li = []
-    for i, t in enumerate(time_li):
-        mean_li.append(np.mean(alpha_values_d[t]))
-        std_li.append(np.sqrt(unbias_var_estimate(alpha_values_d[t])))
-
-    return np.asarray(mean_li), np.asarray(std_li)
+    values = alpha_values_df.loc[time_li]
+    return values.mean(axis = 1).to_numpy(), values.std(axis = 1,
+        ddof = 1).to_numpy()
 
-def compute_p_alpha_diversity(alpha_healthy_d, alpha_uc_d, time_li):
+def compute_p_alpha_diversity(alpha_healthy_df, alpha_uc_df, time_li):
     """
        computes the p-values using Mann Whitney test
 
        @parameters
        -----------------------------------------------------------------------
-       alpha_healthy_d : (dict (float) -> [float])
-       alpha_uc_d : (dict (float) -> [float])
+       alpha_healthy_df : (pd.DataFrame) (time x subject)
+       alpha_uc_df : (pd.DataFrame) (time x subject)
        time_li : ([float])
 
        @returns
@@ -224,13 +186,12 @@ def compute_p_alpha_diversity(alpha_healthy_d, alpha_uc_d, time_li):
        results and the adjusted p-values)
     """
 
-    p_vals = []
-    for t in time_li:
-        test_res = mannwhitneyu(alpha_healthy_d[t], alpha_uc_d[t],
-                   use_continuity = False)
-        p_vals.append(test_res[1])
+    # one test per time
+    p_vals = stats.mannwhitneyu(alpha_healthy_df.loc[time_li].to_numpy(),
+        alpha_uc_df.loc[time_li].to_numpy(), use_continuity = False, axis = 1,
+        nan_policy = "omit")[1]
 
-    hypothesis_test_result = multipletests(p_vals, alpha = 0.05,
+    hypothesis_test_result = multitest.multipletests(p_vals, alpha = 0.05,
     method = "fdr_bh", is_sorted = False)
 
     df = pd.DataFrame(np.vstack((p_vals, hypothesis_test_result[1])).T)
@@ -300,17 +261,16 @@ def alpha_diversity_mean_std(subjset_healthy, subjset_uc, subjset_innoc, name,
 
     alpha_healthy = compute_alpha_diversity_time(subjset_healthy)
     alpha_uc = compute_alpha_diversity_time(subjset_uc)
-    alpha_innoc_healthy = md2.diversity.alpha.normalized_entropy(
-         subjset_innoc['Healthy'].reads[0])
-    alpha_innoc_uc = md2.diversity.alpha.normalized_entropy(
-             subjset_innoc['Ulcerative Colitis'].reads[0])
+    alpha_innoc = compute_alpha_diversity_time(subjset_innoc)
+    alpha_innoc_healthy = alpha_innoc.loc[0, 'Healthy']
+    alpha_innoc_uc = alpha_innoc.loc[0, 'Ulcerative Colitis']
     subj_ = ""
     for subj in subjset_healthy:
         subj_ = subj
         break
     name_ = subj_.name
 
-    times = np.sort(list(alpha_healthy.keys()))
+    times = alpha_healthy.index.to_numpy()
     means_healthy, std_healthy = compute_mean_std(alpha_healthy, times)
     means_uc, std_uc = compute_mean_std(alpha_uc, times)
 
@@ -443,23 +403,47 @@ def reformat_data(subjset):
         sample labels id ((dict (float) -> (str, float)))
     """
 
-    data = None
+    data, samples = diversity.sample_matrix(subjset)
     labels = []
     labels_float = {}
-    for subj in subjset:
-        for t in subj.times:
-            ts = str(float(t)).replace('.5', 'PM').replace('.0', 'AM')
-            labels.append('{}-{}'.format(subj.name, ts))
-            labels_float[labels[-1]] = (subj, t)
-        d = subj.matrix()["raw"].T
-        if data is None:
-            data = d
-        else:
-            data = np.vstack((data, d))
+    for subj, t in samples:
+        ts = str(float(t)).replace('.5', 'PM').replace('.0', 'AM')
+        labels.append('{}-{}'.format(subj.name, ts))
+        labels_float[labels[-1]] = (subj, t)
 
     #print(labels_float)
     return data, labels, labels_float
 
+def compute_beta_diversity(subjset_healthy, subjset_uc, subjset_innoc):
+
+    """
+       computes the Bray-Curtis dissimilarities between all of the samples of
+       the healthy and UC subjects and the inoculum
+
+       @parameters
+       -----------------------------------------------------------------------
+       subjset_heallthy, subjset_uc : ([pylab.subject]) data pertaining to
+                                       healthy / uc subjsets
+       subjset_innoc : ([pylab.subject]) data at the time of inoculum
+
+       @returns
+       -----------------------------------------------------------------------
+       dissimilarities (diversity.BetaDiversity), sample labels id
+       ((dict (str) -> (pl.base.Subject, float)))
+    """
+
+    subset_ = list(subjset_healthy) + list(subjset_uc)
+    data, labels, labels_float = reformat_data(subset_)
+    beta = diversity.BetaDiversity(data, labels)
+
+    data_innoc, samples_innoc = diversity.sample_matrix(subjset_innoc)
+    labels_innoc = ['inoculum {}'.format(subj.name) for subj, _ in samples_innoc]
+    for label in labels_innoc:
+        labels_float[label] = 1000
+    beta.add_samples(data_innoc, labels_innoc)
+
+    return beta, labels_float
+
 def combine_dicts(dict1, dict2):
 
     """
@@ -477,7 +461,7 @@ def combine_dicts(dict1, dict2):
 
 def beta_diversity_figure(subjset_healthy, subjset_uc, subjset_innoc, name = None,
     axleft = None, axright = None, axcenter = None, figlabel = None,
-    save = False):
+    save = False, beta = None, labels_float = None):
 
     """
        Plots the first two dimensions of the beta diversity
@@ -491,6 +475,8 @@ def beta_diversity_figure(subjset_healthy, subjset_uc, subjset_innoc, name = Non
        ax, axleft, axright, axcenter : (matplotlib.Axes)
        save : (bool) save figure or not
        figlabel : (str) figure label
+       beta, labels_float : the output of compute_beta_diversity. If None, it
+                            is computed
 
        @returns
        -----------------------------------------------------------------------
@@ -499,22 +485,12 @@ def beta_diversity_figure(subjset_healthy, subjset_uc, subjset_innoc, name = Non
 
     print("Plotting Beta Diversity")
 
-    subset_ = []
-    for sub in subjset_healthy:
-        subset_.append(sub)
-    for sub in subjset_uc:
-        subset_.append(sub)
-    data, labels, labels_float = reformat_data(subset_)
-
-    for subj in subjset_innoc:
-        labels.append('inoculum {}'.format(subj.name))
-        labels_float[labels[-1]] = 1000
-        m = subj.matrix()['raw'].T
-        data = np.vstack((data, m))
+    if beta is None:
+        beta, labels_float = compute_beta_diversity(subjset_healthy, subjset_uc,
+            subjset_innoc)
+    labels = beta.ids
 
-    bc_dm = skbio.diversity.beta_diversity("braycurtis", data, labels)
-
-    bc_pcoa = skbio.stats.ordination.pcoa(bc_dm)
+    bc_pcoa = beta.pcoa()
     #print(bc_pcoa)
 
     data = bc_pcoa.samples.to_numpy()
@@ -719,39 +695,7 @@ def beta_diversity_figure(subjset_healthy, subjset_uc, subjset_innoc, name = Non
     plt.close()
 
 
-def get_reads(subjset, type_):
-
-    """
-       gets read counts, groups and label names associated with each samples
-
-       @Parameters
-       -----------------------------------------------------------------------
-       subjset : (pl.base.Subject)
-       type_ : (str) healthy or UC cohort
-
-       @returns
-       -----------------------------------------------------------------------
-       read at each samples (numpy), label names (list), cohort names (list)
-    """
-    data = None
-    labels = []
-    cohort = []
-    for subj in subjset:
-        for t in subj.times:
-            ts = str(float(t)).replace('.5', 'PM').replace('.0', 'AM')
-            labels.append('{}-{}'.format(subj.name, ts))
-            cohort.append(type_)
-        d = subj.matrix()["raw"].T
-        if data is None:
-            data = d
-        else:
-            data = np.vstack((data, d))
-
-    #print(labels_float)
-    return data, cohort, labels
-
-
-def permanova(subjset_healthy, subjset_uc, subjset_inoc):
+def permanova(subjset_healthy, subjset_uc, subjset_inoc, beta = None):
 
     """
        runs the permanova test and prints the result
@@ -759,6 +703,8 @@ def permanova(subjset_healthy, subjset_uc, subjset_inoc):
        @Parameters
        -----------------------------------------------------------------------
        subjset_healthy, subjset_uc : (pl.base.Subject)
+       beta : (diversity.BetaDiversity) the output of compute_beta_diversity.
+              If None, it is computed
 
        @returns
        -----------------------------------------------------------------------
@@ -766,31 +712,23 @@ def permanova(subjset_healthy, subjset_uc, subjset_inoc):
 
     """
 
-    healthy_reads, healthy_group, healthy_labels = get_reads(subjset_healthy, "healthy")
-    uc_reads, uc_group, uc_labels = get_reads(subjset_uc, "uc")
-
-    reads = np.vstack((healthy_reads, uc_reads))
-
-    grouping = healthy_group + uc_group
-    labels = healthy_labels + uc_labels
+    if beta is None:
+        beta, _ = compute_beta_diversity(subjset_healthy, subjset_uc, subjset_inoc)
 
+    grouping = ["healthy"] * sum(len(subj.times) for subj in subjset_healthy) + \
+        ["uc"] * sum(len(subj.times) for subj in subjset_uc)
     for subj in subjset_inoc:
-        labels.append('inoculum {}'.format(subj.name))
         if subj.name == "Healthy":
-            grouping.append("healthy")
+            grouping += ["healthy"] * len(subj.times)
         else:
-            grouping.append("uc")
-        m = subj.matrix()['raw'].T
-        reads = np.vstack((reads, m))
-
-    bc_dm = skbio.diversity.beta_diversity(counts = reads, ids = labels ,
-    metric="braycurtis")
+            grouping += ["uc"] * len(subj.times)
 
-    test_result = skbio.stats.distance.permanova(distance_matrix = bc_dm, grouping = grouping)
+    test_result = beta.permanova(grouping)
     print("Permanova Test Result")
     print(test_result)
 
-def diversity_plot(subjset_healthy, subjset_uc, subjset_innoc, loc, name = None):
+def diversity_plot(subjset_healthy, subjset_uc, subjset_innoc, loc, name = None,
+    beta = None, labels_float = None):
 
     """
        plots the alpha and beta diversity together
@@ -799,6 +737,8 @@ def diversity_plot(subjset_healthy, subjset_uc, subjset_innoc, loc, name = None)
        subjset_heallthy, subjset_uc : ([pylab.subject]) data pertaining to
                                        healthy / uc subjsets
        subjset_innoc : ([pylab.subject]) data at the time of inoculum
+       beta, labels_float : the output of compute_beta_diversity. If None, it
+                            is computed
     """
 
     fig = plt.figure(figsize = (15, 15))
@@ -811,7 +751,8 @@ def diversity_plot(subjset_healthy, subjset_uc, subjset_innoc, loc, name = None)
     #ax5 = fig.add_subplot(spec[0, 0 : 2])
 
     beta_diversity_figure(subjset_healthy, subjset_uc, subjset_innoc,
-    name = name, axleft = ax4, axright = ax3, axcenter = ax2)
+    name = name, axleft = ax4, axright = ax3, axcenter = ax2, beta = beta,
+    labels_float = labels_float)
     alpha_diversity_mean_std(subjset_healthy, subjset_uc, subjset_innoc,
     name = name, ax = ax1, axlegend = ax1)
 
@@ -850,15 +791,21 @@ def loaddata(healthy):
 
 def main():
 
+    plot_setup.use_arial_fonts()
     print("Making Supplemental Figure 1")
     args = parse_args()
-    subjset_healthy = md2.Study.load(args.healthy_pkl)
-    subjset_uc = md2.Study.load(args.uc_pkl)
-    subjset_inoc = md2.Study.load(args.inoc_pkl)
+    subjset_healthy = study_matrices.load_study(args.healthy_pkl)
+    subjset_uc = study_matrices.load_study(args.uc_pkl)
+    subjset_inoc = study_matrices.load_study(args.inoc_pkl)
     output_loc = args.output_loc
 
-    diversity_plot(subjset_healthy, subjset_uc, subjset_inoc, output_loc)
-    permanova(subjset_healthy, subjset_uc, subjset_inoc)
+    # The dissimilarities are computed once for the PCoA and the PERMANOVA
+    beta, labels_float = compute_beta_diversity(subjset_healthy, subjset_uc,
+        subjset_inoc)
+    diversity_plot(subjset_healthy, subjset_uc, subjset_inoc, output_loc,
+        beta = beta, labels_float = labels_float)
+    permanova(subjset_healthy, subjset_uc, subjset_inoc, beta = beta)
     print("Done Making Supplemental Figure 1")
 
-main()
+if __name__ == "__main__":
+    main()
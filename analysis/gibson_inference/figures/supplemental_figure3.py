@@ -1,44 +1,15 @@
 import numpy as np
-import matplotlib.pyplot as plt
 import mdsine2 as md2
 import argparse
 import os
-from matplotlib import rcParams
-from matplotlib import font_manager
-
-rcParams['pdf.fonttype'] = 42
-
-font_dirs = ['gibson_inference/figures/arial_fonts']
-font_files = font_manager.findSystemFonts(fontpaths=font_dirs)
-#print(font_files)
-
-for font_file in font_files:
-    #print(font_file)
-    ff = font_file.split("/")[-1]
-    if "._" not in ff:
-        font_manager.fontManager.addfont(font_file)
-
-# change font
-rcParams['font.family'] = 'Arial'
-
-
-def filter(study, dtype, threshold, min_num_consecutive, min_num_subjects,
-	colonization_time, max_n_otus=None):
-
-    study = md2.consistency_filtering(subjset=study, dtype=dtype,
-        threshold=threshold, min_num_consecutive=min_num_consecutive,
-        min_num_subjects=min_num_subjects, colonization_time=colonization_time)
-    if max_n_otus is not None:
-        n = args.max_n_otus
-        if n <= 0:
-            raise ValueError('`max_n_otus` ({}) must be > 0'.format(n))
-        to_delete = []
-        for taxon in study.taxa:
-            if taxon.idx >= n:
-                to_delete.append(taxon.name)
-        study.pop_taxa(to_delete)
-    #print('{} taxa left in {}, n_days = {}'.format(len(study.taxa), study.name))
-    return len(study.taxa)
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[2] / 'helpers'))
+import filter_sweep
+import plot_setup
+plt = plot_setup.lazy_import('matplotlib.pyplot')
+
 
 def run_and_save_filtering_results(study_healthy, study_uc, loc):
     fig = plt.figure(figsize=(15, 20))
@@ -74,6 +45,13 @@ def make_plot(axes_set, study, start, title_li):
     used_keys = []
     col_time=5
     i = 1
+
+    # Number of taxa left after the consistency filtering for every
+    # (threshold, consecutive days, number of subjects)
+    sweep = filter_sweep.ConsistencySweep(study, dtype="rel")
+    n_taxa_grid = sweep.n_taxa_remaining(threshold_values[1:], days,
+        np.arange(1, n_subjects + 1), colonization_time=col_time)
+
     study_name = "Healthy"
     if study.name != "healthy":
         study_name = "Dysbiotic"
@@ -94,10 +72,10 @@ def make_plot(axes_set, study, start, title_li):
         axes.set_title(title_li[i-1], fontweight="bold", fontsize=18, loc="left")
         axes.ticklabel_format(axis="x", style="sci")
         used_n = 0
-        for d in days:
+        for di, d in enumerate(days):
             results_n = [np.nan]
-            for t in threshold_values[1:]:
-                n_taxa = filter(study, "rel", t, d, i, col_time)
+            for ti, t in enumerate(threshold_values[1:]):
+                n_taxa = n_taxa_grid[ti, di, i - 1]
                 max_n = max(n_taxa, max_n)
                 min_n = min(n_taxa, min_n)
                 results_n.append(n_taxa)
@@ -143,6 +121,7 @@ def parse_args():
 
 if __name__ =="__main__":
 
+    plot_setup.use_arial_fonts()
     print("Making Supplemental Figure 3")
     args = parse_args()
 
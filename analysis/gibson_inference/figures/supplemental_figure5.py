@@ -1,190 +1,29 @@
 import numpy as np
 import pandas as pd
-import copy
-from scipy.special import comb
-from scipy.stats import hypergeom
-from statsmodels.stats import multitest as mtest
-import matplotlib.pyplot as plt
-import seaborn as sns
 import matplotlib.colors as colors
 from matplotlib.colors import LogNorm
 import os
 import pickle
 import mdsine2 as md2
 import math
-from mdsine2.names import STRNAMES
 from matplotlib.gridspec import GridSpec
 from pandas.plotting import table
 from matplotlib.colors import ListedColormap
 import argparse
+import sys
+from pathlib import Path
 #import pylab as pl
 
-from matplotlib import rcParams
-from matplotlib import font_manager
-
-rcParams['pdf.fonttype'] = 42
-
-font_dirs = ['gibson_inference/figures/arial_fonts']
-font_files = font_manager.findSystemFonts(fontpaths=font_dirs)
-#print(font_files)
-
-for font_file in font_files:
-    #print(font_file)
-    ff = font_file.split("/")[-1]
-    if "._" not in ff:
-        font_manager.fontManager.addfont(font_file)
-
-# change font
-rcParams['font.family'] = 'Arial'
-
-def compute_p_value(N, M, n, k):
-    '''computes and returns the hypergeometric p-values
-       @Parameters
-       ------------------------------------------------------------------
-       N, M, n, k: (int)
-
-       @returns
-        ------------------------------------------------------------------------
-       float
-    '''
-    lim = min(n, M)
-    p = 0
-    for i in range(k, lim + 1):
-        p += comb(M, i) * comb(N - M, n - i) / comb(N, n)
-
-    p1 = hypergeom.sf(k-1, N, M, n) #to check the accuracy of p
-
-    return p
-
-def obtain_p_vals(cluster_dict, hierarchy_otu_dict):
-    total_otus = sum([len(cluster_dict[id_]) for id_ in cluster_dict])
-
-    cluster_all_p ={}
-    cluster_all_level = {}
-    for id_ in sorted(cluster_dict.keys()):
-        #print("id:", id_)
-        otus_li = cluster_dict[id_]
-        cluster_all_p[id_] = []
-        cluster_all_level[id_] = []
-        n_otus_cluster = len(otus_li)
-
-        for level in hierarchy_otu_dict:
-            level_li = hierarchy_otu_dict[level]
-            n_otus_annotated = len(level_li)
-            n_otus_annotated_cluster = len(set(otus_li).intersection(level_li))
-            if n_otus_annotated_cluster != 0 :
-                p_val = compute_p_value(total_otus, n_otus_annotated,
-                    n_otus_cluster, n_otus_annotated_cluster)
-                cluster_all_p[id_].append(p_val)
-                cluster_all_level[id_].append(level)
-
-    return cluster_all_p, cluster_all_level
-
-def clusterize(labels, taxa_list):
-    """returns the consenus cluster as a dictionary ((int) cluster_id ->
-    ([str]) ids of OTUs belonging to the cluster)
-
-    @parameters
-    labels : ([int]) the consensus cluster id of OTUs in taxa_list
-    taxa_list : ([str]) ids of OTU
-    """
-
-    cluster = {}
-    for i in range(len(labels)):
-        if labels[i] + 1 not in cluster:
-            cluster[labels[i] + 1] = []
-        cluster[labels[i] + 1].append(taxa_list[i])
-
-    return cluster
-
-def map_level_to_otu(taxas_info, level):
-    map_ = {}
-    for taxa in taxas_info:
-        key = taxa.taxonomy[level]
-        if key not in map_:
-            map_[key] = []
-        name = taxa.name
-        map_[key].append(name)
-
-    return map_
-
-def parse_cluster(mcmc):
-
-    clustering = mcmc.graph[STRNAMES.CLUSTERING].clustering
-    consensus_cluster_labels = clustering.toarray()
-    taxa_list = []
-    taxas = mcmc.graph.data.taxa
-    for taxa in taxas:
-        taxa_list.append(taxa.name)
-
-    cluster = clusterize(consensus_cluster_labels, taxa_list)
-    #export_cluster(cluster, taxa_list, study_obj.taxa, name)
-    return cluster
-
-def pivot_df(p_li, p_info, adjusted_p_li, adjusted_p_res_li, name):
-
-    cluster_row = []
-    hierarchy_names = []
-    values = []
-    enriched = []
-
-    for i in range(len(p_li)):
-        if adjusted_p_res_li[i] == True:
-            cluster_row.append(" ".join(p_info[i].split()[:2]))
-            hierarchy_names.append(p_info[i].split()[-1])
-            values.append(adjusted_p_li[i])
-            enriched.append(adjusted_p_res_li[i])
-
-    data_frame = pd.DataFrame({"cluster_id":cluster_row,
-            "module_name":hierarchy_names, "p_value":values})
-    df_pivot = data_frame.pivot(values="p_value", index="module_name",
-                columns="cluster_id")
-    df_pivot = df_pivot.fillna(1)
-
-    #df_pivot.to_csv(name + ".csv", sep=",")
-    return df_pivot
 
-def run_enrichment(mcmc, hierarchy_level, pivot_name):
-
-    cluster_dict = parse_cluster(mcmc)
-    taxas = mcmc.graph.data.taxa
-    level_otu_map = map_level_to_otu(taxas, hierarchy_level)
-
-    p_values, p_module_info = obtain_p_vals(cluster_dict, level_otu_map)
-
-    all_p_li = []
-    all_p_info_li = []
-
-    for keys in sorted(p_values.keys()):
-        all_p_li = all_p_li + p_values[keys]
-        modules_cluster = []
-        for key2 in p_module_info[keys]:
-            modules_cluster.append("Cluster " + str(keys) + " " + key2)
-        all_p_info_li = all_p_info_li + modules_cluster
-
-    adjusted_p = []
+sys.path.append(str(Path(__file__).resolve().parents[2] / 'helpers'))
+import enrichment as enrich
+import plot_setup
+plt = plot_setup.lazy_import('matplotlib.pyplot')
+sns = plot_setup.lazy_import('seaborn')
 
-    if len(all_p_li) != 0:
-        adjusted_p = mtest.multipletests(copy.deepcopy(all_p_li), alpha=0.05,
-            method="fdr_bh", is_sorted=False)
-    else:
-        print("There are no valid p values ")
-
-    pivoted_df = pivot_df(all_p_li, all_p_info_li, adjusted_p[1], adjusted_p[0],
-        pivot_name)
-
-    df_copy = copy.deepcopy(pivoted_df)
-    index = np.sort([int(idx.split()[1]) for idx in df_copy.columns])
-    index = ["Cluster " + str(i) for i in index]
-    df_save = df_copy[index]
-    #export_df(cluster_dict, level_otu_map, all_p_li, all_p_info_li,
-        #adjusted_p[1], pivot_name)
 
-    #loc = "gibson_inference/figures/output_figures/p_supplemental_figure5_"
-    #os.makedirs("{}".format(loc), exist_ok=True)
-    #df_save.to_csv("{}/p_test_{}.csv".format(loc, pivot_name), sep=",")
-
-    return pivoted_df
+def run_enrichment(mcmc, hierarchy_level, pivot_name):
+    return enrich.enrichment_p_values(mcmc, hierarchy_level)
 
 def export_df(cluster_info, level_otu_dict, raw_p, p_info, adj_p, savename):
 
@@ -231,32 +70,6 @@ def export_df(cluster_info, level_otu_dict, raw_p, p_info, adj_p, savename):
     df_combined.to_csv("{}/combined_p_{}.csv".format(loc, savename), sep=",")
 
 
-def pivot_cluster_membership(mcmc, level):
-
-    taxas = mcmc.graph.data.taxa
-    level_otu_map = map_level_to_otu(taxas, level)
-    cluster_dict = parse_cluster(mcmc)
-
-    data = []
-    index = []
-    for level in sorted(level_otu_map.keys()):
-        name_li = level.split("_")
-        if len(name_li) != 1:
-            name_li = name_li[:-1]
-        new_name = " ".join(name_li)
-
-        index.append(new_name)
-        level_info_row = []
-        for id_ in sorted(cluster_dict.keys()):
-            level_info_row.append(len(set(cluster_dict[id_]).intersection(
-                level_otu_map[level])))
-        data.append(level_info_row)
-
-    columns = ["{}".format(i) for i in range(1, len(cluster_dict) +1)]
-    df = pd.DataFrame(np.asarray(data), index=index, columns=columns)
-
-    return df
-
 def plot_module(cohort, df, axes, title, ylab, plot_cbar=False, cbar_ax=None, vmax=0.5,
     vmin=0.0005, label_x=False, label_x_gram=False, labels_gram_stain=None,
     tick_right=False):
@@ -494,21 +307,6 @@ def make_plot(df_healthy_p_order, df_uc_p_order, df_healthy_p_family,
     fig.savefig(loc + "/supplemental_figure5.pdf", bbox_inches="tight")
 
 
-def format_df(df, n_cluster):
-    columns = df.columns
-    shape = df.shape
-
-    missing = [1] * shape[0]
-    for i in range(1, n_cluster + 1):
-        if "Cluster " + str(i) not in columns:
-            df["Cluster " + str(i)] = missing
-    sorted_cols = ["Cluster " + str(i) for i in range(1, n_cluster + 1)]
-    new_df = df[sorted_cols]
-    cols = [str(i) for i in range(1, n_cluster + 1)]
-    new_df.columns = cols
-
-    return new_df
-
 def parse_args():
 
     parser = argparse.ArgumentParser(description = "files needed for making"\
@@ -519,11 +317,34 @@ def parse_args():
        help = "a pl.BaseMCMC pkl file for UC runs")
     parser.add_argument("-o_loc", "--output_loc", required="True",
         help = "directory(folder name) where the output figure is saved")
+    parser.add_argument("-ploc1", "--healthy_posterior_mcmc_loc", default=None,
+       help = "a pl.BaseMCMC pkl file of the healthy run that learned the clustering. "\
+       "If given (with -ploc2), the posterior probabilities of enrichment of the "\
+       "modules over its Gibbs samples are saved next to the figure")
+    parser.add_argument("-ploc2", "--uc_posterior_mcmc_loc", default=None,
+       help = "a pl.BaseMCMC pkl file of the UC run that learned the clustering")
+    parser.add_argument("-n", "--n_samples", type=int, default=1000,
+        help = "number of Gibbs samples used for the posterior enrichment")
+    parser.add_argument("-w", "--n_workers", type=int, default=1,
+        help = "number of processes used for the posterior enrichment")
 
     return parser.parse_args()
 
+def save_posterior_enrichment(mcmc_posterior, mcmc, cohort, loc, n_samples, n_workers):
+    """saves the posterior probabilities of enrichment of the modules of mcmc at
+       every taxonomy rank in the figure"""
+
+    os.makedirs(loc, exist_ok=True)
+    labels = enrich.posterior_cocluster_labels(mcmc_posterior, n_samples=n_samples)
+    for level in ["phylum", "class", "order", "family"]:
+        df = enrich.posterior_enrichment_level(mcmc_posterior, level,
+            consensus_mcmc=mcmc, n_samples=n_samples, n_workers=n_workers,
+            labels=labels)
+        df.to_csv("{}/{}_{}.csv".format(loc, cohort, level), sep=",")
+
 if __name__ == "__main__":
 
+    plot_setup.use_arial_fonts()
     args = parse_args()
     print("Making Supplemental Figure 5")
 
@@ -542,29 +363,29 @@ if __name__ == "__main__":
     healthy_phylum_enrichment = run_enrichment(mcmc_healthy, "phylum", "healthy_phylum")
     uc_phylum_enrichment = run_enrichment(mcmc_uc, "phylum", "uc_phylum")
 
-    healthy_family_abundance = pivot_cluster_membership(mcmc_healthy, "family")
-    uc_family_abundance = pivot_cluster_membership(mcmc_uc, "family")
+    healthy_family_abundance = enrich.pivot_cluster_membership(mcmc_healthy, "family")
+    uc_family_abundance = enrich.pivot_cluster_membership(mcmc_uc, "family")
 
-    healthy_order_abundance = pivot_cluster_membership(mcmc_healthy, "order")
-    uc_order_abundance = pivot_cluster_membership(mcmc_uc, "order")
+    healthy_order_abundance = enrich.pivot_cluster_membership(mcmc_healthy, "order")
+    uc_order_abundance = enrich.pivot_cluster_membership(mcmc_uc, "order")
 
-    healthy_class_abundance = pivot_cluster_membership(mcmc_healthy, "class")
-    uc_class_abundance = pivot_cluster_membership(mcmc_uc, "class")
+    healthy_class_abundance = enrich.pivot_cluster_membership(mcmc_healthy, "class")
+    uc_class_abundance = enrich.pivot_cluster_membership(mcmc_uc, "class")
 
-    healthy_phylum_abundance = pivot_cluster_membership(mcmc_healthy, "phylum")
-    uc_phylum_abundance = pivot_cluster_membership(mcmc_uc, "phylum")
+    healthy_phylum_abundance = enrich.pivot_cluster_membership(mcmc_healthy, "phylum")
+    uc_phylum_abundance = enrich.pivot_cluster_membership(mcmc_uc, "phylum")
 
     healthy_N = healthy_order_abundance.to_numpy().shape[1]
     uc_N = uc_order_abundance.to_numpy().shape[1]
 
-    healthy_order_enrichment = format_df(healthy_order_enrichment, healthy_N)
-    uc_order_enrichment=format_df(uc_order_enrichment, uc_N)
-    healthy_family_enrichment= format_df(healthy_family_enrichment, healthy_N)
-    uc_family_enrichment= format_df(uc_family_enrichment, uc_N)
-    healthy_class_enrichment= format_df(healthy_class_enrichment, healthy_N)
-    uc_class_enrichment= format_df(uc_class_enrichment, uc_N)
-    healthy_phylum_enrichment= format_df(healthy_phylum_enrichment, healthy_N)
-    uc_phylum_enrichment= format_df(uc_phylum_enrichment, uc_N)
+    healthy_order_enrichment = enrich.format_df(healthy_order_enrichment, healthy_N)
+    uc_order_enrichment=enrich.format_df(uc_order_enrichment, uc_N)
+    healthy_family_enrichment= enrich.format_df(healthy_family_enrichment, healthy_N)
+    uc_family_enrichment= enrich.format_df(uc_family_enrichment, uc_N)
+    healthy_class_enrichment= enrich.format_df(healthy_class_enrichment, healthy_N)
+    uc_class_enrichment= enrich.format_df(uc_class_enrichment, uc_N)
+    healthy_phylum_enrichment= enrich.format_df(healthy_phylum_enrichment, healthy_N)
+    uc_phylum_enrichment= enrich.format_df(uc_phylum_enrichment, uc_N)
 
     make_plot(healthy_order_enrichment,uc_order_enrichment, healthy_family_enrichment,
         uc_family_enrichment, healthy_class_enrichment, uc_class_enrichment,
@@ -573,4 +394,11 @@ if __name__ == "__main__":
         uc_family_abundance, healthy_class_abundance, uc_class_abundance,
         healthy_phylum_abundance, uc_phylum_abundance, args.output_loc)
 
+    posterior_loc = args.output_loc + "/supplemental_figure5_posterior_enrichment"
+    for cohort, loc, mcmc in [("healthy", args.healthy_posterior_mcmc_loc, mcmc_healthy),
+        ("uc", args.uc_posterior_mcmc_loc, mcmc_uc)]:
+        if loc is not None:
+            save_posterior_enrichment(md2.BaseMCMC.load(loc), mcmc, cohort,
+                posterior_loc, args.n_samples, args.n_workers)
+
     print("Done Making Supplemental Figure 5")
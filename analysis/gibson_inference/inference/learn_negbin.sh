@@ -6,6 +6,9 @@ source gibson_inference/settings.sh
 echo "Learning negative binomial dispersion parameters..."
 echo "Output Directory: ${NEGBIN_OUT_DIR}"
 
+stage negbin \
+    --outputs "${NEGBIN_OUT_DIR}/replicates/mcmc.pkl" \
+    -- \
 mdsine2 infer-negbin \
     --input "${PREPROCESS_DIR}/gibson_replicates_agg_taxa_filtered.pkl" \
     --seed 0 \
@@ -14,6 +17,9 @@ mdsine2 infer-negbin \
     --checkpoint 200 \
     --basepath ${NEGBIN_OUT_DIR}
 
+stage negbin-posterior \
+    --outputs "${NEGBIN_OUT_DIR}/replicates/posterior" \
+    -- \
 mdsine2 visualize-negbin \
     --chain "${NEGBIN_OUT_DIR}/replicates/mcmc.pkl" \
     --output-basepath "${NEGBIN_OUT_DIR}/replicates/posterior"
@@ -7,97 +7,46 @@ NEGBIN="${NEGBIN_OUT_DIR}/replicates/mcmc.pkl"
 BURNIN="5000"
 N_SAMPLES="15000"
 CHECKPOINT="100"
-MULTIPROCESSING="0"
 HEALTHY_DSET="${PREPROCESS_DIR}/gibson_healthy_agg_taxa_filtered.pkl"
 UC_DSET="${PREPROCESS_DIR}/gibson_uc_agg_taxa_filtered.pkl"
 INTERACTION_IND_PRIOR="strong-sparse"
 PERTURBATION_IND_PRIOR="weak-agnostic"
+CPUS_PER_CHAIN="1"
 
 echo "Running MDSINE2 model"
 echo "Writing files to ${MDSINE_OUT_DIR}"
 
-# Healthy cohort
-# --------------
-
-# Seed 0
-mdsine2 infer \
-    --input $HEALTHY_DSET \
+# The four chains (Healthy and UC cohorts, seeds 0 and 1) are independent, so they
+# run at the same time. Each chain's posterior is rendered as soon as it finishes and
+# the convergence diagnostics of each cohort are written to
+# ${MDSINE_OUT_DIR}/diagnostics once both of its seeds are done.
+# When the stage reruns, run_chains.py only reruns the chains that did not finish or
+# whose arguments changed (and the posteriors and diagnostics that depend on them).
+stage infer-all-seeds \
+    --outputs \
+        $MDSINE_OUT_DIR/healthy-seed0/mcmc.pkl \
+        $MDSINE_OUT_DIR/healthy-seed1/mcmc.pkl \
+        $MDSINE_OUT_DIR/uc-seed0/mcmc.pkl \
+        $MDSINE_OUT_DIR/uc-seed1/mcmc.pkl \
+        $MDSINE_OUT_DIR/healthy-seed0/posterior \
+        $MDSINE_OUT_DIR/healthy-seed1/posterior \
+        $MDSINE_OUT_DIR/uc-seed0/posterior \
+        $MDSINE_OUT_DIR/uc-seed1/posterior \
+        $MDSINE_OUT_DIR/diagnostics/gibson_healthy_agg_taxa_filtered/diagnostics.tsv \
+        $MDSINE_OUT_DIR/diagnostics/gibson_uc_agg_taxa_filtered/diagnostics.tsv \
+    -- \
+python helpers/run_chains.py \
+    --chain healthy-seed0 $HEALTHY_DSET 0 \
+    --chain healthy-seed1 $HEALTHY_DSET 1 \
+    --chain uc-seed0 $UC_DSET 0 \
+    --chain uc-seed1 $UC_DSET 1 \
     --negbin $NEGBIN \
-    --seed 0 \
     --burnin $BURNIN \
     --n-samples $N_SAMPLES \
     --checkpoint $CHECKPOINT \
-    --multiprocessing $MULTIPROCESSING \
-    --rename-study healthy-seed0 \
     --basepath $MDSINE_OUT_DIR \
     --interaction-ind-prior $INTERACTION_IND_PRIOR \
-    --perturbation-ind-prior $PERTURBATION_IND_PRIOR
-
-mdsine2 visualize-posterior \
-    --chain $MDSINE_OUT_DIR/healthy-seed0/mcmc.pkl \
-    --output-basepath $MDSINE_OUT_DIR/healthy-seed0/posterior
-
-echo "Finished Healthy (seed 0)."
-
-# Seed 1
-mdsine2 infer \
-    --input $HEALTHY_DSET \
-    --negbin $NEGBIN \
-    --seed 1 \
-    --burnin $BURNIN \
-    --n-samples $N_SAMPLES \
-    --checkpoint $CHECKPOINT \
-    --multiprocessing $MULTIPROCESSING \
-    --rename-study healthy-seed1 \
-    --basepath $MDSINE_OUT_DIR \
-    --interaction-ind-prior $INTERACTION_IND_PRIOR \
-    --perturbation-ind-prior $PERTURBATION_IND_PRIOR
-
-mdsine2 visualize-posterior \
-    --chain $MDSINE_OUT_DIR/healthy-seed1/mcmc.pkl \
-    --output-basepath $MDSINE_OUT_DIR/healthy-seed1/posterior
-
-echo "Finished Healthy (seed 1)."
-
-# ---------
-# UC cohort
-# ---------
-# Seed 0
-mdsine2 infer \
-    --input $UC_DSET \
-    --negbin $NEGBIN \
-    --seed 0 \
-    --burnin $BURNIN \
-    --n-samples $N_SAMPLES \
-    --checkpoint $CHECKPOINT \
-    --multiprocessing $MULTIPROCESSING \
-    --rename-study uc-seed0 \
-    --basepath $MDSINE_OUT_DIR \
-    --interaction-ind-prior $INTERACTION_IND_PRIOR \
-    --perturbation-ind-prior $PERTURBATION_IND_PRIOR
-
-mdsine2 visualize-posterior \
-    --chain $MDSINE_OUT_DIR/uc-seed0/mcmc.pkl \
-    --output-basepath $MDSINE_OUT_DIR/uc-seed0/posterior
-
-echo "Finished UC (seed 0)."
-
-# Seed 1
-mdsine2 infer \
-    --input $UC_DSET \
-    --negbin $NEGBIN \
-    --seed 1 \
-    --burnin $BURNIN \
-    --n-samples $N_SAMPLES \
-    --checkpoint $CHECKPOINT \
-    --multiprocessing $MULTIPROCESSING \
-    --rename-study uc-seed1 \
-    --basepath $MDSINE_OUT_DIR \
-    --interaction-ind-prior $INTERACTION_IND_PRIOR \
-    --perturbation-ind-prior $PERTURBATION_IND_PRIOR
-
-mdsine2 visualize-posterior \
-    --chain $MDSINE_OUT_DIR/uc-seed1/mcmc.pkl \
-    --output-basepath $MDSINE_OUT_DIR/uc-seed1/posterior
+    --perturbation-ind-prior $PERTURBATION_IND_PRIOR \
+    --cpus-per-chain $CPUS_PER_CHAIN
 
-echo "Finished UC (seed 1)."
+echo "Finished Healthy (seeds 0, 1) and UC (seeds 0, 1)."
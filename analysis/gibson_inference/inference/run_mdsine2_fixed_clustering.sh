@@ -17,6 +17,9 @@ echo "Writing files to ${MDSINE_FIXED_CLUSTER_OUT_DIR}"
 
 # Healthy cohort
 # --------------
+stage infer-fixed-clustering-healthy \
+    --outputs "${MDSINE_FIXED_CLUSTER_OUT_DIR}/healthy/mcmc.pkl" \
+    -- \
 mdsine2 infer \
     --input ${PREPROCESS_DIR}/gibson_healthy_agg_taxa_filtered.pkl \
     --negbin $NEGBIN \
@@ -29,6 +32,9 @@ mdsine2 infer \
     --fixed-clustering ${MDSINE_OUT_DIR}/healthy-seed0/mcmc.pkl \
     --interaction-ind-prior $INTERACTION_IND_PRIOR \
     --perturbation-ind-prior $PERTURBATION_IND_PRIOR
+stage posterior-fixed-clustering-healthy \
+    --outputs "${MDSINE_FIXED_CLUSTER_OUT_DIR}/healthy/posterior" \
+    -- \
 mdsine2 visualize-posterior \
     --chain  "${MDSINE_FIXED_CLUSTER_OUT_DIR}/healthy/mcmc.pkl" \
     --output-basepath "${MDSINE_FIXED_CLUSTER_OUT_DIR}/healthy/posterior" \
@@ -38,6 +44,9 @@ echo "Finished Healthy."
 
 # UC cohort
 # ---------
+stage infer-fixed-clustering-uc \
+    --outputs "${MDSINE_FIXED_CLUSTER_OUT_DIR}/uc/mcmc.pkl" \
+    -- \
 mdsine2 infer \
     --input ${PREPROCESS_DIR}/gibson_uc_agg_taxa_filtered.pkl \
     --negbin $NEGBIN \
@@ -50,6 +59,9 @@ mdsine2 infer \
     --fixed-clustering ${MDSINE_OUT_DIR}/uc-seed0/mcmc.pkl \
     --interaction-ind-prior $INTERACTION_IND_PRIOR \
     --perturbation-ind-prior $PERTURBATION_IND_PRIOR
+stage posterior-fixed-clustering-uc \
+    --outputs "${MDSINE_FIXED_CLUSTER_OUT_DIR}/uc/posterior" \
+    -- \
 mdsine2 visualize-posterior \
     --chain "${MDSINE_FIXED_CLUSTER_OUT_DIR}/uc/mcmc.pkl" \
     --output-basepath "${MDSINE_FIXED_CLUSTER_OUT_DIR}/uc/posterior" \
@@ -7,6 +7,9 @@ echo "Performing consistency filtering over Study objects."
 # Filter the OTUs using consistency filtering
 
 # ==== Healthy
+stage filter-healthy \
+    --outputs ${PREPROCESS_DIR}/gibson_healthy_agg_taxa_filtered.pkl \
+    -- \
 mdsine2 filter \
     --dataset ${PREPROCESS_DIR}/gibson_healthy_agg_taxa.pkl \
     --outfile ${PREPROCESS_DIR}/gibson_healthy_agg_taxa_filtered.pkl \
@@ -17,6 +20,9 @@ mdsine2 filter \
     --colonization-time 5
 
 # ==== UC
+stage filter-uc \
+    --outputs ${PREPROCESS_DIR}/gibson_uc_agg_taxa_filtered.pkl \
+    -- \
 mdsine2 filter \
     --dataset ${PREPROCESS_DIR}/gibson_uc_agg_taxa.pkl \
     --outfile ${PREPROCESS_DIR}/gibson_uc_agg_taxa_filtered.pkl \
@@ -26,6 +32,9 @@ mdsine2 filter \
     --min-num-subjects 2 \
     --colonization-time 5
 
+stage filter-replicates \
+    --outputs ${PREPROCESS_DIR}/gibson_replicates_agg_taxa_filtered.pkl \
+    -- \
 python helpers/filter_replicates_like_other_dataset.py \
     --replicate-dataset ${PREPROCESS_DIR}/gibson_replicates_agg_taxa.pkl \
     --like-other ${PREPROCESS_DIR}/gibson_healthy_agg_taxa_filtered.pkl \
@@ -19,3 +19,13 @@ export CV_BASEDIR="${OUT_DIR}/cv"
 export CV_DATASET_PATH="${CV_BASEDIR}/dataset"  # training/test datasets
 export CV_OUT_DIR="${CV_BASEDIR}/mdsine2"
 export CV_FWSIM_OUT_DIR="${CV_BASEDIR}/forward_sims"
+
+
+# ============== Stage caching
+# `stage <name> [--inputs ...] [--outputs ...] -- <command>` runs <command> only if it
+# has not already been run with the same arguments and inputs and its outputs are
+# unchanged (see helpers/pipeline_cache.py). Set PIPELINE_FORCE=1 to rerun everything.
+export PIPELINE_CACHE_DIR="${OUT_DIR}/.pipeline_cache"
+stage() {
+    python helpers/pipeline_cache.py --cache-dir "${PIPELINE_CACHE_DIR}" "$@"
+}
@@ -5,6 +5,10 @@ Author: David Kaplan
 Date: 11/30/20
 MDSINE2 version: 4.0.6
 '''
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+
+import numpy as np
 import pandas as pd
 import mdsine2 as md2
 from mdsine2.logger import logger
@@ -12,10 +16,19 @@ import os
 import argparse
 
 
+COLUMNS = ['kingdom', 'phylum', 'class', 'order', 'family', 'genus']
+DSETS = ['healthy', 'uc', 'replicates', 'inoculum']
+
+
 def parse_rdp(fname, confidence_threshold):
     '''Parse the taxonomic assignment document from RDP with a confidence
     threshold `confidence_threshold`
 
+    The document is read one line at a time into an array of the names and
+    an array of the confidences of the taxonomic levels of every OTU. Every
+    level after the first one whose confidence is not above the threshold is
+    then set to `md2.pylab.base.DEFAULT_TAXLEVEL_NAME` at once.
+
     Parameters
     ----------
     fname : str
@@ -26,51 +39,53 @@ def parse_rdp(fname, confidence_threshold):
 
     Returns
     -------
-    dict( key1 -> dict ( key2 -> value ) )
-        key1 : str
+    pd.DataFrame
+        index : str
             OTU name
-        key2 : str
+        columns : str
             taxonomic level
         value : str
             taxonomic name
     '''
-    f = open(fname, 'r')
-    txt = f.read()
-    f.close()
-
-    columns = ['kingdom', 'phylum', 'class', 'order', 'family', 'genus']
-    data = []
     index = []
+    names = []
+    confidences = []
+    with open(fname, 'r') as f:
+        for line in f:
+            if 'OTU' != line[:3]:
+                continue
+            # <otu>;<orientation>;Root;<conf>%;<kingdom>;<conf>%;...;<genus>;<conf>%
+            splitting = line.rstrip('\n').split('%;')
+            index.append(splitting[0].split(';')[0])
+            row_names = [None] * len(COLUMNS)
+            row_confidences = [np.nan] * len(COLUMNS)
+            for tax_idx, level in enumerate(splitting[1:]):
+                row_names[tax_idx], confidence = level.replace('%', '').split(';')
+                row_confidences[tax_idx] = float(confidence)
+            names.append(row_names)
+            confidences.append(row_confidences)
+
+    names = np.asarray(names, dtype=object).reshape(-1, len(COLUMNS))
+    confidences = np.asarray(confidences, dtype=float).reshape(-1, len(COLUMNS))
+    # Keep the levels up to the first one at or below the threshold (or missing)
+    keep = np.logical_and.accumulate(confidences > confidence_threshold, axis=1)
+    names[~keep] = md2.pylab.base.DEFAULT_TAXLEVEL_NAME
+
+    df = pd.DataFrame(names, columns=COLUMNS, index=index)
+    return df
 
-    for i, line in enumerate(txt.split('\n')):
-        if 'OTU' != line[:3]:
-            continue
-
-        splitting = line.split('%;')
-        otuname = splitting[0].split(';')[0]
-        splitting = splitting[1:]
-
-        index.append(otuname)
-
-        temp = []
-        taxaed = []
-
-        for tax_idx in range(len(splitting)):
-            tax_key = columns[tax_idx]
-            tax, confidence = splitting[tax_idx].replace('%', '').split(';')
-            if float(confidence) > confidence_threshold:
-                temp.append(tax)
-                taxaed.append(tax_key)
-            else:
-                break
 
-        for tax_key in columns:
-            if tax_key not in taxaed:
-                temp.append(md2.pylab.base.DEFAULT_TAXLEVEL_NAME)
-        data.append(temp)
+def replace_taxonomy(basepath, dset, df):
+    '''Set the consensus taxonomies of the taxa of the study of `dset` to `df`
+    and save it as `gibson_<dset>_agg_taxa.pkl`.'''
+    logger.info('Replacing {}'.format(dset))
+    study_fname = os.path.join(basepath, 'gibson_{dset}_agg.pkl'.format(dset=dset))
+    study = md2.Study.load(study_fname)
 
-    df = pd.DataFrame(data, columns=columns, index=index)
-    return df
+    study.taxa.generate_consensus_taxonomies(df)
+    study_fname = os.path.join(basepath, 'gibson_{dset}_agg_taxa.pkl'.format(dset=dset))
+    study.save(study_fname)
+    return study_fname
 
 
 if __name__ == '__main__':
@@ -82,16 +97,17 @@ if __name__ == '__main__':
         help='This is the minimum confidence required for us to use the classification')
     parser.add_argument('--output-basepath', '-o', type=str, dest='basepath',
         help='This is where you want to save the parsed dataset.')
+    parser.add_argument('--max-workers', type=int, dest='max_workers', default=len(DSETS),
+        help='Maximum number of datasets to update at the same time')
     args = parser.parse_args()
 
     logger.info('Parsing RDP')
     df = parse_rdp(fname=args.rdp_table, confidence_threshold=args.confidence_threshold)
 
-    for dset in ['healthy', 'uc', 'replicates', 'inoculum']:
-        logger.info('Replacing {}'.format(dset))
-        study_fname = os.path.join(args.basepath, 'gibson_{dset}_agg.pkl'.format(dset=dset))
-        study = md2.Study.load(study_fname)
-
-        study.taxa.generate_consensus_taxonomies(df)
-        study_fname = os.path.join(args.basepath, 'gibson_{dset}_agg_taxa.pkl'.format(dset=dset))
-        study.save(study_fname)
+    # The datasets share the parsed table and are updated in parallel
+    context = multiprocessing.get_context('fork')
+    with ProcessPoolExecutor(max_workers=max(1, min(args.max_workers, len(DSETS))),
+            mp_context=context) as pool:
+        futures = [pool.submit(replace_taxonomy, args.basepath, dset, df) for dset in DSETS]
+        for future in futures:
+            logger.info('Saved {}'.format(future.result()))
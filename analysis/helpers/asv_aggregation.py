@@ -0,0 +1,156 @@
+'''Aggregate the ASVs of a study within a hamming distance without comparing
+every pair of sequences.
+
+`md2.aggregate_items(subjset=study, hamming_dist=d)` scans the taxa in order
+and, for each taxon that has not been aggregated yet (the anchor), aggregates
+into it every later taxon whose sequence has the same length and is within a
+hamming distance `d` of the sequence of the anchor. It finds them by comparing
+all pairs of sequences (and restarting the scan after every aggregation).
+
+`hamming_groups` computes the same groups with a pigeonhole index: if two
+sequences of the same length are within a hamming distance `d`, then at least
+one of `d + 1` disjoint segments of the sequences is identical in both. Every
+sequence is split into `d + 1` segments, the sequences are bucketed by the
+content of each segment, and only the sequences that share a bucket are
+compared (vectorized, on the `sequence_matrix` rows).
+
+`aggregate_study` hands the groups to `md2.Study.aggregate_items`, in the order
+that `md2.aggregate_items` would aggregate them. The groups only depend on the
+names and sequences of the taxa, so they are remembered for the datasets that
+share the same taxa (e.g. healthy, uc, replicates and inoculum) and are only
+computed once.
+'''
+import hashlib
+
+from mdsine2.logger import logger
+import numpy as np
+
+import sequence_matrix
+
+# digest of the (names, sequences, hamming distance) -> groups
+_GROUPS = {}
+
+
+def _segments(length, n_segments):
+    bounds = np.linspace(0, length, n_segments + 1).astype(int)
+    return [(start, stop) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+
+
+def _neighbors(M, hamming_dist):
+    '''For every row of `M`, the later rows within `hamming_dist` of it.'''
+    n, length = M.shape
+    if length <= hamming_dist:
+        # There are not enough positions for `hamming_dist + 1` non-empty segments,
+        # but every pair of sequences of this length is within the distance
+        return [np.arange(i + 1, n) for i in range(n)]
+    buckets = {}
+    for k, (start, stop) in enumerate(_segments(length, hamming_dist + 1)):
+        keys = M[:, start:stop].tobytes()
+        size = stop - start
+        for i in range(n):
+            buckets.setdefault((k, keys[i * size:(i + 1) * size]), []).append(i)
+
+    candidates = [set() for _ in range(n)]
+    for rows in buckets.values():
+        if len(rows) < 2:
+            continue
+        for a, i in enumerate(rows):
+            candidates[i].update(rows[a + 1:])
+
+    neighbors = []
+    for i in range(n):
+        cands = np.fromiter(sorted(candidates[i]), dtype=int, count=len(candidates[i]))
+        if len(cands) > 0:
+            dists = np.count_nonzero(M[cands] != M[i], axis=1)
+            cands = cands[dists <= hamming_dist]
+        neighbors.append(cands)
+    return neighbors
+
+
+def hamming_groups(names, sequences, hamming_dist):
+    '''Groups of the taxa that `md2.aggregate_items` aggregates together.
+
+    Parameters
+    ----------
+    names : list(str)
+        Names of the taxa, in the order of the study
+    sequences : list(str)
+        Sequence of each taxon
+    hamming_dist : int
+        Maximum hamming distance to the anchor of the group
+
+    Returns
+    -------
+    list((str, list(str)))
+        The anchor of every group with at least two taxa and the names of the
+        taxa that are aggregated into it, in order
+
+    Examples
+    --------
+    Sequences that are not longer than the distance are all within it
+
+    >>> hamming_groups(['x', 'y'], ['AC', 'GT'], 3)
+    [('x', ['y'])]
+    >>> hamming_groups(['x', 'y', 'z'], ['AAAA', 'AATT', 'TTTT'], 2)
+    [('x', ['y'])]
+    '''
+    h = hashlib.sha256()
+    for name, seq in zip(names, sequences):
+        h.update('{}\t{}\n'.format(name, seq).encode())
+    key = (h.hexdigest(), hamming_dist)
+    if key in _GROUPS:
+        return _GROUPS[key]
+
+    names = list(names)
+    sequences = list(sequences)
+    by_length = {}
+    for i, seq in enumerate(sequences):
+        by_length.setdefault(len(seq), []).append(i)
+    neighbors = [None] * len(names)
+    for rows in by_length.values():
+        M = sequence_matrix.sequence_matrix(sequences[i] for i in rows)
+        for i, nbrs in zip(rows, _neighbors(M, hamming_dist)):
+            neighbors[i] = [rows[j] for j in nbrs]
+
+    aggregated = np.zeros(len(names), dtype=bool)
+    groups = []
+    for i in range(len(names)):
+        if aggregated[i]:
+            continue
+        members = [j for j in neighbors[i] if not aggregated[j]]
+        if len(members) == 0:
+            continue
+        aggregated[members] = True
+        groups.append((names[i], [names[j] for j in members]))
+    _GROUPS[key] = groups
+    return groups
+
+
+def aggregate_study(study, hamming_dist):
+    '''Same as `md2.aggregate_items(subjset=study, hamming_dist=hamming_dist)`.
+
+    Parameters
+    ----------
+    study : md2.Study
+    hamming_dist : int
+
+    Returns
+    -------
+    md2.Study
+        `study`, aggregated in place
+    '''
+    names = [taxon.name for taxon in study.taxa]
+    groups = hamming_groups(names, [taxon.sequence for taxon in study.taxa], hamming_dist)
+    logger.info('Aggregating {} taxa into {} groups'.format(
+        sum(len(members) + 1 for _, members in groups), len(groups)))
+
+    position = {name: i for i, name in enumerate(names)}
+    removed = np.zeros(len(names), dtype=int)
+    for anchor, members in groups:
+        # Aggregating only removes taxa that come after the anchor, so the
+        # anchor is at its original index minus the taxa removed before it
+        idx = position[anchor] - removed[:position[anchor]].sum()
+        for name in members:
+            study.aggregate_items(study.taxa[idx], study.taxa[name])
+            removed[position[name]] = 1
+    return study
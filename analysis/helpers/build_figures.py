@@ -0,0 +1,355 @@
+'''Render the main and supplemental figures of `gibson_inference/figures` in one
+pool of long-lived worker processes.
+
+Each figure is the script that its `make_*.sh` runs, with the same arguments
+(they are read from the `make_*.sh` scripts, see `read_make_script`). The
+driver
+
+    - skips the figures that are up to date. A figure is rebuilt only if its
+      script, the local modules it imports (e.g. `helpers/taxa_aggregation.py`),
+      its arguments or one of its inputs changed since it was last made, or if
+      one of its outputs is missing or changed (the fingerprints are kept by
+      `pipeline_cache.PipelineCache`, in the same cache folder as the `stage`s of
+      the pipeline),
+    - loads every Study/MCMC pickle that is read by more than one of the figures
+      to rebuild once, in the driver process, before the workers are forked. The
+      workers inherit them and `md2.Study.load`/`md2.BaseMCMC.load` return the
+      preloaded objects instead of reading the pickles again (a Study is copied
+      first since some figures pop subjects from it; chains are shared as is),
+    - imports matplotlib and seaborn and registers the Arial fonts
+      (`plot_setup.use_arial_fonts`) once per worker, and runs every figure
+      script in the worker as `__main__` (with `runpy`), restoring the
+      matplotlib settings and closing the figures after each one.
+
+This is called by `gibson_inference/figures/make_all_figures.sh` from the
+`analysis` folder (the figure scripts use paths relative to it):
+
+    python helpers/build_figures.py --cache-dir ${PIPELINE_CACHE_DIR} --max-workers 4
+'''
+import argparse
+import copy
+import multiprocessing
+import os
+import runpy
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import mdsine2 as md2
+from mdsine2.logger import logger
+
+import pipeline_cache
+import plot_setup
+
+FIGURES_DIR = 'gibson_inference/figures'
+
+# Arguments of the figure scripts that are the folder the figure is saved in
+_OUTPUT_DIR_OPTIONS = ['-o_loc', '--output_loc', '--output_path']
+
+# Objects preloaded by the driver, inherited by the forked workers
+_PRELOADED = {}
+_LOAD = {}
+
+
+class Figure(object):
+    '''A figure script and the arguments its `make_*.sh` runs it with.
+
+    Parameters
+    ----------
+    name : str
+        Unique name of the figure
+    script : str
+        Path of the script
+    args : list(str)
+        Arguments of the script
+    outputs : list(str)
+        Files the script makes
+    inputs : list(str)
+        Files/folders read by the script that are not one of its arguments (e.g.
+        folders of forward simulations). Arguments that are existing files are
+        inputs already.
+    '''
+    def __init__(self, name, script, args, outputs, inputs=None):
+        self.name = name
+        self.script = script
+        self.args = list(args)
+        self.outputs = list(outputs)
+        self.inputs = list(inputs or [])
+
+    def __repr__(self):
+        return 'Figure({})'.format(self.name)
+
+    @property
+    def command(self):
+        return [sys.executable, self.script] + self.args
+
+    @property
+    def stage(self):
+        return 'figure-' + self.name
+
+    def all_inputs(self):
+        '''The inputs, the arguments that are files and the local modules that the
+        script imports (e.g. `taxa_aggregation.py`), so that editing a helper
+        rebuilds the figures that use it.'''
+        return sorted(set(self.inputs + pipeline_cache.local_imports(self.script) +
+            pipeline_cache.implicit_inputs(self.command, self.outputs)))
+
+
+def _figure_from_args(script, args):
+    '''The `Figure` of a run of a figure script with the arguments `args`.
+
+    The name and the outputs follow the naming of the figure scripts: a DESeq
+    heatmap script writes `<-o_loc>/<-o>.pdf`, the other scripts write
+    `<output folder>/<name of the script>.pdf`. Every other argument that is a
+    path is an input.
+    '''
+    options = {}
+    for i, arg in enumerate(args[:-1]):
+        if arg.startswith('-') and not args[i + 1].startswith('-'):
+            options[arg] = args[i + 1]
+    out_dirs = [options[opt] for opt in _OUTPUT_DIR_OPTIONS if opt in options]
+    if len(out_dirs) != 1:
+        raise ValueError('Could not find the output folder of {} {}'.format(script, args))
+
+    stem = os.path.splitext(os.path.basename(script))[0]
+    if stem.startswith('deseq_heatmap'):
+        name = 'deseq-' + options['-o'].replace('_', '-')
+        output = options['-o'] + '.pdf'
+    else:
+        name = stem.replace('_', '-')
+        output = stem + '.pdf'
+    inputs = [value for opt, value in options.items()
+        if opt not in _OUTPUT_DIR_OPTIONS and '/' in value]
+    return Figure(name, script, args, outputs=[os.path.join(out_dirs[0], output)],
+        inputs=inputs)
+
+
+def read_make_script(path):
+    '''The runs of the figure scripts in a `make_*.sh` script.
+
+    The script is run by bash with `python` replaced by a function that records
+    its arguments (after the variables of `settings.sh` are expanded) instead of
+    running anything, so the `make_*.sh` scripts are the only place the
+    arguments of the figures are written down.
+
+    Returns
+    -------
+    list((str, list(str)))
+        The script and the arguments of every `python` command
+    '''
+    record = tempfile.NamedTemporaryFile(suffix='.commands', delete=False)
+    record.close()
+    try:
+        shell = 'python() {{ printf \'%s\\0\' "$#" "$@" >> {record}; }}; ' \
+            'export -f python; bash {script}'.format(record=shlex.quote(record.name),
+            script=shlex.quote(path))
+        subprocess.run(['bash', '-c', shell], check=True, stdout=subprocess.DEVNULL)
+        with open(record.name, 'rb') as f:
+            tokens = f.read().decode().split('\0')[:-1]
+    finally:
+        os.remove(record.name)
+
+    commands = []
+    i = 0
+    while i < len(tokens):
+        n = int(tokens[i])
+        commands.append((tokens[i + 1], tokens[i + 2:i + 1 + n]))
+        i += 1 + n
+    return commands
+
+
+def gibson_figures(figures_dir=FIGURES_DIR):
+    '''The figures of the `make_*.sh` scripts in `figures_dir`.
+
+    Runs of scripts that do not exist are skipped (with a warning), and so is
+    `make_all_figures.sh`.
+
+    Returns
+    -------
+    list(Figure)
+    '''
+    figures = []
+    for fname in sorted(os.listdir(figures_dir)):
+        if not (fname.startswith('make_') and fname.endswith('.sh')) or \
+                fname == 'make_all_figures.sh':
+            continue
+        for script, args in read_make_script(os.path.join(figures_dir, fname)):
+            if not os.path.isfile(script):
+                logger.warning('Skipping `{}` of {}: the script does not exist'.format(
+                    script, fname))
+                continue
+            figures.append(_figure_from_args(script, args))
+    return figures
+
+
+def shared_pickles(figures):
+    '''Pickles (arguments ending in `.pkl`) that are read by more than one of the
+    figures.'''
+    counts = {}
+    for figure in figures:
+        for path in set(arg for arg in figure.args if arg.endswith('.pkl')):
+            counts[path] = counts.get(path, 0) + 1
+    return sorted(path for path, count in counts.items() if count > 1 and os.path.isfile(path))
+
+
+def preload(paths):
+    '''Load the pickles into `_PRELOADED`. Chains are the pickles named `mcmc.pkl`,
+    the others are Studies.'''
+    for path in paths:
+        start_time = time.time()
+        if os.path.basename(path) == 'mcmc.pkl':
+            obj = md2.BaseMCMC.load(path)
+        else:
+            obj = md2.Study.load(path)
+        _PRELOADED[os.path.abspath(path)] = obj
+        logger.info('Preloaded {} in {:.1f}s'.format(path, time.time() - start_time))
+
+
+def _preloaded_loader(name, load, copy_obj):
+    def _load(filename, *args, **kwargs):
+        obj = _PRELOADED.get(os.path.abspath(filename))
+        if obj is None:
+            return load(filename, *args, **kwargs)
+        return copy.deepcopy(obj) if copy_obj else obj
+    _load.__name__ = name
+    return staticmethod(_load)
+
+
+def _init_worker():
+    '''Set up a worker once: non-interactive matplotlib, the Arial fonts and the
+    loaders of the preloaded pickles.'''
+    import matplotlib
+    matplotlib.use('Agg')
+    # Imported once per worker so that the figures do not each pay for it
+    import matplotlib.pyplot  # noqa: F401
+    import seaborn  # noqa: F401
+
+    plot_setup.use_arial_fonts()
+
+    _LOAD['study'] = md2.Study.load
+    _LOAD['mcmc'] = md2.BaseMCMC.load
+    md2.Study.load = _preloaded_loader('load', _LOAD['study'], copy_obj=True)
+    md2.BaseMCMC.load = _preloaded_loader('load', _LOAD['mcmc'], copy_obj=False)
+
+
+def render(figure):
+    '''Run the script of a figure in this process.
+
+    Returns
+    -------
+    float
+        Time it took, in seconds
+    '''
+    import matplotlib
+    import matplotlib.pyplot as plt
+
+    start_time = time.time()
+    argv = sys.argv
+    sys.argv = [figure.script] + figure.args
+    try:
+        with matplotlib.rc_context():
+            runpy.run_path(figure.script, run_name='__main__')
+    except SystemExit as e:
+        # e.g. an argparse error. Report it as a failure of the figure instead of
+        # letting it stop the worker (and the driver)
+        if e.code not in (None, 0):
+            raise RuntimeError('{} exited with {}'.format(figure.script, e.code))
+    finally:
+        sys.argv = argv
+        plt.close('all')
+    return time.time() - start_time
+
+
+def build(figures, cache, max_workers=1, force=False):
+    '''Render the figures that are out of date.
+
+    Parameters
+    ----------
+    figures : list(Figure)
+    cache : pipeline_cache.PipelineCache
+    max_workers : int
+        Number of worker processes
+    force : bool
+        If True, render all of the figures
+
+    Returns
+    -------
+    list(str)
+        Names of the figures that failed
+    '''
+    stale = []
+    fingerprints = {}
+    failed = []
+    for figure in figures:
+        inputs = figure.all_inputs()
+        missing = [path for path in figure.inputs if not os.path.exists(path)]
+        if len(missing) > 0:
+            logger.error('[{}] inputs do not exist: {}'.format(figure.name, missing))
+            failed.append(figure.name)
+            continue
+        fingerprints[figure.name] = cache.fingerprint(figure.command, inputs)
+        reason = 'forced' if force else cache.is_up_to_date(figure.stage,
+            fingerprints[figure.name], figure.outputs)
+        if reason is None:
+            logger.info('[{}] up to date, skipping'.format(figure.name))
+            continue
+        logger.info('[{}] rendering because {}'.format(figure.name, reason))
+        stale.append(figure)
+    cache.save()
+    if len(stale) == 0:
+        return failed
+
+    preload(shared_pickles(stale))
+    context = multiprocessing.get_context('fork')
+    with ProcessPoolExecutor(max_workers=max(1, min(max_workers, len(stale))),
+            mp_context=context, initializer=_init_worker) as pool:
+        futures = {pool.submit(render, figure): figure for figure in stale}
+        for future in as_completed(futures):
+            figure = futures[future]
+            try:
+                elapsed = future.result()
+            except (Exception, SystemExit) as e:
+                logger.error('[{}] failed: {}: {}'.format(figure.name, type(e).__name__, e))
+                failed.append(figure.name)
+                continue
+            missing = [path for path in figure.outputs if not os.path.exists(path)]
+            if len(missing) > 0:
+                logger.error('[{}] finished but did not make {}'.format(figure.name, missing))
+                failed.append(figure.name)
+                continue
+            cache.record(figure.stage, fingerprints[figure.name], figure.command, figure.outputs)
+            cache.save()
+            logger.info('[{}] finished in {:.1f}s'.format(figure.name, elapsed))
+    _PRELOADED.clear()
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(usage=__doc__)
+    parser.add_argument('--cache-dir', type=str, dest='cache_dir', required=True,
+        help='Folder the fingerprints of the figures are saved in')
+    parser.add_argument('--max-workers', type=int, dest='max_workers', default=os.cpu_count(),
+        help='Maximum number of figures rendered at once')
+    parser.add_argument('--only', type=str, dest='only', nargs='+', default=None,
+        help='Names of the figures to render (default all of them)')
+    parser.add_argument('--force', action='store_true', dest='force',
+        help='Render the figures even if they are up to date')
+    args = parser.parse_args()
+    force = args.force or os.environ.get('PIPELINE_FORCE', '0') not in ('', '0')
+
+    figures = gibson_figures()
+    if args.only is not None:
+        unknown = set(args.only) - set(figure.name for figure in figures)
+        if len(unknown) > 0:
+            parser.error('Unknown figures {}. Choose from {}'.format(sorted(unknown),
+                [figure.name for figure in figures]))
+        figures = [figure for figure in figures if figure.name in args.only]
+
+    failed = build(figures, pipeline_cache.PipelineCache(args.cache_dir),
+        max_workers=args.max_workers, force=force)
+    if len(failed) > 0:
+        logger.error('{} figure(s) failed: {}'.format(len(failed), sorted(failed)))
+        sys.exit(1)
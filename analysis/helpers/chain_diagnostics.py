@@ -0,0 +1,579 @@
+'''Cross-chain convergence diagnostics for MDSINE2 inference.
+
+Given several chains run on the same dataset with different seeds, compute for the
+growth rates, the self-interactions and the interaction indicators:
+
+    - the split R-hat (Gelman et al., Bayesian Data Analysis 3rd ed., 11.4),
+    - the effective sample size over all chains (Geyer's initial monotone sequence),
+    - the autocorrelation of each parameter averaged over the chains.
+
+A table with one row per parameter is written to `{output-basepath}/diagnostics.tsv`
+and the autocorrelations to `{output-basepath}/autocorrelation.tsv`.
+
+With `--follow`, the chains can still be running. Every `--interval` seconds, the
+samples written to disk since the last check (MDSINE2 writes the trace every
+`--checkpoint` steps) are added to running estimates of each chain and the tables
+are rewritten. Only the rows of the HDF5 trace written since the last check are read:
+the running estimates keep the sums of the samples over blocks of `--block-size`
+samples (for the split R-hat) and the sums of lagged products up to `--max-lag` (for
+the autocorrelation and the ESS, which is therefore truncated at `--max-lag`). If `--min-ess` is given, monitoring
+stops as soon as every parameter has an R-hat below `--rhat-threshold` and an ESS of
+at least `--min-ess`, which is when the chains can be stopped.
+'''
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+import mdsine2 as md2
+from mdsine2.names import STRNAMES
+from mdsine2.logger import logger
+
+# Number of parameters whose diagnostics are computed at once. The interaction
+# indicators of a chain have n_taxa^2 parameters, so they are done in chunks to bound
+# the memory of the FFTs.
+_CHUNK_SIZE = 1000
+
+
+def load_traces(chain_path, section='posterior'):
+    '''Load the traces of the parameters we check for convergence.
+
+    Parameters
+    ----------
+    chain_path : str
+        Location of the `md2.BaseMCMC` chain
+    section : str
+        Section of the trace to load
+
+    Returns
+    -------
+    dict(str -> np.ndarray(n_gibbs, n_params)), list(str)
+        Trace of each parameter group and the names of the taxa
+    '''
+    mcmc = md2.BaseMCMC.load(chain_path)
+    return _traces(mcmc, section), [taxon.name for taxon in mcmc.graph.data.taxa]
+
+
+# Node of the graph whose trace is each parameter group
+_GROUP_NODES = {
+    'growth': STRNAMES.GROWTH_VALUE,
+    'self_interaction': STRNAMES.SELF_INTERACTION_VALUE,
+    'interaction_indicator': STRNAMES.INTERACTIONS_OBJ}
+
+
+def _traces(mcmc, section):
+    traces = {group: mcmc.graph[node].get_trace_from_disk(section=section)
+        for group, node in _GROUP_NODES.items()}
+    traces['interaction_indicator'] = interaction_indicators(traces['interaction_indicator'])
+    return traces
+
+
+def interaction_indicators(interactions):
+    '''Off-diagonal interaction indicators (np.ndarray(n_gibbs, n_taxa * (n_taxa - 1)))
+    of a trace of the interaction matrices (np.ndarray(n_gibbs, n_taxa, n_taxa)).
+    '''
+    n_taxa = interactions.shape[1]
+    indicators = ~np.isnan(interactions) & (interactions != 0)
+    return indicators[:, ~np.eye(n_taxa, dtype=bool)].astype(float)
+
+
+def checkpointed_length(f):
+    '''Number of Gibbs steps of the chain written to disk so far, read from the
+    `end_iter` attribute MDSINE2 keeps on the datasets of its trace file (an open
+    `h5py.File`). Returns None if it is not there, in which case the whole trace on
+    disk is assumed valid.
+    '''
+    ends = [f[key].attrs['end_iter'] for key in f if 'end_iter' in f[key].attrs]
+    if len(ends) == 0:
+        return None
+    return int(min(ends))
+
+
+def parameter_names(group, taxa):
+    if group == 'interaction_indicator':
+        return ['{}->{}'.format(src, dst) for dst in taxa for src in taxa if src != dst]
+    return list(taxa)
+
+
+def _trim(traces):
+    '''Stack the traces of the chains, truncating them to the shortest one.'''
+    n_samples = min(trace.shape[0] for trace in traces)
+    return np.stack([trace[:n_samples] for trace in traces])
+
+
+def autocovariance(x):
+    '''Autocovariance of each chain at every lag, computed with an FFT.
+
+    Parameters
+    ----------
+    x : np.ndarray(n_chains, n_samples, n_params)
+
+    Returns
+    -------
+    np.ndarray(n_chains, n_samples, n_params)
+    '''
+    n = x.shape[1]
+    centered = x - x.mean(axis=1, keepdims=True)
+    n_fft = 1 << int(np.ceil(np.log2(2 * n)))
+    f = np.fft.rfft(centered, n=n_fft, axis=1)
+    acov = np.fft.irfft(f * np.conjugate(f), n=n_fft, axis=1)[:, :n]
+    return acov / n
+
+
+def _rhat_from_moments(means, variances, n):
+    '''R-hat from the means and variances (`ddof=1`) of chains of `n` samples each.'''
+    within = variances.mean(axis=0)
+    between = n * means.var(axis=0, ddof=1)
+    var_plus = (n - 1) / n * within + between / n
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rhat = np.sqrt(var_plus / within)
+    rhat[within == 0] = np.where(between[within == 0] == 0, 1., np.inf)
+    return rhat
+
+
+def split_rhat(x):
+    '''Split R-hat of each parameter.
+
+    Parameters
+    ----------
+    x : np.ndarray(n_chains, n_samples, n_params)
+
+    Returns
+    -------
+    np.ndarray(n_params)
+        1 if the parameter is constant in every chain half and equal across them,
+        `inf` if it is constant within but different across the chain halves
+    '''
+    half = x.shape[1] // 2
+    halves = np.concatenate([x[:, :half], x[:, half:2 * half]], axis=0)
+    return _rhat_from_moments(halves.mean(axis=1), halves.var(axis=1, ddof=1), half)
+
+
+def _ess_from_autocovariance(acov, means, n):
+    '''Effective sample size from the autocovariances (normalized by `n`) and the
+    means of chains of `n` samples each. The sum of the autocorrelations is truncated
+    at the largest lag in `acov`.
+    '''
+    n_chains = acov.shape[0]
+    chain_var = acov[:, 0] * n / (n - 1)
+    within = chain_var.mean(axis=0)
+    var_plus = (n - 1) / n * within
+    if n_chains > 1:
+        var_plus = var_plus + means.var(axis=0, ddof=1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rho = 1 - (within - acov.mean(axis=0)) / var_plus
+    rho[0] = 1
+
+    # Geyer's initial monotone sequence: sum the pairs rho_{2k} + rho_{2k+1} while
+    # they are positive, forcing them to be non-increasing
+    n_pairs = rho.shape[0] // 2
+    pairs = rho[:2 * n_pairs:2] + rho[1:2 * n_pairs:2]
+    pairs = np.minimum.accumulate(pairs, axis=0)
+    positive = np.cumprod(pairs > 0, axis=0).astype(bool)
+    tau = -1 + 2 * np.where(positive, pairs, 0).sum(axis=0)
+    ess = n_chains * n / np.maximum(tau, 1 / np.log10(n_chains * n))
+    ess[var_plus == 0] = np.nan
+    return ess
+
+
+def effective_sample_size(x):
+    '''Effective sample size of each parameter over all of the chains.
+
+    Parameters
+    ----------
+    x : np.ndarray(n_chains, n_samples, n_params)
+
+    Returns
+    -------
+    np.ndarray(n_params)
+    '''
+    return _ess_from_autocovariance(autocovariance(x), x.mean(axis=1), x.shape[1])
+
+
+def autocorrelation(x, max_lag):
+    '''Autocorrelation of each parameter up to `max_lag`, averaged over the chains.
+
+    Parameters
+    ----------
+    x : np.ndarray(n_chains, n_samples, n_params)
+    max_lag : int
+
+    Returns
+    -------
+    np.ndarray(max_lag + 1, n_params)
+    '''
+    acov = autocovariance(x)[:, :max_lag + 1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        acorr = acov / acov[:, :1]
+    return np.nanmean(acorr, axis=0)
+
+
+def summarize(traces, max_lag=50):
+    '''Diagnostics of every parameter of a parameter group.
+
+    Parameters
+    ----------
+    traces : list(np.ndarray(n_gibbs, n_params))
+        Trace of the group in each chain
+    max_lag : int
+        Largest lag of the autocorrelation
+
+    Returns
+    -------
+    np.ndarray(n_params), np.ndarray(n_params), np.ndarray(max_lag + 1, n_params)
+        R-hat, effective sample size and autocorrelation
+    '''
+    n_params = traces[0].shape[1]
+    rhat = np.zeros(n_params)
+    ess = np.zeros(n_params)
+    acorr = np.zeros((max_lag + 1, n_params))
+    for start in range(0, n_params, _CHUNK_SIZE):
+        cols = slice(start, start + _CHUNK_SIZE)
+        x = _trim([trace[:, cols] for trace in traces])
+        rhat[cols] = split_rhat(x)
+        ess[cols] = effective_sample_size(x)
+        acorr[:, cols] = autocorrelation(x, max_lag)
+    return rhat, ess, acorr
+
+
+def diagnostics_table(chain_traces, taxa, max_lag=50):
+    '''Build the diagnostic and autocorrelation tables from the traces of the chains.
+
+    Parameters
+    ----------
+    chain_traces : list(dict(str -> np.ndarray(n_gibbs, n_params)))
+        Output of `load_traces` for each chain
+    taxa : list(str)
+        Names of the taxa
+    max_lag : int
+        Largest lag of the autocorrelation
+
+    Returns
+    -------
+    pd.DataFrame, pd.DataFrame
+    '''
+    results = {}
+    for group in chain_traces[0]:
+        results[group] = summarize([traces[group] for traces in chain_traces], max_lag=max_lag)
+    return _tables(results, taxa, max_lag)
+
+
+def _tables(results, taxa, max_lag):
+    rows = []
+    acorr_rows = []
+    for group, (rhat, ess, acorr) in results.items():
+        names = parameter_names(group, taxa)
+        rows.append(pd.DataFrame({
+            'Group': group, 'Parameter': names, 'Rhat': rhat, 'ESS': ess}))
+        acorr_rows.append(pd.DataFrame(acorr.T, index=pd.MultiIndex.from_product(
+            [[group], names], names=['Group', 'Parameter'])))
+    table = pd.concat(rows, ignore_index=True)
+    acorr_table = pd.concat(acorr_rows)
+    acorr_table.columns = ['Lag{}'.format(lag) for lag in range(max_lag + 1)]
+    return table, acorr_table
+
+
+class StreamingTrace(object):
+    '''Running statistics of the trace of a parameter group in one chain, updated
+    with the samples of each new checkpoint.
+
+    The statistics are computed on the samples minus the first sample so that the
+    sums of squares do not lose precision for parameters far from 0.
+
+    Parameters
+    ----------
+    n_params : int
+        Number of parameters in the group
+    max_lag : int
+        Largest lag of the autocovariance
+    block_size : int
+        Number of samples summed together for the split R-hat. The chain is split in
+        half on a block boundary.
+    '''
+    def __init__(self, n_params, max_lag=50, block_size=100):
+        self.max_lag = max_lag
+        self.block_size = block_size
+        self.n = 0
+        self.shift = None
+        self.total = np.zeros(n_params)
+        self.lag_products = np.zeros((max_lag + 1, n_params))
+        self.head = np.zeros((0, n_params))
+        self.tail = np.zeros((0, n_params))
+        self.block_sums = []
+        self.block_sumsqs = []
+        self._block_sum = np.zeros(n_params)
+        self._block_sumsq = np.zeros(n_params)
+        self._block_n = 0
+
+    def update(self, samples):
+        '''Add the samples (np.ndarray(n_new, n_params)) that follow the ones already seen.'''
+        samples = np.asarray(samples, dtype=float)
+        if samples.shape[0] == 0:
+            return
+        if self.shift is None:
+            self.shift = samples[0].copy()
+        samples = samples - self.shift
+
+        # Products x_t * x_{t+k} where x_{t+k} is one of the new samples
+        z = np.concatenate([self.tail, samples])
+        b = self.tail.shape[0]
+        for k in range(self.max_lag + 1):
+            start = max(b, k)
+            if start < z.shape[0]:
+                self.lag_products[k] += np.einsum('ij,ij->j',
+                    z[start - k:z.shape[0] - k], z[start:])
+        self.tail = z[-self.max_lag:].copy() if self.max_lag > 0 else z[:0]
+        if self.head.shape[0] < self.max_lag:
+            self.head = np.concatenate([self.head, samples[:self.max_lag - self.head.shape[0]]])
+        self.total += samples.sum(axis=0)
+        self.n += samples.shape[0]
+
+        i = 0
+        while i < samples.shape[0]:
+            chunk = samples[i:i + self.block_size - self._block_n]
+            self._block_sum += chunk.sum(axis=0)
+            self._block_sumsq += np.square(chunk).sum(axis=0)
+            self._block_n += chunk.shape[0]
+            i += chunk.shape[0]
+            if self._block_n == self.block_size:
+                self.block_sums.append(self._block_sum)
+                self.block_sumsqs.append(self._block_sumsq)
+                self._block_sum = np.zeros_like(self._block_sum)
+                self._block_sumsq = np.zeros_like(self._block_sumsq)
+                self._block_n = 0
+
+    @property
+    def n_blocks(self):
+        return len(self.block_sums)
+
+    def mean(self):
+        return self.shift + self.total / self.n
+
+    def autocovariance(self):
+        '''Autocovariance (normalized by `n`) at lags 0..max_lag, np.ndarray(max_lag + 1, n_params).'''
+        n = self.n
+        mean = self.total / n
+        acov = np.zeros_like(self.lag_products)
+        for k in range(self.max_lag + 1):
+            # Sums of x_0..x_{n-k-1} and of x_k..x_{n-1}
+            first = self.total - (self.tail[self.tail.shape[0] - k:].sum(axis=0) if k > 0 else 0)
+            last = self.total - self.head[:k].sum(axis=0)
+            acov[k] = (self.lag_products[k] - mean * (first + last) + (n - k) * mean ** 2) / n
+        return acov
+
+    def half_moments(self, n_half_blocks):
+        '''Means and variances (`ddof=1`) of the first and second `n_half_blocks` blocks.'''
+        n = n_half_blocks * self.block_size
+        means = []
+        variances = []
+        for blocks in [slice(0, n_half_blocks), slice(n_half_blocks, 2 * n_half_blocks)]:
+            total = np.sum(self.block_sums[blocks], axis=0)
+            sumsq = np.sum(self.block_sumsqs[blocks], axis=0)
+            mean = total / n
+            means.append(self.shift + mean)
+            variances.append(np.maximum(sumsq - n * mean ** 2, 0) / (n - 1))
+        return np.stack(means), np.stack(variances)
+
+
+def streaming_summary(traces):
+    '''Diagnostics of a parameter group from the running statistics of each chain.
+
+    Parameters
+    ----------
+    traces : list(StreamingTrace)
+        Running statistics of the group in each chain
+
+    Returns
+    -------
+    np.ndarray(n_params), np.ndarray(n_params), np.ndarray(max_lag + 1, n_params)
+        R-hat, effective sample size and autocorrelation. None if there are not yet
+        enough samples (two blocks and more than `2 * max_lag` samples per chain).
+    '''
+    n = min(trace.n for trace in traces)
+    n_half_blocks = min(trace.n_blocks for trace in traces) // 2
+    if n_half_blocks < 1 or n <= 2 * traces[0].max_lag:
+        return None
+
+    moments = [trace.half_moments(n_half_blocks) for trace in traces]
+    rhat = _rhat_from_moments(
+        np.concatenate([means for means, _ in moments]),
+        np.concatenate([variances for _, variances in moments]),
+        n_half_blocks * traces[0].block_size)
+
+    acov = np.stack([trace.autocovariance() for trace in traces])
+    ess = _ess_from_autocovariance(acov, np.stack([trace.mean() for trace in traces]), n)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        acorr = np.nanmean(acov / acov[:, :1], axis=0)
+    return rhat, ess, acorr
+
+
+class ChainMonitor(object):
+    '''Follow the trace of a (possibly running) chain on disk.
+
+    The chain is loaded once, for the names of the taxa, the burn-in and the location
+    of its trace file. Each poll then only reads the rows of the HDF5 trace written
+    since the previous poll.
+
+    Parameters
+    ----------
+    chain_path : str
+        Location of the `md2.BaseMCMC` chain
+    section : str
+        'posterior' to skip the burn-in samples, 'entire' to use every sample
+    max_lag, block_size : int
+        See `StreamingTrace`
+    '''
+    def __init__(self, chain_path, section='posterior', max_lag=50, block_size=100):
+        self.chain_path = chain_path
+        self.section = section
+        self.max_lag = max_lag
+        self.block_size = block_size
+        self.n_read = 0
+        self.n_total = None
+        self.taxa = None
+        self.traces = None
+        self.trace_path = None
+        self.datasets = None
+        self.burnin = 0
+
+    @property
+    def finished(self):
+        return self.n_total is not None and self.n_read >= self.n_total
+
+    def poll(self):
+        '''Add the samples written to disk since the last poll. Returns the number of
+        new samples.
+        '''
+        import h5py
+
+        if self.trace_path is None:
+            if not os.path.isfile(self.chain_path):
+                return 0
+            mcmc = md2.BaseMCMC.load(self.chain_path)
+            self.taxa = [taxon.name for taxon in mcmc.graph.data.taxa]
+            self.trace_path = mcmc.tracer.filename
+            self.datasets = {group: mcmc.graph[node].name for group, node in _GROUP_NODES.items()}
+            self.burnin = getattr(mcmc, 'burnin', 0) if self.section == 'posterior' else 0
+            self.n_total = getattr(mcmc, 'n_samples', None)
+            n_taxa = len(self.taxa)
+            n_params = {'growth': n_taxa, 'self_interaction': n_taxa,
+                'interaction_indicator': n_taxa * (n_taxa - 1)}
+            self.traces = {group: StreamingTrace(n_params[group], max_lag=self.max_lag,
+                block_size=self.block_size) for group in _GROUP_NODES}
+
+        with h5py.File(self.trace_path, 'r', libver='latest') as f:
+            length = checkpointed_length(f)
+            if length is None:
+                length = min(f[name].shape[0] for name in self.datasets.values())
+            if length <= self.n_read:
+                return 0
+
+            # Only the rows written since the last poll (and after the burn-in) are read
+            start = max(self.n_read, self.burnin)
+            new = {}
+            if start < length:
+                new = {group: f[name][start:length] for group, name in self.datasets.items()}
+        if len(new) > 0:
+            new['interaction_indicator'] = interaction_indicators(new['interaction_indicator'])
+        for group, samples in new.items():
+            self.traces[group].update(samples)
+        n_new = length - self.n_read
+        self.n_read = length
+        return n_new
+
+
+def follow(monitors, basepath, interval=300, rhat_threshold=1.1, min_ess=None):
+    '''Poll the chains until they finish, or until they converge if `min_ess` is given,
+    rewriting the diagnostic tables after every checkpoint.
+    '''
+    while True:
+        n_new = 0
+        for monitor in monitors:
+            try:
+                n_new += monitor.poll()
+            except (OSError, EOFError) as e:
+                # The chain is being written to, try again on the next poll
+                logger.info('Could not read {} ({}), retrying later'.format(monitor.chain_path, e))
+
+        if n_new > 0 and all(monitor.traces is not None for monitor in monitors):
+            results = {}
+            for group in monitors[0].traces:
+                summary = streaming_summary([monitor.traces[group] for monitor in monitors])
+                if summary is not None:
+                    results[group] = summary
+            if len(results) > 0:
+                max_lag = monitors[0].max_lag
+                table, acorr_table = _tables(results, monitors[0].taxa, max_lag)
+                table.to_csv(os.path.join(basepath, 'diagnostics.tsv'), sep='\t', index=False)
+                acorr_table.to_csv(os.path.join(basepath, 'autocorrelation.tsv'), sep='\t')
+                logger.info('Gibbs steps read: {}'.format(
+                    ', '.join(str(monitor.n_read) for monitor in monitors)))
+                log_summary(table, rhat_threshold=rhat_threshold)
+
+                if min_ess is not None and len(results) == len(monitors[0].traces) and \
+                        (table['Rhat'] <= rhat_threshold).all() and \
+                        (table['ESS'].fillna(np.inf) >= min_ess).all():
+                    logger.info('Converged')
+                    return True
+
+        if all(monitor.finished for monitor in monitors):
+            return False
+        time.sleep(interval)
+
+
+def log_summary(table, rhat_threshold=1.1):
+    for group, df in table.groupby('Group', sort=False):
+        n_bad = int((df['Rhat'] > rhat_threshold).sum())
+        logger.info('{}: max R-hat {:.3f}, {}/{} parameters above {}, min ESS {:.0f}'.format(
+            group, np.nanmax(df['Rhat']), n_bad, len(df), rhat_threshold, np.nanmin(df['ESS'])))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(usage=__doc__)
+    parser.add_argument('--chains', '-c', type=str, dest='chains', nargs='+', required=True,
+        help='Locations of the `md2.BaseMCMC` chains run on the same dataset')
+    parser.add_argument('--section', '-s', type=str, dest='section', default='posterior',
+        help='Section of the traces to use')
+    parser.add_argument('--max-lag', type=int, dest='max_lag', default=50,
+        help='Largest lag of the autocorrelation')
+    parser.add_argument('--rhat-threshold', type=float, dest='rhat_threshold', default=1.1,
+        help='R-hat above which a parameter is reported as not converged')
+    parser.add_argument('--output-basepath', '-o', type=str, dest='basepath', required=True,
+        help='Folder to save the diagnostics in')
+    parser.add_argument('--follow', action='store_true', dest='follow',
+        help='Follow the checkpoints of running chains until they finish')
+    parser.add_argument('--interval', type=float, dest='interval', default=300,
+        help='Seconds between two polls of the chains (with `--follow`)')
+    parser.add_argument('--block-size', type=int, dest='block_size', default=100,
+        help='Number of samples per block of the split R-hat (with `--follow`). Use ' \
+             'the `--checkpoint` of the inference')
+    parser.add_argument('--min-ess', type=float, dest='min_ess', default=None,
+        help='Stop following once every ESS is above this and every R-hat is below ' \
+             '`--rhat-threshold` (with `--follow`)')
+    args = parser.parse_args()
+    os.makedirs(args.basepath, exist_ok=True)
+
+    if args.follow:
+        monitors = [ChainMonitor(chain, section=args.section, max_lag=args.max_lag,
+            block_size=args.block_size) for chain in args.chains]
+        follow(monitors, args.basepath, interval=args.interval,
+            rhat_threshold=args.rhat_threshold, min_ess=args.min_ess)
+    else:
+        chain_traces = []
+        taxa = None
+        for chain in args.chains:
+            logger.info('Loading {}'.format(chain))
+            traces, chain_taxa = load_traces(chain, section=args.section)
+            if taxa is not None and chain_taxa != taxa:
+                raise ValueError('Chain `{}` was not run on the same taxa as `{}`'.format(
+                    chain, args.chains[0]))
+            taxa = chain_taxa
+            chain_traces.append(traces)
+
+        table, acorr_table = diagnostics_table(chain_traces, taxa, max_lag=args.max_lag)
+        table.to_csv(os.path.join(args.basepath, 'diagnostics.tsv'), sep='\t', index=False)
+        acorr_table.to_csv(os.path.join(args.basepath, 'autocorrelation.tsv'), sep='\t')
+        log_summary(table, rhat_threshold=args.rhat_threshold)
@@ -0,0 +1,210 @@
+'''Diversity of the samples of one or more studies.
+
+The samples of every subject (one per timepoint) are stacked into a single
+(n_samples, n_taxa) matrix in one preallocated pass (`sample_matrix`).
+
+`alpha_diversity` computes the alpha diversity indices of all of the samples
+of such a matrix at once, and `alpha_diversity_table` lays them out by subject
+and time.
+
+`BetaDiversity` holds the Bray-Curtis dissimilarities of such a matrix. They
+are computed blockwise and vectorized (the memory used at once is bounded by
+`max_elements`), only once, and are shared by the principal coordinates
+analysis (PCoA, cached as well) and PERMANOVA. New samples can be added
+without recomputing the dissimilarities between the existing ones. skbio (slow
+to import) is only imported when the PCoA or PERMANOVA is computed.
+'''
+import numpy as np
+import pandas as pd
+
+import study_matrices
+
+
+def sample_matrix(subjects, dtype='raw'):
+    '''Stack the samples of all of the subjects into one matrix.
+
+    Parameters
+    ----------
+    subjects : iterable(md2.Subject)
+        The subjects. Their samples are stacked in order (subject, then time).
+    dtype : str
+        Which matrix of the subjects to use (e.g. 'raw' (reads), 'rel', 'abs')
+
+    Returns
+    -------
+    np.ndarray(n_samples, n_taxa)
+        The samples
+    list((md2.Subject, float))
+        The subject and the time of each sample
+    '''
+    subjects = list(subjects)
+    matrices = [getattr(study_matrices.subject_matrices(subj), dtype) for subj in subjects]  # (n_taxa, n_times)
+    data = np.empty((sum(m.shape[1] for m in matrices), matrices[0].shape[0]))
+    samples = []
+    for subj, m in zip(subjects, matrices):
+        data[len(samples):len(samples) + m.shape[1]] = m.T
+        samples += [(subj, t) for t in subj.times]
+    return data, samples
+
+
+def alpha_diversity(counts):
+    '''Alpha diversity indices of every sample (row) at once.
+
+    Parameters
+    ----------
+    counts : np.ndarray(n_samples, n_taxa)
+        The samples (e.g. read counts)
+
+    Returns
+    -------
+    dict (str) -> np.ndarray(n_samples)
+        'richness': Number of taxa that are present
+        'entropy': Shannon entropy (nats) of the relative abundances
+        'normalized_entropy': Entropy divided by the log of the richness (same as
+            `md2.diversity.alpha.normalized_entropy`)
+        'simpson': Gini-Simpson index (1 - sum of the squared relative abundances)
+    '''
+    counts = np.asarray(counts, dtype=float)
+    richness = np.count_nonzero(counts > 0, axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rel = counts / counts.sum(axis=1, keepdims=True)
+        entropy = -np.sum(np.where(rel > 0, rel * np.log(np.where(rel > 0, rel, 1)), 0), axis=1)
+        return {
+            'richness': richness,
+            'entropy': entropy,
+            'normalized_entropy': entropy / np.log(richness),
+            'simpson': 1 - np.sum(rel ** 2, axis=1)}
+
+
+def alpha_diversity_table(subjects, dtype='raw'):
+    '''Alpha diversity indices (`alpha_diversity`) of every sample of the subjects.
+
+    Parameters
+    ----------
+    subjects : iterable(md2.Subject)
+    dtype : str
+        Which matrix of the subjects to use (see `sample_matrix`)
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per sample with the columns 'subject', 'time' and one column
+        per index. E.g. `table.pivot(index='time', columns='subject',
+        values='normalized_entropy')` is the (time x subject) matrix of an index.
+    '''
+    data, samples = sample_matrix(subjects, dtype=dtype)
+    table = pd.DataFrame({
+        'subject': [subj.name for subj, _ in samples],
+        'time': [t for _, t in samples]})
+    for index, values in alpha_diversity(data).items():
+        table[index] = values
+    return table
+
+
+def braycurtis(x, y=None, max_elements=2 ** 24):
+    '''Bray-Curtis dissimilarity between every row of `x` and every row of `y`.
+
+        d(u, v) = sum(|u - v|) / sum(u + v) = 1 - 2 * sum(min(u, v)) / sum(u + v)
+
+    Parameters
+    ----------
+    x : np.ndarray(n, n_taxa)
+    y : np.ndarray(m, n_taxa), None
+        If None, the (symmetric) dissimilarities between the rows of `x`
+    max_elements : int
+        Maximum number of elements of the intermediate arrays
+
+    Returns
+    -------
+    np.ndarray(n, m)
+    '''
+    x = np.asarray(x, dtype=float)
+    symmetric = y is None
+    y = x if symmetric else np.asarray(y, dtype=float)
+    x_totals = x.sum(axis=1)
+    y_totals = y.sum(axis=1)
+
+    dist = np.empty((x.shape[0], y.shape[0]))
+    block_size = max(1, max_elements // max(1, y.shape[0] * x.shape[1]))
+    for start in range(0, x.shape[0], block_size):
+        end = min(start + block_size, x.shape[0])
+        # Only the upper triangle is computed for the symmetric case
+        first = start if symmetric else 0
+        shared = np.minimum(x[start:end, None, :], y[None, first:, :]).sum(axis=2)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            block = 1 - 2 * shared / (x_totals[start:end, None] + y_totals[None, first:])
+        dist[start:end, first:] = block
+        if symmetric:
+            dist[first:, start:end] = block.T
+    if symmetric:
+        np.fill_diagonal(dist, 0)
+    return dist
+
+
+class BetaDiversity(object):
+    '''Bray-Curtis beta diversity of a set of samples.
+
+    Parameters
+    ----------
+    counts : np.ndarray(n_samples, n_taxa)
+        The samples (e.g. read counts)
+    ids : list(str)
+        Unique name of each sample
+    max_elements : int
+        Maximum number of elements of the intermediate arrays of `braycurtis`
+    '''
+
+    def __init__(self, counts, ids, max_elements=2 ** 24):
+        self.max_elements = max_elements
+        self.counts = np.asarray(counts, dtype=float)
+        self.ids = list(ids)
+        if len(self.ids) != self.counts.shape[0]:
+            raise ValueError('There are {} ids for {} samples'.format(len(self.ids),
+                self.counts.shape[0]))
+        self.distances = braycurtis(self.counts, max_elements=max_elements)
+        self._distance_matrix = None
+        self._pcoa = None
+
+    def add_samples(self, counts, ids):
+        '''Add samples. Only their dissimilarities to the existing samples and
+        to each other are computed.'''
+        counts = np.atleast_2d(np.asarray(counts, dtype=float))
+        ids = list(ids)
+        if len(ids) != counts.shape[0]:
+            raise ValueError('There are {} ids for {} samples'.format(len(ids),
+                counts.shape[0]))
+
+        n = len(self.ids)
+        distances = np.empty((n + len(ids), n + len(ids)))
+        distances[:n, :n] = self.distances
+        distances[n:, :n] = braycurtis(counts, self.counts, max_elements=self.max_elements)
+        distances[:n, n:] = distances[n:, :n].T
+        distances[n:, n:] = braycurtis(counts, max_elements=self.max_elements)
+
+        self.counts = np.vstack((self.counts, counts))
+        self.ids += ids
+        self.distances = distances
+        self._distance_matrix = None
+        self._pcoa = None
+
+    @property
+    def distance_matrix(self):
+        '''The dissimilarities as a `skbio.DistanceMatrix`'''
+        if self._distance_matrix is None:
+            import skbio.stats.distance
+            self._distance_matrix = skbio.stats.distance.DistanceMatrix(self.distances, self.ids)
+        return self._distance_matrix
+
+    def pcoa(self):
+        '''Principal coordinates analysis of the dissimilarities
+        (`skbio.OrdinationResults`)'''
+        if self._pcoa is None:
+            import skbio.stats.ordination
+            self._pcoa = skbio.stats.ordination.pcoa(self.distance_matrix)
+        return self._pcoa
+
+    def permanova(self, grouping, permutations=999):
+        '''PERMANOVA test of the groups of the samples (one label per sample)'''
+        import skbio.stats.distance
+        return skbio.stats.distance.permanova(distance_matrix=self.distance_matrix,
+            grouping=grouping, permutations=permutations)
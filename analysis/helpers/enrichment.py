@@ -3,7 +3,6 @@ import mdsine2 as md2
 import pandas as pd
 import pickle
 import math
-import copy
 import os
 import matplotlib.pyplot as plt
 from matplotlib.gridspec import GridSpec
@@ -11,7 +10,6 @@ import seaborn as sns
 import matplotlib.colors as colors
 
 from matplotlib.colors import LogNorm
-from scipy.special import comb
 from scipy.stats import hypergeom
 from statsmodels.stats import multitest as mtest
 from mdsine2.names import STRNAMES
@@ -21,20 +19,70 @@ def compute_p_value(N, M, n, k):
     '''computes and returns the hypergeometric p-values
        @Parameters
        ------------------------------------------------------------------
-       N, M, n, k: (int)
+       N, M, n, k: (int or np.ndarray) total number of OTUs, number of OTUs
+           annotated with the taxonomy, number of OTUs in the cluster and number
+           of annotated OTUs in the cluster
 
        @returns
         ------------------------------------------------------------------------
-       float
+       float or np.ndarray, P(X >= k)
     '''
-    lim = min(n, M)
-    p = 0
-    for i in range(k, lim + 1):
-        p += comb(M, i) * comb(N - M, n - i) / comb(N, n)
+    return hypergeom.sf(np.asarray(k) - 1, N, M, n)
 
-    p1 = hypergeom.sf(k-1, N, M, n) #to check the accuracy of p
+def membership_matrix(labels):
+    """returns the sorted unique labels and the (n_labels x n_items) 0/1
+       matrix of which item has which label
 
-    return p
+    @parameters
+    labels : ([int] or [str]) the label of each item
+    """
+
+    groups, inverse = np.unique(np.asarray(labels), return_inverse=True)
+    matrix = np.zeros((len(groups), len(inverse)), dtype=int)
+    matrix[inverse, np.arange(len(inverse))] = 1
+    return groups, matrix
+
+def hypergeom_enrichment(cluster_labels, taxonomy_labels):
+    """runs the hypergeometric test for every (cluster, taxonomy) pair at once
+
+    @parameters
+    cluster_labels : ([int]) the cluster of each OTU
+    taxonomy_labels : ([str]) the taxonomy of each OTU
+
+    @returns
+    clusters : (np.ndarray) sorted cluster labels
+    taxonomies : (np.ndarray) sorted taxonomy names
+    counts : (np.ndarray(n_clusters, n_taxonomies)) number of OTUs of each taxonomy
+        in each cluster
+    p_values : (np.ndarray(n_clusters, n_taxonomies)) p-values, NaN for the pairs
+        that are not tested (no OTU of the taxonomy in the cluster)
+    """
+
+    clusters, cluster_matrix = membership_matrix(cluster_labels)
+    taxonomies, taxonomy_matrix = membership_matrix(taxonomy_labels)
+    counts = cluster_matrix @ taxonomy_matrix.T
+
+    total_otus = len(cluster_labels)
+    n_otus_cluster = cluster_matrix.sum(axis=1)
+    n_otus_annotated = taxonomy_matrix.sum(axis=1)
+    p_values = compute_p_value(total_otus, n_otus_annotated[None, :],
+        n_otus_cluster[:, None], counts)
+    p_values = np.where(counts > 0, p_values, np.nan)
+
+    return clusters, taxonomies, counts, p_values
+
+def adjust_p_values(p_values, alpha=0.05):
+    """applies the Benjamini-Hochberg correction to all of the tested (not NaN)
+       p-values at once and returns whether each is rejected and the adjusted
+       p-values (NaN where not tested)"""
+
+    tested = ~np.isnan(p_values)
+    reject = np.zeros(p_values.shape, dtype=bool)
+    adjusted = np.full(p_values.shape, np.nan)
+    if np.any(tested):
+        reject[tested], adjusted[tested] = mtest.multipletests(p_values[tested],
+            alpha=alpha, method="fdr_bh", is_sorted=False)[:2]
+    return reject, adjusted
 
 def obtain_p_vals(cluster_dict, hierarchy_otu_dict):
     """runs the hypergeometric test for taxonomy ranks in the interaction modules
@@ -46,26 +94,21 @@ def obtain_p_vals(cluster_dict, hierarchy_otu_dict):
            OTUs in the cluster
        """
 
-    total_otus = sum([len(cluster_dict[id_]) for id_ in cluster_dict])
+    otu_cluster = {otu: id_ for id_ in cluster_dict for otu in cluster_dict[id_]}
+    otu_level = {otu: level for level in hierarchy_otu_dict
+        for otu in hierarchy_otu_dict[level]}
+    otus = list(otu_cluster.keys())
+    cluster_ids = sorted(cluster_dict.keys())
+    clusters, levels, _, p_values = hypergeom_enrichment(
+        [cluster_ids.index(otu_cluster[otu]) for otu in otus],
+        [otu_level[otu] for otu in otus])
 
     cluster_all_p ={}
     cluster_all_level = {}
-    for id_ in sorted(cluster_dict.keys()):
-        #print("id:", id_)
-        otus_li = cluster_dict[id_]
-        cluster_all_p[id_] = []
-        cluster_all_level[id_] = []
-        n_otus_cluster = len(otus_li)
-
-        for level in hierarchy_otu_dict:
-            level_li = hierarchy_otu_dict[level]
-            n_otus_annotated = len(level_li)
-            n_otus_annotated_cluster = len(set(otus_li).intersection(level_li))
-            if n_otus_annotated_cluster != 0 :
-                p_val = compute_p_value(total_otus, n_otus_annotated,
-                    n_otus_cluster, n_otus_annotated_cluster)
-                cluster_all_p[id_].append(p_val)
-                cluster_all_level[id_].append(level)
+    for i, id_ in enumerate(cluster_ids):
+        tested = ~np.isnan(p_values[i])
+        cluster_all_p[id_] = list(p_values[i, tested])
+        cluster_all_level[id_] = list(levels[tested])
 
     return cluster_all_p, cluster_all_level
 
@@ -157,31 +200,49 @@ def format_df(df, n_cluster):
 
     return new_df
 
+def consensus_enrichment(mcmc, level):
+    """runs the hypergeometric test between the consensus clusters and the
+       taxonomies at the given rank (level) of the OTUs in the mcmc file"""
+
+    clustering = mcmc.graph[STRNAMES.CLUSTERING].clustering
+    labels = clustering.toarray()
+    taxonomy_labels = [str(taxa.taxonomy[level]) for taxa in mcmc.graph.data.taxa]
+    return hypergeom_enrichment(labels, taxonomy_labels)
+
 def pivot_cluster_membership(mcmc, level):
     """creates a table(data frame) that summarizes the number of OTUS in
        each interaction module at the given taxonomy rank(level)"""
 
-    taxas = mcmc.graph.data.taxa
-    level_otu_map = map_level_to_otu(taxas, level)
-    cluster_dict = parse_cluster(mcmc)
+    clusters, levels, counts, _ = consensus_enrichment(mcmc, level)
 
-    data = []
     index = []
-    for level in sorted(level_otu_map.keys()):
+    for level in levels:
         name_li = level.split("_")
         if len(name_li) != 1:
             name_li = name_li[:-1]
-        new_name = " ".join(name_li)
+        index.append(" ".join(name_li))
+
+    columns = ["{}".format(i) for i in range(1, len(clusters) +1)]
+    df = pd.DataFrame(counts.T, index=index, columns=columns)
+
+    return df
 
-        index.append(new_name)
-        level_info_row = []
-        for id_ in sorted(cluster_dict.keys()):
-            level_info_row.append(len(set(cluster_dict[id_]).intersection(
-                level_otu_map[level])))
-        data.append(level_info_row)
+def enrichment_p_values(mcmc, hierarchy_level):
+    """runs the enrichment analysis at the given taxonomy rank (hierarchy_level)
+        and returns the BH adjusted p-values of the enriched (cluster, taxonomy)
+        pairs as a data frame (taxonomy x cluster). Only the taxonomies and the
+        clusters with at least one enrichment are kept, the other pairs are 1."""
+
+    clusters, levels, _, p_values = consensus_enrichment(mcmc, hierarchy_level)
+    if np.all(np.isnan(p_values)):
+        print("There are no valid p values ")
+    reject, adjusted = adjust_p_values(p_values)
 
-    columns = ["{}".format(i) for i in range(1, len(cluster_dict) +1)]
-    df = pd.DataFrame(np.asarray(data), index=index, columns=columns)
+    df = pd.DataFrame(np.where(reject, adjusted, np.nan).T, index=levels,
+        columns=["Cluster " + str(id_ + 1) for id_ in clusters])
+    df = df.loc[reject.any(axis=0), reject.any(axis=1)].fillna(1)
+    df.index.name = "module_name"
+    df.columns.name = "cluster_id"
 
     return df
 
@@ -190,46 +251,199 @@ def run_enrichment_level(mcmc, hierarchy_level, pivot_name):
     """runs the enrichment analysis at the given taxonomy rank (hierarchy_level)
         and returns the results as a data frame"""
 
-    cluster_dict = parse_cluster(mcmc)
-    taxas = mcmc.graph.data.taxa
-    level_otu_map = map_level_to_otu(taxas, hierarchy_level)
+    n_clusters = len(np.unique(mcmc.graph[STRNAMES.CLUSTERING].clustering.toarray()))
+    return format_df(enrichment_p_values(mcmc, hierarchy_level), n_clusters)
+
+def cocluster_labels(coclusters):
+    """returns the cluster assignment of every Gibbs sample from the co-cluster
+       trace. Co-clustering is an equivalence relation, so each OTU is labeled
+       by the index of the first OTU it is clustered with
+
+    @parameters
+    coclusters : (np.ndarray(n_samples, n_otus, n_otus)) 1 if two OTUs are in the
+        same cluster in the sample, else 0
+
+    @returns
+    np.ndarray(n_samples, n_otus) : the cluster label of each OTU in each sample
+    """
+
+    return np.argmax(np.asarray(coclusters) > 0.5, axis=-1)
 
-    p_values, p_module_info = obtain_p_vals(cluster_dict, level_otu_map)
+def posterior_cocluster_labels(mcmc, n_samples=1000, block_size=100):
+    """returns the cluster assignment (as in cocluster_labels) of (evenly spaced)
+       n_samples Gibbs samples of the posterior of mcmc. Only those samples of the
+       co-cluster trace are read from the trace file, block_size at a time
 
-    all_p_li = []
-    all_p_info_li = []
+    @parameters
+    mcmc : (md2.BaseMCMC) an inference with a learned clustering
+    n_samples : (int) number of Gibbs samples. If None, all of them
+    block_size : (int) number of Gibbs samples read at once
+
+    @returns
+    np.ndarray(n_samples, n_otus) : the cluster label of each OTU in each sample
+    """
 
-    for keys in sorted(p_values.keys()):
-        all_p_li = all_p_li + p_values[keys]
-        modules_cluster = []
-        for key2 in p_module_info[keys]:
-            modules_cluster.append("Cluster " + str(keys) + " " + key2)
-        all_p_info_li = all_p_info_li + modules_cluster
+    import h5py
+
+    coclusters = mcmc.graph[STRNAMES.CLUSTERING_OBJ].coclusters
+    with h5py.File(mcmc.tracer.filename, "r", libver="latest") as f:
+        dset = f[coclusters.name]
+        end = int(dset.attrs.get("end_iter", dset.shape[0]))
+        rows = np.arange(mcmc.burnin, end)
+        if n_samples is not None and n_samples < len(rows):
+            rows = rows[np.unique(np.round(np.linspace(0, len(rows) - 1,
+                n_samples)).astype(int))]
+        return np.concatenate([cocluster_labels(dset[rows[i:i + block_size]])
+            for i in range(0, len(rows), block_size)])
+
+def _bh_reject(p_values, alpha=0.05):
+    """applies the Benjamini-Hochberg correction separately to the tested
+       (not NaN) p-values of every row and returns which are rejected"""
+
+    n_tested = np.sum(~np.isnan(p_values), axis=1)
+    sorted_p = np.sort(p_values, axis=1)
+    ranks = np.arange(1, p_values.shape[1] + 1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        below = sorted_p <= ranks[None, :] * alpha / n_tested[:, None]
+    any_below = below.any(axis=1)
+    last = p_values.shape[1] - 1 - np.argmax(below[:, ::-1], axis=1)
+    threshold = np.where(any_below, sorted_p[np.arange(len(last)), last], -np.inf)
+    with np.errstate(invalid="ignore"):
+        return p_values <= threshold[:, None]
+
+def batched_enrichment(labels, taxonomy_index, n_taxonomies, alpha=0.05):
+    """runs the hypergeometric test and the BH correction of every Gibbs sample
+       in the batch at once
 
-    adjusted_p = []
+    @parameters
+    labels : (np.ndarray(n_samples, n_otus)) the cluster label (in [0, n_otus))
+        of each OTU in each sample
+    taxonomy_index : (np.ndarray(n_otus)) the taxonomy (in [0, n_taxonomies)) of
+        each OTU
+    n_taxonomies : (int) number of taxonomies
+
+    @returns
+    np.ndarray(n_samples, n_otus, n_taxonomies) : whether the cluster labeled i
+        in the sample is enriched for the taxonomy
+    """
+
+    n_samples, n_otus = labels.shape
+    slots = labels + n_otus * np.arange(n_samples)[:, None]
+    counts = np.bincount((slots * n_taxonomies + taxonomy_index[None, :]).ravel(),
+        minlength=n_samples * n_otus * n_taxonomies).reshape(n_samples, n_otus,
+        n_taxonomies)
+    n_otus_cluster = np.bincount(slots.ravel(), minlength=n_samples * n_otus).reshape(
+        n_samples, n_otus)
+    n_otus_annotated = np.bincount(taxonomy_index, minlength=n_taxonomies)
+
+    p_values = compute_p_value(n_otus, n_otus_annotated[None, None, :],
+        n_otus_cluster[:, :, None], counts)
+    p_values = np.where(counts > 0, p_values, np.nan)
+    reject = _bh_reject(p_values.reshape(n_samples, -1), alpha)
+    return reject.reshape(n_samples, n_otus, n_taxonomies)
+
+def _posterior_enrichment_batch(labels, taxonomy_index, n_taxonomies, alpha):
+    """number of samples in the batch in which each OTU is in a cluster enriched
+       for each taxonomy, and in which each taxonomy is enriched at all"""
+
+    reject = batched_enrichment(labels, taxonomy_index, n_taxonomies, alpha)
+    otu_enriched = np.take_along_axis(reject, labels[:, :, None], axis=1)
+    return otu_enriched.sum(axis=0), reject.any(axis=1).sum(axis=0)
+
+def posterior_enrichment(coclusters, taxonomy_labels, consensus_labels, alpha=0.05,
+    n_workers=1, batch_size=500):
+    """runs the enrichment analysis on every Gibbs sample of the clustering and
+       summarizes how often each consensus module is enriched for each taxonomy
+       (see posterior_enrichment_labels)
+
+    @parameters
+    coclusters : (np.ndarray(n_samples, n_otus, n_otus)) co-cluster trace
+    """
 
-    if len(all_p_li) != 0:
-        adjusted_p = mtest.multipletests(copy.deepcopy(all_p_li), alpha=0.05,
-            method="fdr_bh", is_sorted=False)
+    return posterior_enrichment_labels(cocluster_labels(coclusters), taxonomy_labels,
+        consensus_labels, alpha=alpha, n_workers=n_workers, batch_size=batch_size)
+
+def posterior_enrichment_labels(labels, taxonomy_labels, consensus_labels, alpha=0.05,
+    n_workers=1, batch_size=500):
+    """runs the enrichment analysis on every Gibbs sample of the clustering and
+       summarizes how often each consensus module is enriched for each taxonomy
+
+    @parameters
+    labels : (np.ndarray(n_samples, n_otus)) the cluster label of each OTU in
+        each Gibbs sample (see cocluster_labels)
+    taxonomy_labels : ([str]) the taxonomy of each OTU
+    consensus_labels : ([int]) the consensus module of each OTU
+    n_workers : (int) number of processes the batches are split between
+    batch_size : (int) number of Gibbs samples tested at once
+
+    @returns
+    clusters : (np.ndarray) sorted consensus module labels
+    taxonomies : (np.ndarray) sorted taxonomy names
+    module_probs : (np.ndarray(n_clusters, n_taxonomies)) posterior probability
+        that an OTU of the module is in a cluster enriched for the taxonomy
+    taxonomy_probs : (np.ndarray(n_taxonomies)) posterior probability that the
+        taxonomy is enriched in at least one cluster
+    """
+
+    taxonomies, taxonomy_index = np.unique(np.asarray(taxonomy_labels),
+        return_inverse=True)
+    clusters, cluster_matrix = membership_matrix(consensus_labels)
+    batches = [labels[i:i + batch_size] for i in range(0, len(labels), batch_size)]
+    args = (taxonomy_index, len(taxonomies), alpha)
+
+    if n_workers > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            results = list(executor.map(_posterior_enrichment_batch, batches,
+                *[[arg] * len(batches) for arg in args]))
     else:
-        print("There are no valid p values ")
+        results = [_posterior_enrichment_batch(batch, *args) for batch in batches]
 
-    pivoted_df = pivot_df(all_p_li, all_p_info_li, adjusted_p[1], adjusted_p[0],
-        pivot_name)
-    formatted_df = format_df(pivoted_df, len(cluster_dict))
+    otu_probs = sum(res[0] for res in results) / len(labels)
+    taxonomy_probs = sum(res[1] for res in results) / len(labels)
+    module_probs = (cluster_matrix @ otu_probs) / cluster_matrix.sum(axis=1)[:, None]
+    return clusters, taxonomies, module_probs, taxonomy_probs
 
-    df_copy = copy.deepcopy(pivoted_df)
-    index = np.sort([int(idx.split()[1]) for idx in df_copy.columns])
-    index = ["Cluster " + str(i) for i in index]
-    df_save = df_copy[index]
-    #export_df(cluster_dict, level_otu_map, all_p_li, all_p_info_li,
-        #adjusted_p[1], pivot_name)
+def posterior_enrichment_level(mcmc, hierarchy_level, consensus_mcmc=None,
+    n_samples=1000, alpha=0.05, n_workers=1, labels=None):
+    """runs the enrichment analysis at the given taxonomy rank (hierarchy_level)
+       over (evenly spaced) n_samples Gibbs samples of the clustering in mcmc and
+       returns the posterior probabilities of enrichment of the consensus modules
+       as a data frame (taxonomy x module). The last column is the probability
+       that the taxonomy is enriched in any cluster.
+
+    @parameters
+    mcmc : (md2.BaseMCMC) an inference with a learned clustering
+    consensus_mcmc : (md2.BaseMCMC) the modules are the clustering of this
+        inference (e.g. the fixed clustering run). If None, the consensus
+        clustering of mcmc
+    n_samples : (int) number of Gibbs samples tested. If None, all of them
+    labels : (np.ndarray(n_samples, n_otus)) the output of
+        posterior_cocluster_labels(mcmc, n_samples). They do not depend on the
+        level, so pass them when testing several levels. If None, they are read
+    """
 
-    #loc = "gibson_inference/figures/output_figures/p_supplemental_figure5_"
-    #os.makedirs("{}".format(loc), exist_ok=True)
-    #df_save.to_csv("{}/p_test_{}.csv".format(loc, pivot_name), sep=",")
+    if labels is None:
+        labels = posterior_cocluster_labels(mcmc, n_samples=n_samples)
 
-    return formatted_df
+    if consensus_mcmc is None:
+        consensus = md2.util.generate_cluster_assignments_posthoc(
+            clustering=mcmc.graph[STRNAMES.CLUSTERING].clustering, set_as_value=True)
+    else:
+        if [taxa.name for taxa in consensus_mcmc.graph.data.taxa] != \
+            [taxa.name for taxa in mcmc.graph.data.taxa]:
+            raise ValueError("The two inferences are not on the same OTUs")
+        consensus = consensus_mcmc.graph[STRNAMES.CLUSTERING].clustering.toarray()
+
+    taxonomy_labels = [str(taxa.taxonomy[hierarchy_level]) for taxa in mcmc.graph.data.taxa]
+    clusters, levels, module_probs, taxonomy_probs = posterior_enrichment_labels(labels,
+        taxonomy_labels, consensus, alpha=alpha, n_workers=n_workers)
+
+    df = pd.DataFrame(module_probs.T, index=levels,
+        columns=["Cluster " + str(i + 1) for i in range(len(clusters))])
+    df["Any cluster"] = taxonomy_probs
+    df.index.name = "module_name"
+    return df
 
 def save_dfs(df_results, df_names, loc):
 
@@ -0,0 +1,117 @@
+'''Sweep the parameters of the consistency filtering.
+
+`md2.consistency_filtering` keeps the taxa that are at or above `threshold` for
+at least `min_num_consecutive` consecutive timepoints (at or after
+`colonization_time`) in at least `min_num_subjects` subjects. Evaluating it for
+every point of a parameter grid rescans the whole study each time.
+
+`ConsistencySweep` instead computes, once per colonization time, the longest
+run of consecutive timepoints at or above each threshold of every taxon in every
+subject, in one vectorized pass over the matrices of the subjects. The number of
+taxa that survive any (threshold, min_num_consecutive, min_num_subjects,
+colonization_time) combination is then read off that table.
+'''
+import numpy as np
+
+import study_matrices
+
+
+def max_run_lengths(matrix, thresholds):
+    '''Longest run of consecutive columns at or above each threshold.
+
+    Parameters
+    ----------
+    matrix : np.ndarray(n_taxa, n_times)
+    thresholds : np.ndarray(n_thresholds)
+
+    Returns
+    -------
+    np.ndarray(n_thresholds, n_taxa), int
+    '''
+    matrix = np.asarray(matrix)
+    thresholds = np.asarray(thresholds)
+    if matrix.shape[1] == 0:
+        return np.zeros((len(thresholds), matrix.shape[0]), dtype=int)
+    above = matrix[None, :, :] >= thresholds[:, None, None]
+    positions = np.arange(matrix.shape[1])
+    # Position of the last timepoint below the threshold, at or before each timepoint
+    last_below = np.maximum.accumulate(np.where(above, -1, positions), axis=2)
+    return np.max(positions - last_below, axis=2)
+
+
+class ConsistencySweep(object):
+    '''Number of taxa that survive the consistency filtering of a study over a
+    grid of parameters.
+
+    Parameters
+    ----------
+    study : md2.Study
+    dtype : str
+        The matrix that is filtered ('raw', 'rel' or 'abs')
+    '''
+
+    def __init__(self, study, dtype='rel'):
+        self.taxa = study.taxa
+        self.subject_names = [subj.name for subj in study]
+        self.matrices = [getattr(study_matrices.subject_matrices(subj), dtype) for subj in study]
+        self.times = [np.asarray(subj.times) for subj in study]
+        self._runs = {}
+
+    def run_lengths(self, thresholds, colonization_time=0):
+        '''Longest run of consecutive timepoints at or after `colonization_time`
+        at or above each threshold, of every taxon in every subject.
+
+        Returns
+        -------
+        np.ndarray(n_thresholds, n_subjects, n_taxa), int
+        '''
+        thresholds = np.asarray(thresholds, dtype=float)
+        key = (colonization_time, thresholds.tobytes())
+        if key not in self._runs:
+            self._runs[key] = np.stack([
+                max_run_lengths(matrix[:, times >= colonization_time], thresholds)
+                for matrix, times in zip(self.matrices, self.times)], axis=1)
+        return self._runs[key]
+
+    def n_taxa_remaining(self, thresholds, min_num_consecutive, min_num_subjects,
+        colonization_time=0):
+        '''Number of taxa that are kept by `md2.consistency_filtering` for every
+        combination of the parameters.
+
+        Parameters
+        ----------
+        thresholds : array_like(n_thresholds)
+        min_num_consecutive : array_like(n_consecutive), int
+        min_num_subjects : array_like(n_subjects), int
+        colonization_time : float
+
+        Returns
+        -------
+        np.ndarray(n_thresholds, n_consecutive, n_subjects), int
+        '''
+        runs = self.run_lengths(thresholds, colonization_time)
+        min_num_consecutive = np.atleast_1d(min_num_consecutive)
+        min_num_subjects = np.atleast_1d(min_num_subjects)
+
+        # Number of subjects in which each taxon passes (threshold, consecutive)
+        n_passing = np.sum(runs[:, None, :, :] >= min_num_consecutive[None, :, None, None],
+            axis=2)
+        return np.sum(n_passing[..., None] >= min_num_subjects, axis=2)
+
+    def sweep(self, thresholds, min_num_consecutive, min_num_subjects, colonization_times):
+        '''`n_taxa_remaining` for several colonization times.
+
+        Returns
+        -------
+        np.ndarray(n_colonization_times, n_thresholds, n_consecutive, n_subjects), int
+        '''
+        return np.stack([self.n_taxa_remaining(thresholds, min_num_consecutive,
+            min_num_subjects, colonization_time=col_time)
+            for col_time in colonization_times])
+
+    def remaining_taxa(self, threshold, min_num_consecutive, min_num_subjects,
+        colonization_time=0):
+        '''Names of the taxa that are kept for a single combination of the parameters.'''
+        runs = self.run_lengths([threshold], colonization_time)[0]
+        keep = np.sum(runs >= min_num_consecutive, axis=0) >= min_num_subjects
+        return [taxon.name for taxon, kept in zip(self.taxa, keep) if kept]
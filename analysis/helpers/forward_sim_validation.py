@@ -41,6 +41,8 @@ import numpy as np
 import pickle
 import time
 
+import study_matrices
+
 def forward_simulate(growth, interactions, perturbations, 
     dt, subject, start, n_days, limit_of_detection, full_pred, studyname, 
     basepath, sim_max=None, save_intermediate_times=False):
@@ -91,7 +93,7 @@ def forward_simulate(growth, interactions, perturbations,
         Basepath to save in
     '''
     times = subject.times
-    M = subject.matrix()['abs']
+    M = study_matrices.subject_matrices(subject).abs
 
     # Get the times and data within the time frame specified
     # ------------------------------------------------------
@@ -140,7 +142,7 @@ def forward_simulate(growth, interactions, perturbations,
         times = times[startidx:endidx]
         M = M[:, startidx:endidx]
 
-    initial_conditions = M[:, 0]
+    initial_conditions = M[:, 0].copy()
     if np.any(initial_conditions == 0):
         logger.info('{} taxa have a 0 abundance at time {}. Setting to {}'.format(
             np.sum(initial_conditions == 0), start, limit_of_detection))
@@ -267,7 +269,7 @@ if __name__ == '__main__':
         'are doing many time look ahead predictions at various timepoints')
     
     args = parser.parse_args()
-    study = md2.Study.load(args.validation)
+    study = study_matrices.load_study(args.validation)
     save_intermediate_times = bool(args.save_intermediate_times)
     os.makedirs(args.basepath, exist_ok=True)
 
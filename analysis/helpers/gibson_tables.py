@@ -0,0 +1,290 @@
+'''Load the tables of the Gibson dataset (`datasets/gibson`) once.
+
+`md2.dataset.load_gibson` reads and parses every TSV of the dataset (the read
+counts of ~1500 ASVs in ~720 samples, the qPCR, the metadata, the perturbations
+and both taxonomy tables) each time it is called, and it is called for every
+dataset (healthy, uc, replicates, inoculum).
+
+`load_tables` parses the TSVs once into typed arrays:
+
+    - the read counts as an integer (n_asvs, n_samples) matrix,
+    - the sample and subject ids of the metadata as categoricals,
+    - the qPCR triplicates as a float (n_samples, 3) matrix,
+
+and the studies of the datasets are all built from that single load with
+`GibsonTables.study`.
+
+The parsed tables are cached as Parquet files in `cache_dir`, one per TSV, each
+tagged with the sha256 checksum of the TSV it was parsed from. The TSVs are
+only parsed again if their checksum no longer matches (or the cache is missing):
+
+    <cache_dir>/counts.parquet
+    <cache_dir>/metadata.parquet
+    ...
+'''
+import hashlib
+import os
+
+import mdsine2 as md2
+from mdsine2.logger import logger
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+TABLES = ['counts', 'metadata', 'perturbations', 'qpcr', 'rdp_species', 'silva_species']
+
+# Subjects of each dataset
+DSET_SUBJECTS = {
+    'healthy': ['2', '3', '4', '5'],
+    'uc': ['6', '7', '8', '9', '10'],
+    'replicates': ['M2-D8', 'M2-D9', 'M2-D10'],
+    'inoculum': ['Healthy', 'Ulcerative Colitis']}
+
+_CHECKSUM_KEY = b'sha256'
+_CHUNK_SIZE = 1 << 20
+
+
+def _sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _parse_tsv(table, path):
+    '''Parse a TSV of the dataset into a typed DataFrame.'''
+    if table == 'counts':
+        df = pd.read_csv(path, sep='\t', index_col=0)
+        df.index = df.index.astype(str)
+        df.index.name = 'name'
+        return df.astype(np.int64)
+    if table == 'metadata':
+        return pd.read_csv(path, sep='\t',
+            dtype={'sampleID': 'category', 'subject': 'category', 'time': float})
+    if table == 'qpcr':
+        df = pd.read_csv(path, sep='\t', dtype={'sampleID': 'category'})
+        measurements = [col for col in df.columns if col != 'sampleID']
+        df[measurements] = df[measurements].astype(float)
+        return df
+    if table == 'perturbations':
+        return pd.read_csv(path, sep='\t',
+            dtype={'name': 'category', 'start': float, 'end': float, 'subject': 'category'})
+    # Taxonomy tables
+    df = pd.read_csv(path, sep='\t', dtype=str, keep_default_na=False, na_values=['NA'])
+    df.columns = [col.lower() for col in df.columns]
+    return df.set_index('name')
+
+
+def _read_cached(path, checksum):
+    if not os.path.isfile(path):
+        return None
+    try:
+        table = pq.read_table(path)
+    except (OSError, pa.ArrowException):
+        return None
+    metadata = table.schema.metadata or {}
+    if metadata.get(_CHECKSUM_KEY, b'').decode() != checksum:
+        return None
+    return table.to_pandas()
+
+
+def _write_cached(df, path, checksum):
+    table = pa.Table.from_pandas(df)
+    metadata = dict(table.schema.metadata or {})
+    metadata[_CHECKSUM_KEY] = checksum.encode()
+    table = table.replace_schema_metadata(metadata)
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        pq.write_table(table, tmp)
+        os.replace(tmp, path)
+    except OSError:
+        # The cache is only an optimization
+        logger.warning('Could not cache the parsed table in {}'.format(path))
+
+
+def merge_species(rdp, silva, max_n_species):
+    '''Species assignment of a taxon from both the RDP and SILVA assignments.
+
+    The species of both assignments (each can be several, separated by '/') are
+    combined. If there are more than `max_n_species` of them the species is
+    left unassigned (NaN).
+
+    Parameters
+    ----------
+    rdp, silva : str, float
+        Species assigned by RDP and SILVA. NaN if unassigned.
+    max_n_species : int
+
+    Returns
+    -------
+    str, float
+    '''
+    species = []
+    for assignment in [rdp, silva]:
+        if isinstance(assignment, str):
+            for s in assignment.split('/'):
+                if s not in species:
+                    species.append(s)
+    if len(species) == 0 or len(species) > max_n_species:
+        return np.nan
+    return '/'.join(species)
+
+
+class GibsonTables(object):
+    '''The parsed tables of the Gibson dataset.
+
+    Attributes
+    ----------
+    asv_names : np.ndarray(n_asvs), str
+    sample_ids : pd.Categorical(n_samples)
+        Samples of the columns of `counts`
+    counts : np.ndarray(n_asvs, n_samples), int
+        Read counts
+    metadata : pd.DataFrame
+        Columns: 'sampleID' (categorical), 'subject' (categorical), 'time' (float)
+    qpcr_sample_ids : pd.Categorical(n_qpcr)
+    qpcr : np.ndarray(n_qpcr, n_replicates), float
+        qPCR measurements of each sample in `qpcr_sample_ids`
+    perturbations : pd.DataFrame
+        Columns: 'name', 'start', 'end', 'subject'
+    taxonomy : dict (str) -> pd.DataFrame
+        Taxonomy table of the 'rdp' and 'silva' assignments, indexed by the
+        name of the ASV
+    '''
+    def __init__(self, tables):
+        counts = tables['counts']
+        self.asv_names = counts.index.to_numpy(dtype=str)
+        self.sample_ids = pd.Categorical(counts.columns.astype(str))
+        self.counts = counts.to_numpy(dtype=np.int64)
+        self.metadata = tables['metadata']
+        qpcr = tables['qpcr']
+        self.qpcr_sample_ids = pd.Categorical(qpcr['sampleID'])
+        self.qpcr = qpcr.drop(columns='sampleID').to_numpy(dtype=float)
+        self._qpcr_columns = [col for col in qpcr.columns if col != 'sampleID']
+        self.perturbations = tables['perturbations']
+        self.taxonomy = {'rdp': tables['rdp_species'], 'silva': tables['silva_species']}
+
+    @property
+    def sequences(self):
+        '''dict (str) -> str: the sequence of each ASV'''
+        return dict(self.taxonomy['rdp']['sequence'])
+
+    def taxonomy_table(self, species_assignment='both', max_n_species=2):
+        '''Taxonomy table of the ASVs (as `md2.dataset.load_gibson`).
+
+        Parameters
+        ----------
+        species_assignment : str
+            'rdp', 'silva' or 'both' (the species of both are combined with
+            `merge_species`)
+        max_n_species : int
+            Maximum number of species in a combined assignment
+
+        Returns
+        -------
+        pd.DataFrame
+            Index: name of the ASV. Columns: 'sequence' and the taxonomic levels
+        '''
+        if species_assignment in self.taxonomy:
+            return self.taxonomy[species_assignment].copy()
+        if species_assignment != 'both':
+            raise ValueError('`species_assignment` ({}) not recognized'.format(
+                species_assignment))
+        df = self.taxonomy['rdp'].copy()
+        silva = self.taxonomy['silva']['species'].reindex(df.index)
+        df['species'] = [merge_species(rdp, silva_, max_n_species)
+            for rdp, silva_ in zip(df['species'], silva)]
+        return df
+
+    def dataframes(self, dset):
+        '''The tables of the samples of dataset `dset`, as DataFrames.
+
+        Returns
+        -------
+        dict (str) -> pd.DataFrame
+            'metadata', 'reads', 'qpcr' and 'perturbations' (None if the
+            subjects of the dataset have no perturbations)
+        '''
+        if dset not in DSET_SUBJECTS:
+            raise ValueError('`dset` ({}) not recognized. Options: {}'.format(
+                dset, list(DSET_SUBJECTS)))
+        subjects = DSET_SUBJECTS[dset]
+
+        metadata = self.metadata[self.metadata['subject'].isin(subjects)]
+        samples = metadata['sampleID'].astype(str).to_numpy()
+        sidx = pd.Index(self.sample_ids).get_indexer(samples)
+        if np.any(sidx < 0):
+            raise ValueError('Samples {} have no read counts'.format(samples[sidx < 0]))
+        reads = pd.DataFrame(self.counts[:, sidx], index=self.asv_names, columns=samples)
+        reads.index.name = 'name'
+
+        qidx = pd.Index(self.qpcr_sample_ids).get_indexer(samples)
+        if np.any(qidx < 0):
+            raise ValueError('Samples {} have no qPCR'.format(samples[qidx < 0]))
+        qpcr = pd.DataFrame(self.qpcr[qidx], index=pd.Index(samples, name='sampleID'),
+            columns=self._qpcr_columns)
+
+        perturbations = self.perturbations[self.perturbations['subject'].isin(subjects)]
+        if len(perturbations) == 0:
+            perturbations = None
+        else:
+            perturbations = perturbations.astype({'name': str, 'subject': str}).reset_index(
+                drop=True)
+
+        metadata = metadata.astype({'sampleID': str, 'subject': str}).set_index('sampleID')
+        return {'metadata': metadata, 'reads': reads, 'qpcr': qpcr,
+            'perturbations': perturbations}
+
+    def study(self, dset, species_assignment='both', max_n_species=2):
+        '''Build the study of dataset `dset` ('healthy', 'uc', 'replicates' or
+        'inoculum'), as `md2.dataset.load_gibson(dset=dset, ...)`.
+
+        Returns
+        -------
+        md2.Study
+        '''
+        dfs = self.dataframes(dset)
+        taxa = md2.TaxaSet(taxonomy_table=self.taxonomy_table(
+            species_assignment=species_assignment, max_n_species=max_n_species))
+        study = md2.Study(taxa=taxa, name=dset)
+        study.parse(metadata=dfs['metadata'], reads=dfs['reads'], qpcr=dfs['qpcr'],
+            perturbations=dfs['perturbations'])
+        return study
+
+
+def load_tables(dataset_dir, cache_dir=None):
+    '''Parse the tables of the Gibson dataset, or read them from the cache.
+
+    Parameters
+    ----------
+    dataset_dir : str
+        Folder with the TSVs (`counts.tsv`, `metadata.tsv`, ...)
+    cache_dir : str, None
+        Folder of the Parquet cache. If None, `<dataset_dir>/.cache`.
+
+    Returns
+    -------
+    GibsonTables
+    '''
+    if cache_dir is None:
+        cache_dir = os.path.join(dataset_dir, '.cache')
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+    except OSError:
+        logger.warning('Could not make the cache folder {}'.format(cache_dir))
+
+    tables = {}
+    for table in TABLES:
+        path = os.path.join(dataset_dir, table + '.tsv')
+        cache_path = os.path.join(cache_dir, table + '.parquet')
+        checksum = _sha256(path)
+        df = _read_cached(cache_path, checksum)
+        if df is None:
+            logger.info('Parsing {}'.format(path))
+            df = _parse_tsv(table, path)
+            if os.path.isdir(cache_dir):
+                _write_cached(df, cache_path, checksum)
+        tables[table] = df
+    return GibsonTables(tables)
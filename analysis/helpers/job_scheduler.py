@@ -0,0 +1,457 @@
+'''Run a DAG of shell-command tasks, either on an LSF cluster or on the local machine.
+
+A `JobGraph` holds `Task`s, each of which is a shell command with the names of the
+tasks it depends on and the files it produces. The graph is run by a backend:
+
+    `LSFBackend`
+        Renders an LSF script for every task and submits it with `bsub`, the way the
+        ErisOne scripts always have. Dependencies are passed to LSF (`#BSUB -w done(...)`)
+        so that the whole graph can be submitted at once.
+    `LocalBackend`
+        Runs the tasks as subprocesses on the local machine with at most `max_workers`
+        running at once. A task is started as soon as its dependencies finish.
+
+With both backends, tasks that fail (or that do not produce their outputs) are
+retried up to `max_retries` times. On LSF the retries happen inside the job, so
+the job only finishes successfully (and its dependents only start) once the
+command succeeded and all of its outputs exist.
+
+A task is complete if all of its outputs exist (or, if it declares no outputs, if it
+finished successfully in a previous run with the same command). Complete tasks are
+skipped, so rerunning a graph only runs what is missing, and what depends on it: a
+task is rerun whenever one of its dependencies is, even if its outputs exist.
+
+Example
+-------
+>>> graph = JobGraph(state_dir='jobs/')
+>>> graph.add(Task('infer', 'mdsine2 infer ...', outputs=['out/mcmc.pkl']))
+>>> graph.add(Task('to-numpy', 'python analysis/helpers/convert_trace_to_numpy.py ...',
+...     dependencies=['infer'], outputs=['out/numpy_trace/growth.npy']))
+>>> graph.run(LocalBackend(max_workers=4))
+'''
+import os
+import shlex
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from mdsine2.logger import logger
+
+lsfstr = '''#!/bin/bash
+#BSUB -J {jobname}
+#BSUB -o {stdout_loc}
+#BSUB -e {stderr_loc}
+
+#BSUB -q {queue}
+#BSUB -n {cpus}
+#BSUB -M {mem}
+#BSUB -R rusage[mem={mem}]
+{bsub_options}
+#
+echo '---PROCESS RESOURCE LIMITS---'
+ulimit -a
+echo '---SHARED LIBRARY PATH---'
+echo $LD_LIBRARY_PATH
+echo '---APPLICATION SEARCH PATH:---'
+echo $PATH
+echo '---LSF Parameters:---'
+printenv | grep '^LSF'
+echo '---LSB Parameters:---'
+printenv | grep '^LSB'
+echo '---LOADED MODULES:---'
+module list
+echo '---SHELL:---'
+echo $SHELL
+echo '---HOSTNAME:---'
+hostname
+echo '---GROUP MEMBERSHIP (files are created in the first group listed):---'
+groups
+echo '---DEFAULT FILE PERMISSIONS (UMASK):---'
+umask
+echo '---CURRENT WORKING DIRECTORY:---'
+pwd
+echo '---DISK SPACE QUOTA---'
+df .
+echo '---TEMPORARY SCRATCH FOLDER ($TMPDIR):---'
+echo $TMPDIR
+
+
+# Load the environment
+{setup}
+source activate {environment_name}
+cd {code_basepath}
+
+# Run the command (up to {attempts} times, until it succeeds and makes its outputs)
+for attempt in $(seq 1 {attempts}); do
+    (
+set -e
+{command}
+    )
+    status=$?
+    if [ $status -eq 0 ] && {outputs_check}; then
+{done_marker_script}
+        exit 0
+    fi
+    echo "Attempt $attempt/{attempts} failed (exit code $status, or missing outputs)" >&2
+done
+exit 1
+'''
+
+# Delimiter of the here-document that writes the command into the completion marker
+_MARKER_EOF = 'MDSINE2_JOB_SCHEDULER_COMMAND_EOF'
+
+
+class Task(object):
+    '''A shell command in a `JobGraph`.
+
+    Parameters
+    ----------
+    name : str
+        Unique name of the task. This is also the LSF job name.
+    command : str
+        Shell command(s) to run
+    dependencies : list(str), None
+        Names of the tasks that must finish before this one starts
+    outputs : list(str), None
+        Files this task produces. The task is complete when all of them exist.
+    queue, cpus, memory : str, None
+        LSF resources. If None, the defaults of the `LSFBackend` are used.
+    bsub_options : list(str), None
+        Additional `#BSUB` lines (without the `#BSUB` prefix), e.g. `['-g /gibson/keystoneness']`
+    '''
+    def __init__(self, name, command, dependencies=None, outputs=None, queue=None,
+        cpus=None, memory=None, bsub_options=None):
+        self.name = name
+        self.command = command
+        self.dependencies = list(dependencies) if dependencies is not None else []
+        self.outputs = list(outputs) if outputs is not None else []
+        self.queue = queue
+        self.cpus = cpus
+        self.memory = memory
+        self.bsub_options = list(bsub_options) if bsub_options is not None else []
+
+    def __repr__(self):
+        return 'Task({})'.format(self.name)
+
+    def outputs_exist(self):
+        return all(os.path.exists(path) for path in self.outputs)
+
+
+class JobGraph(object):
+    '''A DAG of `Task`s.
+
+    Parameters
+    ----------
+    state_dir : str
+        Folder in which the completion markers of the tasks are written
+    '''
+    def __init__(self, state_dir='job_state/'):
+        self.state_dir = state_dir
+        self.tasks = {}
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def __iter__(self):
+        return iter(self.topological_order())
+
+    def add(self, task):
+        '''Add a task. Its dependencies must already be in the graph.'''
+        if task.name in self.tasks:
+            raise ValueError('Task `{}` already in the graph'.format(task.name))
+        for dep in task.dependencies:
+            if dep not in self.tasks:
+                raise ValueError('Dependency `{}` of `{}` is not in the graph'.format(dep, task.name))
+        self.tasks[task.name] = task
+        return task
+
+    def topological_order(self):
+        '''Tasks are added after their dependencies, so insertion order is topological.'''
+        return list(self.tasks.values())
+
+    def done_marker(self, task):
+        return os.path.join(self.state_dir, task.name + '.done')
+
+    def done_marker_script(self, task):
+        '''Shell commands that write the completion marker of the task: the time it
+        finished, then its command. Both backends write the marker with it.
+        '''
+        return '{{ date \'+%Y-%m-%d %H:%M:%S\'; cat <<\'{eof}\'\n{command}\n{eof}\n}} > {path}'.format(
+            eof=_MARKER_EOF, command=task.command,
+            path=shlex.quote(os.path.abspath(self.done_marker(task))))
+
+    def is_complete(self, task):
+        '''A task with outputs is complete if they all exist. A task without outputs is
+        complete if it finished before with the same command (its marker was written
+        by `done_marker_script`).
+        '''
+        if task.outputs:
+            return task.outputs_exist()
+        if not os.path.exists(self.done_marker(task)):
+            return False
+        with open(self.done_marker(task), 'r') as f:
+            f.readline()
+            return f.read() == task.command + '\n'
+
+    def mark_complete(self, task):
+        '''Write the same marker as `done_marker_script`.'''
+        os.makedirs(self.state_dir, exist_ok=True)
+        with open(self.done_marker(task), 'w') as f:
+            f.write(time.strftime('%Y-%m-%d %H:%M:%S') + '\n')
+            f.write(task.command + '\n')
+
+    def clear_complete(self, task):
+        if os.path.exists(self.done_marker(task)):
+            os.remove(self.done_marker(task))
+
+    def out_of_date(self):
+        '''Names of the tasks that must run: the incomplete ones and every task that
+        depends on one of them, directly or not.
+        '''
+        stale = set()
+        for task in self.topological_order():
+            if any(dep in stale for dep in task.dependencies) or not self.is_complete(task):
+                stale.add(task.name)
+        return stale
+
+    def run(self, backend):
+        '''Run the graph with the backend. Returns the names of the tasks that failed.'''
+        return backend.run(self)
+
+
+class LocalBackend(object):
+    '''Run the tasks as subprocesses on this machine.
+
+    Parameters
+    ----------
+    max_workers : int
+        Maximum number of tasks running at once
+    max_retries : int
+        Number of times a task is rerun after it fails
+    log_basepath : str
+        Folder for the stdout/stderr of each task
+    cwd : str, None
+        Working directory of the commands. If None, the current directory.
+
+    Attributes
+    ----------
+    timings : dict(str -> (float, float))
+        Wall-clock start and end time of every task that finished in the last run
+    '''
+    def __init__(self, max_workers=1, max_retries=1, log_basepath='job_logs/', cwd=None):
+        if max_workers < 1:
+            raise ValueError('`max_workers` ({}) must be at least 1'.format(max_workers))
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.log_basepath = log_basepath
+        self.cwd = cwd
+        self.timings = {}
+
+    def _run_task(self, graph, task):
+        os.makedirs(self.log_basepath, exist_ok=True)
+        stdout_loc = os.path.join(self.log_basepath, task.name + '.out')
+        stderr_loc = os.path.join(self.log_basepath, task.name + '.err')
+        first_start_time = time.time()
+        for attempt in range(1 + self.max_retries):
+            start_time = time.time()
+            with open(stdout_loc, 'a') as stdout, open(stderr_loc, 'a') as stderr:
+                ret = subprocess.run('set -e\n' + task.command, shell=True, cwd=self.cwd,
+                    stdout=stdout, stderr=stderr, executable='/bin/bash')
+            if ret.returncode == 0 and task.outputs_exist():
+                graph.mark_complete(task)
+                self.timings[task.name] = (first_start_time, time.time())
+                logger.info('[{}] finished in {:.1f}s'.format(task.name, time.time() - start_time))
+                return True
+            if ret.returncode != 0:
+                logger.warning('[{}] failed with exit code {} (attempt {}/{}). See {}'.format(
+                    task.name, ret.returncode, attempt + 1, 1 + self.max_retries, stderr_loc))
+            else:
+                logger.warning('[{}] is missing outputs {} (attempt {}/{})'.format(
+                    task.name, [p for p in task.outputs if not os.path.exists(p)],
+                    attempt + 1, 1 + self.max_retries))
+        return False
+
+    def run(self, graph):
+        pending = {}
+        finished = set()
+        failed = set()
+        stale = graph.out_of_date()
+        for task in graph.topological_order():
+            if task.name not in stale:
+                logger.info('[{}] complete, skipping'.format(task.name))
+                finished.add(task.name)
+            else:
+                pending[task.name] = task
+
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                # Drop the tasks whose dependencies failed, start the ones that are ready.
+                for name, task in list(pending.items()):
+                    if any(dep in failed for dep in task.dependencies):
+                        logger.warning('[{}] skipped because a dependency failed'.format(name))
+                        failed.add(name)
+                        pending.pop(name)
+                    elif all(dep in finished for dep in task.dependencies) and \
+                            len(running) < self.max_workers:
+                        logger.info('[{}] starting'.format(name))
+                        graph.clear_complete(task)
+                        running[executor.submit(self._run_task, graph, task)] = name
+                        pending.pop(name)
+                if not running:
+                    continue
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    if future.result():
+                        finished.add(name)
+                    else:
+                        failed.add(name)
+
+        if failed:
+            logger.warning('{} task(s) failed: {}'.format(len(failed), sorted(failed)))
+        return sorted(failed)
+
+
+class LSFBackend(object):
+    '''Render an LSF script for every task and submit it with `bsub`.
+
+    Parameters
+    ----------
+    lsf_basepath : str
+        Folder where the scripts, stdout and stderr are written
+    environment_name : str
+        Name of the conda environment to activate when the job starts
+    code_basepath : str
+        Folder to `cd` into before running the command
+    queue, cpus, memory : str
+        Default resources of a task
+    setup : str
+        Shell lines run before activating the environment (e.g. `module load anaconda/4.8.2`)
+    max_retries : int
+        Number of times the command is rerun inside the job after it fails (or does
+        not make its outputs). The job exits with an error if every attempt fails.
+    '''
+    def __init__(self, lsf_basepath, environment_name, code_basepath, queue, cpus,
+        memory, setup='#module load anaconda/4.8.2', max_retries=1):
+        self.lsf_basepath = lsf_basepath
+        self.environment_name = environment_name
+        self.code_basepath = code_basepath
+        self.queue = queue
+        self.cpus = cpus
+        self.memory = memory
+        self.setup = setup
+        self.max_retries = max_retries
+
+    def run(self, graph):
+        script_path = os.path.join(self.lsf_basepath, 'scripts')
+        stdout_loc = os.path.join(self.lsf_basepath, 'stdout')
+        stderr_loc = os.path.join(self.lsf_basepath, 'stderr')
+        os.makedirs(script_path, exist_ok=True)
+        os.makedirs(stdout_loc, exist_ok=True)
+        os.makedirs(stderr_loc, exist_ok=True)
+
+        submitted = set()
+        failed = []
+        stale = graph.out_of_date()
+        for task in graph.topological_order():
+            if task.name not in stale:
+                logger.info('[{}] complete, skipping'.format(task.name))
+                continue
+            if any(dep in failed for dep in task.dependencies):
+                logger.warning('[{}] not submitted because a dependency was not submitted'.format(task.name))
+                failed.append(task.name)
+                continue
+
+            # Only wait on the dependencies submitted in this run; the others are complete.
+            bsub_options = list(task.bsub_options)
+            waits = [dep for dep in task.dependencies if dep in submitted]
+            if waits:
+                bsub_options.append('-w "{}"'.format(
+                    ' && '.join('done({})'.format(dep) for dep in waits)))
+
+            graph.clear_complete(task)
+            lsfname = os.path.join(script_path, task.name + '.lsf')
+            f = open(lsfname, 'w')
+            f.write(lsfstr.format(
+                jobname=task.name,
+                stdout_loc=os.path.join(stdout_loc, task.name + '.out'),
+                stderr_loc=os.path.join(stderr_loc, task.name + '.err'),
+                queue=task.queue if task.queue is not None else self.queue,
+                cpus=task.cpus if task.cpus is not None else self.cpus,
+                mem=task.memory if task.memory is not None else self.memory,
+                bsub_options='\n'.join('#BSUB ' + opt for opt in bsub_options),
+                setup=self.setup, environment_name=self.environment_name,
+                code_basepath=self.code_basepath, command=task.command,
+                attempts=1 + self.max_retries,
+                outputs_check=' && '.join(['true'] + ['[ -e {} ]'.format(shlex.quote(path))
+                    for path in task.outputs]),
+                done_marker_script=graph.done_marker_script(task)))
+            f.close()
+            os.makedirs(graph.state_dir, exist_ok=True)
+
+            command = 'bsub < {}'.format(lsfname)
+            print(command)
+            if os.system(command) == 0:
+                submitted.add(task.name)
+            else:
+                failed.append(task.name)
+        return failed
+
+
+def add_backend_args(parser, resources=True):
+    '''Add the arguments for choosing and configuring the backend to an argparse parser.
+    The ErisOne arguments are the ones the LSF scripts have always taken. If `resources`
+    is False, the script defines its own queue/memory/cpu arguments.
+    '''
+    parser.add_argument('--backend', type=str, dest='backend', choices=['lsf', 'local'],
+        help='Submit the jobs to LSF or run them on this machine', default='lsf')
+    parser.add_argument('--max-workers', type=int, dest='max_workers',
+        help='Maximum number of jobs running at once (local backend)', default=1)
+    parser.add_argument('--max-retries', type=int, dest='max_retries',
+        help='Number of times a failed job (or one that does not make its outputs) is '
+             'rerun. On LSF it is rerun inside the same job.', default=1)
+    parser.add_argument('--job-state-basepath', type=str, dest='job_state_basepath',
+        help='Folder where the completion markers of the jobs are saved. Default: '
+             '`{lsf-basepath}/state`', default=None)
+
+    # ErisOne parameters
+    parser.add_argument('--environment-name', dest='environment_name', type=str,
+        help='Name of the conda environment to activate when the job starts')
+    parser.add_argument('--code-basepath', type=str, dest='code_basepath',
+        help='Where the `run_cross_validation` script is located')
+    if resources:
+        parser.add_argument('--queue', '-q', type=str, dest='queue',
+            help='ErisOne queue this job gets submitted to')
+        parser.add_argument('--memory', '-mem', type=str, dest='memory',
+            help='Amount of memory to reserve on ErisOne')
+        parser.add_argument('--n-cpus', '-cpus', type=str, dest='cpus',
+            help='Number of cpus to reserve on ErisOne')
+    parser.add_argument('--lsf-basepath', '-l', type=str, dest='lsf_basepath',
+        help='This is the basepath to save the lsf files', default='lsf_files/')
+    return parser
+
+
+def make_backend(args, lsf_basepath=None, setup='#module load anaconda/4.8.2'):
+    '''Make the backend from the arguments added by `add_backend_args`.'''
+    if lsf_basepath is None:
+        lsf_basepath = args.lsf_basepath
+    if args.backend == 'local':
+        return LocalBackend(max_workers=args.max_workers, max_retries=args.max_retries,
+            log_basepath=os.path.join(lsf_basepath, 'local_logs'),
+            cwd=args.code_basepath)
+    return LSFBackend(lsf_basepath=lsf_basepath, environment_name=args.environment_name,
+        code_basepath=args.code_basepath, queue=getattr(args, 'queue', None),
+        cpus=getattr(args, 'cpus', None), memory=getattr(args, 'memory', None), setup=setup,
+        max_retries=args.max_retries)
+
+
+def make_graph(args, lsf_basepath=None):
+    '''Make an empty graph whose completion markers are saved where `args` says.'''
+    state_dir = args.job_state_basepath
+    if state_dir is None:
+        if lsf_basepath is None:
+            lsf_basepath = args.lsf_basepath
+        state_dir = os.path.join(lsf_basepath, 'state')
+    return JobGraph(state_dir=state_dir)
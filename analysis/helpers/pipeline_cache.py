@@ -0,0 +1,294 @@
+'''Run a pipeline stage only if it is out of date.
+
+A stage is a single command (e.g. `mdsine2 infer ...`) together with the files it
+reads and the files it writes. The stage is fingerprinted from
+
+    - the command and all of its arguments (so changing `--burnin` or a prior reruns it),
+    - the content of every input file. Any argument of the command that is an existing
+      file is an input (e.g. `--input`, `--negbin`, the python script being run), as
+      are the local modules that a python script imports (e.g. `helpers/steady_state.py`),
+      and extra inputs can be given with `--inputs`,
+    - the version of MDSINE2 that is installed.
+
+After the command finishes, the fingerprint and a digest of every output are written
+to the cache folder. The next time the stage is called it is skipped if the
+fingerprint is unchanged and all of the outputs still exist with the recorded
+content. Otherwise the command is run again. Files are only rehashed when their size
+or modification time changes, so checking an up-to-date multi-GB chain is cheap.
+
+Outputs can be files or folders (e.g. the `posterior` folder made by
+`mdsine2 visualize-posterior`). Set the environment variable `PIPELINE_FORCE=1` (or
+pass `--force`) to rerun the stage regardless.
+
+This is called through the `stage` function in `gibson_inference/settings.sh`:
+
+    stage healthy-filter \
+        --outputs ${PREPROCESS_DIR}/gibson_healthy_agg_taxa_filtered.pkl \
+        -- \
+    mdsine2 filter \
+        --dataset ${PREPROCESS_DIR}/gibson_healthy_agg_taxa.pkl \
+        --outfile ${PREPROCESS_DIR}/gibson_healthy_agg_taxa_filtered.pkl \
+        ...
+'''
+import argparse
+import ast
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+
+import mdsine2 as md2
+from mdsine2.logger import logger
+
+_DIGEST_CACHE = 'file_digests.json'
+_CHUNK_SIZE = 1 << 20
+HELPERS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def _load_json(path, default):
+    if not os.path.isfile(path):
+        return default
+    with open(path, 'r') as f:
+        try:
+            return json.load(f)
+        except ValueError:
+            logger.warning('Could not read {}, ignoring it'.format(path))
+            return default
+
+
+def _save_json(obj, path):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(obj, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+
+class PipelineCache(object):
+    '''Fingerprints of the stages that have been run and the digests of the files
+    they touched.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Folder where the stage records and the file digest cache are written
+    '''
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(os.path.join(cache_dir, 'stages'), exist_ok=True)
+        self._digest_path = os.path.join(cache_dir, _DIGEST_CACHE)
+        self._digests = _load_json(self._digest_path, {})
+
+    def save(self):
+        _save_json(self._digests, self._digest_path)
+
+    def file_digest(self, path):
+        '''sha256 of the content of a file. The digest is reused if the size and
+        modification time of the file have not changed since it was last hashed.
+        '''
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        key = [st.st_size, st.st_mtime_ns]
+        cached = self._digests.get(path)
+        if cached is not None and cached['stat'] == key:
+            return cached['digest']
+
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(_CHUNK_SIZE), b''):
+                h.update(chunk)
+        digest = h.hexdigest()
+        self._digests[path] = {'stat': key, 'digest': digest}
+        return digest
+
+    def digest(self, path):
+        '''Digest of a file or of a folder (the relative paths and digests of every
+        file under it). Returns None if `path` does not exist.
+        '''
+        if os.path.isfile(path):
+            return self.file_digest(path)
+        if not os.path.isdir(path):
+            return None
+        h = hashlib.sha256()
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for fname in sorted(files):
+                fpath = os.path.join(root, fname)
+                h.update(os.path.relpath(fpath, path).encode())
+                h.update(self.file_digest(fpath).encode())
+        return h.hexdigest()
+
+    def record_path(self, stage):
+        return os.path.join(self.cache_dir, 'stages', stage + '.json')
+
+    def fingerprint(self, command, inputs):
+        '''Fingerprint of the command, the content of its inputs and the installed
+        MDSINE2 version.
+        '''
+        payload = {
+            'command': list(command),
+            'inputs': {path: self.digest(path) for path in sorted(inputs)},
+            'mdsine2': getattr(md2, '__version__', None)}
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+    def is_up_to_date(self, stage, fingerprint, outputs):
+        '''Returns the reason the stage must be rerun, or None if it is up to date.
+        '''
+        record = _load_json(self.record_path(stage), None)
+        if record is None:
+            return 'it has not been run yet'
+        if record['fingerprint'] != fingerprint:
+            return 'the command or its inputs changed'
+        for path in outputs:
+            digest = self.digest(path)
+            if digest is None:
+                return 'output `{}` is missing'.format(path)
+            if record['outputs'].get(path) != digest:
+                return 'output `{}` changed since the last run'.format(path)
+        return None
+
+    def record(self, stage, fingerprint, command, outputs):
+        _save_json({
+            'fingerprint': fingerprint,
+            'command': list(command),
+            'outputs': {path: self.digest(path) for path in outputs},
+            'time': time.strftime('%Y-%m-%d %H:%M:%S')}, self.record_path(stage))
+
+
+def local_imports(script, search_dirs=None):
+    '''Files of the local modules that a script imports, directly or through
+    other local modules.
+
+    Parameters
+    ----------
+    script : str
+    search_dirs : list(str), None
+        Folders of the local modules. If None, the folder of the script and
+        `analysis/helpers`.
+
+    Returns
+    -------
+    list(str)
+    '''
+    if search_dirs is None:
+        search_dirs = [os.path.dirname(os.path.abspath(script)), HELPERS_DIR]
+    found = set()
+    todo = [script]
+    while todo:
+        with open(todo.pop(), 'r') as f:
+            tree = ast.parse(f.read())
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+                names = [node.module]
+            else:
+                continue
+            for name in names:
+                for folder in search_dirs:
+                    path = os.path.join(folder, name.split('.')[0] + '.py')
+                    if os.path.isfile(path) and path not in found:
+                        found.add(path)
+                        todo.append(path)
+                        break
+    return sorted(os.path.relpath(path) for path in found)
+
+
+def implicit_inputs(command, outputs):
+    '''Arguments of the command that are existing files and are not one of the
+    outputs (or inside of an output folder), and the local modules imported by the
+    python scripts among them.
+    '''
+    outputs = [os.path.abspath(path) for path in outputs]
+    inputs = []
+    for arg in command:
+        if not os.path.isfile(arg):
+            continue
+        path = os.path.abspath(arg)
+        if any(path == out or path.startswith(out + os.sep) for out in outputs):
+            continue
+        inputs.append(arg)
+        if arg.endswith('.py'):
+            inputs.extend(local_imports(arg))
+    return inputs
+
+
+def run_stage(cache, stage, command, inputs=None, outputs=None, force=False):
+    '''Run `command` unless the stage is up to date.
+
+    Parameters
+    ----------
+    cache : PipelineCache
+    stage : str
+        Unique name of the stage
+    command : list(str)
+        Command to run
+    inputs : list(str)
+        Inputs in addition to the ones found in the arguments of the command
+    outputs : list(str)
+        Files/folders the command makes
+    force : bool
+        If True, run the command even if it is up to date
+
+    Returns
+    -------
+    int
+        Exit code of the command (0 if it was skipped)
+    '''
+    outputs = list(outputs or [])
+    inputs = sorted(set(list(inputs or []) + implicit_inputs(command, outputs)))
+    missing = [path for path in inputs if not os.path.exists(path)]
+    if len(missing) > 0:
+        logger.error('[{}] inputs do not exist: {}'.format(stage, missing))
+        return 1
+
+    fingerprint = cache.fingerprint(command, inputs)
+    reason = 'forced' if force else cache.is_up_to_date(stage, fingerprint, outputs)
+    cache.save()
+    if reason is None:
+        logger.info('[{}] up to date, skipping'.format(stage))
+        return 0
+
+    logger.info('[{}] running because {}'.format(stage, reason))
+    start_time = time.time()
+    ret = subprocess.run(command).returncode
+    if ret != 0:
+        logger.error('[{}] failed with exit code {}'.format(stage, ret))
+        return ret
+    missing = [path for path in outputs if not os.path.exists(path)]
+    if len(missing) > 0:
+        logger.error('[{}] finished but did not make {}'.format(stage, missing))
+        return 1
+
+    # Inputs are rehashed in case the command rewrote one of them in place
+    cache.record(stage, cache.fingerprint(command, inputs), command, outputs)
+    cache.save()
+    logger.info('[{}] finished in {:.1f}s'.format(stage, time.time() - start_time))
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(usage=__doc__)
+    parser.add_argument('--cache-dir', type=str, dest='cache_dir', required=True,
+        help='Folder to save the stage fingerprints in')
+    parser.add_argument('stage', type=str,
+        help='Name of the stage')
+    parser.add_argument('--inputs', type=str, dest='inputs', nargs='+', default=[],
+        help='Files/folders read by the command that are not one of its arguments')
+    parser.add_argument('--outputs', type=str, dest='outputs', nargs='+', default=[],
+        help='Files/folders made by the command')
+    parser.add_argument('--force', action='store_true', dest='force',
+        help='Run the command even if it is up to date')
+    argv = sys.argv[1:]
+    if '--' not in argv:
+        parser.error('The command must be given after `--`')
+    split = argv.index('--')
+    args = parser.parse_args(argv[:split])
+    command = argv[split+1:]
+    if len(command) == 0:
+        parser.error('No command given')
+    force = args.force or os.environ.get('PIPELINE_FORCE', '0') not in ('', '0')
+
+    sys.exit(run_stage(PipelineCache(args.cache_dir), args.stage, command,
+        inputs=args.inputs, outputs=args.outputs, force=force))
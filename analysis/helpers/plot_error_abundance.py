@@ -3,40 +3,24 @@
 #The difference being that it shows the results for MDSINE2 only.
 
 import numpy as np
-import matplotlib.pyplot as plt
 import os
-from scipy import stats
 import pickle as pkl
 import pandas as pd
-import seaborn as sns
 import matplotlib.gridspec as gridspec
-from statsmodels.stats import multitest
 
 import matplotlib.lines as mlines
 import argparse
-from matplotlib import rcParams
-from matplotlib import font_manager
 
-rcParams['pdf.fonttype'] = 42
-
-font_dirs = ['gibson_inference/figures/arial_fonts']
-font_files = font_manager.findSystemFonts(fontpaths=font_dirs)
-#print(font_files)
-
-for font_file in font_files:
-    #print(font_file)
-    ff = font_file.split("/")[-1]
-    if "._" not in ff:
-        font_manager.fontManager.addfont(font_file)
-
-# change font
-rcParams['font.family'] = 'Arial'
+import plot_setup
+plt = plot_setup.lazy_import('matplotlib.pyplot')
+sns = plot_setup.lazy_import('seaborn')
+multitest = plot_setup.lazy_import('statsmodels.stats.multitest')
 
 REL_ORDER = ["MDSINE2"]
 ABS_ORDER = ["MDSINE2"]
 
-HEX_REL = sns.color_palette("tab10").as_hex()
-HEX_ABS = sns.color_palette("tab10").as_hex()
+HEX_REL = plot_setup.TAB10_HEX
+HEX_ABS = plot_setup.TAB10_HEX
 
 PAL_REL = {"MDSINE2":HEX_REL[0]}
 PAL_ABS = {"MDSINE2":HEX_REL[0]}
@@ -290,6 +274,7 @@ def alternative_plot(data_df, title1, title2, use_log, bar_df, type_, axes1,
 
 def main():
 
+    plot_setup.use_arial_fonts()
     print("Making Supplemental Figure 4")
     healthy_subjs = ["2", "3", "4", "5"]
     uc_subjs = ["6", "7", "8", "9", "10"]
@@ -354,4 +339,5 @@ def main():
         dpi=800)
     print("Done Making Supplemental Figure 4")
 
-main()
+if __name__ == "__main__":
+    main()
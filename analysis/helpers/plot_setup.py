@@ -0,0 +1,115 @@
+'''Plot settings shared by the figure scripts.
+
+`use_arial_fonts` registers the Arial fonts of `gibson_inference/figures/arial_fonts`
+with matplotlib and makes them the default (with TrueType fonts embedded in
+PDFs). It is called by the plotting entry points (e.g. the `main` of a figure
+script) instead of at import, so that importing a figure module for its
+computational helpers does not pay for it. It only does the work once per
+process, and the font properties that matplotlib parses from the font files are
+kept in a cache file (in the matplotlib cache folder) so that the files are
+only parsed again when they change.
+
+`lazy_import` returns a module that is only imported when one of its
+attributes is first used. The figure modules use it for the libraries that are
+slow to import (seaborn, statsmodels, skbio, ete3).
+'''
+import dataclasses
+import importlib
+import json
+import os
+import types
+
+import matplotlib
+from matplotlib import font_manager, rcParams
+
+FONT_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'gibson_inference', 'figures', 'arial_fonts')
+FONT_CACHE = 'mdsine2_paper_fonts.json'
+
+# `sns.color_palette('tab10').as_hex()`
+TAB10_HEX = ['#1f77b4', '#ff7f0e', '#2ca02c', '#d62728', '#9467bd', '#8c564b',
+    '#e377c2', '#7f7f7f', '#bcbd22', '#17becf']
+
+_registered = set()
+
+
+class _LazyModule(types.ModuleType):
+    '''Stands in for a module until one of its attributes is used.'''
+    def __getattr__(self, attr):
+        module = importlib.import_module(self.__name__)
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
+
+
+def lazy_import(name):
+    '''Module `name` (e.g. 'seaborn' or 'statsmodels.stats.multitest'), imported
+    the first time one of its attributes is used.'''
+    return _LazyModule(name)
+
+
+def _font_files(font_dir):
+    return sorted(os.path.join(font_dir, fname) for fname in os.listdir(font_dir)
+        if fname.lower().endswith(('.ttf', '.otf')) and not fname.startswith('._'))
+
+
+def _load_font_cache(path):
+    if not os.path.isfile(path):
+        return {}
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except ValueError:
+        return {}
+
+
+def _save_font_cache(cache, path):
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        with open(tmp, 'w') as f:
+            json.dump(cache, f, indent=2, sort_keys=True)
+        os.replace(tmp, path)
+    except OSError:
+        # The cache is only an optimization
+        pass
+
+
+def register_fonts(font_dir=FONT_DIR):
+    '''Add the fonts in `font_dir` to matplotlib (once per process).
+
+    Returns
+    -------
+    int
+        Number of fonts that were added
+    '''
+    font_dir = os.path.abspath(font_dir)
+    if font_dir in _registered:
+        return 0
+    cache_path = os.path.join(matplotlib.get_cachedir(), FONT_CACHE)
+    cache = _load_font_cache(cache_path)
+    fonts = _font_files(font_dir)
+
+    changed = False
+    for font_file in fonts:
+        st = os.stat(font_file)
+        key = [st.st_size, st.st_mtime_ns]
+        cached = cache.get(font_file)
+        if cached is not None and cached['stat'] == key:
+            font_manager.fontManager.ttflist.append(font_manager.FontEntry(**cached['entry']))
+            continue
+        font_manager.fontManager.addfont(font_file)
+        cache[font_file] = {'stat': key,
+            'entry': dataclasses.asdict(font_manager.fontManager.ttflist[-1])}
+        changed = True
+    font_manager.fontManager._findfont_cached.cache_clear()
+
+    if changed:
+        _save_font_cache(cache, cache_path)
+    _registered.add(font_dir)
+    return len(fonts)
+
+
+def use_arial_fonts(font_dir=FONT_DIR):
+    '''Register the Arial fonts and use them for all of the text of the plots.'''
+    register_fonts(font_dir)
+    rcParams['pdf.fonttype'] = 42
+    rcParams['font.family'] = 'Arial'
@@ -7,11 +7,14 @@ MDSINE2 version: 4.0.6
 
 Methodology
 -----------
-1) Load the dataset
+1) Load the dataset. The TSVs are parsed once (and cached) for all of the
+   datasets with `gibson_tables.load_tables`
 2) Aggregate the ASVs into OTUs using the aligned 16S v4 rRNA sequences in 
    `files/gibson_16S_rRNA_v4_seqs_aligned_filtered.fa` given a hamming-distance. 
    Once we agglomerate them together we set the sequences to the original sequence 
-   (unaligned).
+   (unaligned). The ASVs within the hamming-distance are found with the index of
+   `asv_aggregation` (the same groups as `md2.aggregate_items`), which is built
+   once for all of the datasets since they have the same ASVs.
 3) Calculate the consensus sequences
 4) Rename the taxa to OTUs
 5) Remove selected timepoints
@@ -25,11 +28,14 @@ can be found in `paper_files/preprocessing/prefiltered_asvs.fa`.
 '''
 import argparse
 from Bio import SeqIO, SeqRecord, Seq
-import numpy as np
 import mdsine2 as md2
 from mdsine2.logger import logger
 import os
 
+import asv_aggregation
+import gibson_tables
+import sequence_matrix
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(usage=__doc__)
     parser.add_argument('--output-basepath', '-o', type=str, dest='basepath',
@@ -50,24 +56,19 @@ if __name__ == '__main__':
         help='Maximum number of species assignments to have in the name')
     parser.add_argument('--dataset_dir', '-d', dest='dataset_dir', type=str, required=True,
                         help='The directory containing the input dataset (A collection of TSV files).')
+    parser.add_argument('--cache-dir', dest='cache_dir', type=str, default=None,
+        help='Where to cache the parsed tables of the dataset. If nothing is provided, ' \
+            'they are cached in `<dataset_dir>/.cache`.')
 
     args = parser.parse_args()
     os.makedirs(args.basepath, exist_ok=True)
 
+    tables = gibson_tables.load_tables(args.dataset_dir, cache_dir=args.cache_dir)
+
     for dset in ['healthy', 'uc', 'replicates', 'inoculum']:
         # 1) Load the dataset
-        try:
-            study = md2.dataset.load_gibson(dset=dset,
-                                            as_df=False,
-                                            species_assignment='both',
-                                            max_n_species=args.max_n_species)
-        except:
-            logger.warning('Trouble connect to the internet, loading them locally')
-            study = md2.dataset.load_gibson(dset=dset,
-                                            as_df=False,
-                                            species_assignment='both',
-                                            load_local=args.dataset_dir,
-                                            max_n_species=args.max_n_species)
+        study = tables.study(dset=dset, species_assignment='both',
+            max_n_species=args.max_n_species)
 
         # 2) Set the sequences for each taxon
         #    Remove all taxa that are not contained in that file
@@ -84,60 +85,38 @@ if __name__ == '__main__':
                     name, args.sequences))
             study.pop_taxa(to_delete)
 
-            M = []
-            for taxon in study.taxa:
-                seq = list(str(seqs[taxon.name].seq))
-                M.append(seq)
-            M = np.asarray(M)
-            gaps = M == '-'
-            n_gaps = np.sum(gaps, axis=0)
-            idxs = np.where(n_gaps == 0)[0]
+            M = sequence_matrix.sequence_matrix(
+                str(seqs[taxon.name].seq) for taxon in study.taxa)
+            idxs = sequence_matrix.gap_free_columns(M)
             logger.info('There are {} positions where there are no gaps out of {}. Setting those ' \
                 'to the sequences'.format(len(idxs), M.shape[1]))
-            M = M[:, idxs]
-            for i,taxon in enumerate(study.taxa):
-                taxon.sequence = ''.join(M[i])
+            for taxon, seq in zip(study.taxa, sequence_matrix.to_strings(M[:, idxs])):
+                taxon.sequence = seq
 
         # Aggregate with specified hamming distance
         if args.hamming_distance is not None:
             logger.info('Aggregating taxa with a hamming distance of {}'.format(args.hamming_distance))
-            study = md2.aggregate_items(subjset=study, hamming_dist=args.hamming_distance)
+            study = asv_aggregation.aggregate_study(study, hamming_dist=args.hamming_distance)
 
             # Get the maximum distance of all the OTUs
             m = -1
             for taxon in study.taxa:
-                if md2.isotu(taxon):
-                    for aname in taxon.aggregated_taxa:
-                        for bname in taxon.aggregated_taxa:
-                            if aname == bname:
-                                continue
-                            aseq = taxon.aggregated_seqs[aname]
-                            bseq = taxon.aggregated_seqs[bname]
-                            d = md2.diversity.beta.hamming(aseq, bseq)
-                            if d > m:
-                                m = d
+                if md2.isotu(taxon) and len(taxon.aggregated_taxa) > 1:
+                    M = sequence_matrix.sequence_matrix(
+                        taxon.aggregated_seqs[aname] for aname in taxon.aggregated_taxa)
+                    m = max(m, sequence_matrix.max_pairwise_hamming(M))
             logger.info('Maximum distance within an OTU: {}'.format(m))
 
         # 3) compute consensus sequences
         if args.sequences is not None:
             # put original sequences in study
-            try:
-                orig = md2.dataset.load_gibson(dset=dset, as_df=False, species_assignment='both',
-                    max_n_species=args.max_n_species)
-            except:
-                logger.warning('Trouble connect to the internet, loading them locally')
-                orig = md2.dataset.load_gibson(dset=dset,
-                                               as_df=False,
-                                               species_assignment='both',
-                                               load_local=args.dataset_dir,
-                    max_n_species=args.max_n_species)
-
+            orig_seqs = tables.sequences
             for taxon in study.taxa:
                 if md2.isotu(taxon):
                     for asvname in taxon.aggregated_taxa:
-                        taxon.aggregated_seqs[asvname] = orig.taxa[asvname].sequence
+                        taxon.aggregated_seqs[asvname] = orig_seqs[asvname]
                 else:
-                    taxon.sequence = orig.taxa[taxon.name].sequence
+                    taxon.sequence = orig_seqs[taxon.name]
 
             # Compute consensus sequences
             study.taxa.generate_consensus_seqs(threshold=0.65, noconsensus_char='N')
@@ -0,0 +1,167 @@
+'''Run several independent MDSINE2 chains concurrently.
+
+Each chain is given as `--chain NAME DATASET SEED` and is run with `mdsine2 infer`
+into `{basepath}/NAME`. The chains run in parallel processes (at most
+`--max-workers` at once), all reading the same dataset file. If all of the chains
+run at once and there are enough CPUs, each chain is pinned to its own `--cpus-per-chain` CPUs with `taskset`, and
+the numerical libraries of each chain are limited to that many threads so that the
+chains do not compete for cores.
+
+As soon as a chain finishes, its posterior is rendered with
+`mdsine2 visualize-posterior`. Once every chain of a dataset has finished, the
+cross-chain convergence diagnostics (`chain_diagnostics.py`) of that dataset are
+written to `{basepath}/diagnostics/{DATASET NAME}`.
+
+Chains that already finished with the same arguments are not rerun: a chain is
+rerun if its arguments changed, or if its `mcmc.pkl` is missing or its trace does
+not have all of its Gibbs steps (e.g. the chain was killed).
+'''
+import argparse
+import os
+import shutil
+import sys
+
+import mdsine2 as md2
+from mdsine2.logger import logger
+
+import chain_diagnostics
+import job_scheduler as js
+
+infer_command_fmt = 'mdsine2 infer ' \
+    '--input {dset} ' \
+    '--negbin {negbin} ' \
+    '--seed {seed} ' \
+    '--burnin {burnin} ' \
+    '--n-samples {n_samples} ' \
+    '--checkpoint {checkpoint} ' \
+    '--multiprocessing 0 ' \
+    '--rename-study {name} ' \
+    '--basepath {basepath} ' \
+    '--interaction-ind-prior {interaction_prior} ' \
+    '--perturbation-ind-prior {perturbation_prior}'
+
+posterior_command_fmt = 'mdsine2 visualize-posterior ' \
+    '--chain {chain} ' \
+    '--output-basepath {posterior_basepath}'
+
+diagnostics_command_fmt = '{python} {helpers}/chain_diagnostics.py ' \
+    '--chains {chains} ' \
+    '--output-basepath {basepath}'
+
+_HELPERS = os.path.dirname(os.path.abspath(__file__))
+_THREAD_VARS = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+    'NUMBA_NUM_THREADS']
+
+
+def cpu_sets(n_chains, cpus_per_chain):
+    '''Disjoint sets of CPUs for the chains, or None if they cannot be pinned.'''
+    if shutil.which('taskset') is None or not hasattr(os, 'sched_getaffinity'):
+        logger.info('`taskset` is not available, not pinning the chains')
+        return None
+    available = sorted(os.sched_getaffinity(0))
+    if n_chains * cpus_per_chain > len(available):
+        logger.info('{} chains with {} CPUs each do not fit on {} CPUs, not pinning ' \
+            'the chains'.format(n_chains, cpus_per_chain, len(available)))
+        return None
+    return [available[i * cpus_per_chain:(i + 1) * cpus_per_chain] for i in range(n_chains)]
+
+
+def chain_finished(chain):
+    '''Whether the chain saved at `chain` wrote all of its Gibbs steps to its trace.'''
+    if not os.path.isfile(chain):
+        return False
+    try:
+        import h5py
+        mcmc = md2.BaseMCMC.load(chain)
+        with h5py.File(mcmc.tracer.filename, 'r', libver='latest') as f:
+            length = chain_diagnostics.checkpointed_length(f)
+    except (ImportError, AttributeError, OSError, EOFError, KeyError):
+        return False
+    return length is not None and length >= mcmc.n_samples
+
+
+def limit_threads(command, n_threads, cpus=None):
+    '''Prefix the command so that it uses `n_threads` threads on the CPUs `cpus`.'''
+    prefix = ' '.join('{}={}'.format(var, n_threads) for var in _THREAD_VARS)
+    if cpus is not None:
+        prefix += ' taskset -c {}'.format(','.join(str(cpu) for cpu in cpus))
+    return prefix + ' ' + command
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(usage=__doc__)
+    parser.add_argument('--chain', type=str, dest='chains', nargs=3, action='append',
+        metavar=('NAME', 'DATASET', 'SEED'), required=True,
+        help='Name, dataset and seed of a chain. Pass once for every chain')
+    parser.add_argument('--negbin', type=str, dest='negbin',
+        help='This is the MCMC object that was run to learn a0 and a1')
+    parser.add_argument('--burnin', '-nb', type=int, dest='burnin',
+        help='How many burn-in Gibb steps for Markov Chain Monte Carlo (MCMC)')
+    parser.add_argument('--n-samples', '-ns', type=int, dest='n_samples',
+        help='Total number Gibb steps to perform during MCMC inference')
+    parser.add_argument('--checkpoint', '-c', type=int, dest='checkpoint',
+        help='How often to write the posterior to disk. Note that `--burnin` and ' \
+             '`--n-samples` must be a multiple of `--checkpoint` (e.g. checkpoint = 100, ' \
+             'n_samples = 600, burnin = 300)')
+    parser.add_argument('--basepath', '-b', type=str, dest='basepath',
+        help='This is folder to save the output of inference')
+    parser.add_argument('--interaction-ind-prior', '-ip', type=str, dest='interaction_prior',
+        help='Prior of the indicator of the interactions')
+    parser.add_argument('--perturbation-ind-prior', '-pp', type=str, dest='perturbation_prior',
+        help='Prior of the indicator of the perturbations')
+    parser.add_argument('--max-workers', '-w', type=int, dest='max_workers', default=None,
+        help='Maximum number of chains running at once. Default: all of them')
+    parser.add_argument('--cpus-per-chain', type=int, dest='cpus_per_chain', default=1,
+        help='Number of CPUs each chain is pinned to')
+    args = parser.parse_args()
+    os.makedirs(args.basepath, exist_ok=True)
+
+    n_chains = len(args.chains)
+    max_workers = args.max_workers if args.max_workers is not None else n_chains
+    if max_workers >= n_chains:
+        cpus = cpu_sets(n_chains, args.cpus_per_chain)
+    else:
+        # Chains that wait for a free worker could overlap with any of the running
+        # ones, so there is no CPU set we can give them ahead of time
+        logger.info('More chains than workers, not pinning the chains')
+        cpus = None
+
+    graph = js.JobGraph(state_dir=os.path.join(args.basepath, 'job_state'))
+    datasets = {}
+    for i, (name, dset, seed) in enumerate(args.chains):
+        chain = os.path.join(args.basepath, name, 'mcmc.pkl')
+        command = infer_command_fmt.format(
+            dset=dset, negbin=args.negbin, seed=seed, burnin=args.burnin,
+            n_samples=args.n_samples, checkpoint=args.checkpoint, name=name,
+            basepath=args.basepath, interaction_prior=args.interaction_prior,
+            perturbation_prior=args.perturbation_prior)
+        task = graph.add(js.Task(name, limit_threads(command, args.cpus_per_chain,
+            cpus=cpus[i] if cpus is not None else None)))
+        if graph.is_complete(task) and not chain_finished(chain):
+            logger.info('[{}] {} is missing or unfinished, rerunning the chain'.format(name, chain))
+            graph.clear_complete(task)
+        graph.add(js.Task(name + '-posterior', posterior_command_fmt.format(
+                chain=chain, posterior_basepath=os.path.join(args.basepath, name, 'posterior')),
+            dependencies=[name]))
+        datasets.setdefault(dset, []).append(name)
+
+    for dset, names in datasets.items():
+        if len(names) < 2:
+            continue
+        dset_name = os.path.splitext(os.path.basename(dset))[0]
+        graph.add(js.Task(dset_name + '-diagnostics', diagnostics_command_fmt.format(
+                python=sys.executable, helpers=_HELPERS,
+                chains=' '.join(os.path.join(args.basepath, name, 'mcmc.pkl') for name in names),
+                basepath=os.path.join(args.basepath, 'diagnostics', dset_name)),
+            dependencies=names))
+
+    logger.info('Running {} chains, {} at once'.format(n_chains, max_workers))
+    backend = js.LocalBackend(max_workers=max_workers, max_retries=0,
+        log_basepath=os.path.join(args.basepath, 'job_logs'))
+    failed = graph.run(backend)
+    for name, _, _ in args.chains:
+        if name in backend.timings:
+            start, end = backend.timings[name]
+            logger.info('Chain {}: {:.1f}s'.format(name, end - start))
+    if len(failed) > 0:
+        sys.exit(1)
@@ -4,16 +4,26 @@ Author: David Kaplan
 Date: 11/30/20
 MDSINE2 version: 4.0.6
 
-This script runs inference for each cross validation for a single fold. Specify the
-fold by saying which subject (by name) to leave out
+This script runs inference for the cross validation folds of a dataset. Specify the
+folds by saying which subjects (by name) to leave out. If no subject is specified,
+every subject is left out once.
+
+The dataset is loaded once and the training and validation datasets of every fold
+are saved before any inference starts. The folds are then run concurrently with at
+most `--max-workers` running at once. If `--fwsim-basepath` is given, each fold is
+followed by converting its trace into numpy arrays and forward simulating the held
+out subject as soon as its inference finishes. Steps that already finished in a
+previous run are skipped.
 '''
 import mdsine2 as md2
 from mdsine2.logger import logger
 import argparse
+import copy
 import os
-import pathlib
 import sys
 
+import job_scheduler as js
+
 command_fmt = 'mdsine2 infer --input {dset} ' \
     '--negbin {negbin} ' \
     '--seed {seed} ' \
@@ -25,6 +35,65 @@ command_fmt = 'mdsine2 infer --input {dset} ' \
     '--interaction-ind-prior {interaction_prior} ' \
     '--perturbation-ind-prior {perturbation_prior}'
 
+numpy_command_fmt = '{python} {helpers}/convert_trace_to_numpy.py ' \
+    '--chain {chain} ' \
+    '--output-basepath {numpy_basepath} ' \
+    '--section posterior'
+
+fsim_command_fmt = '{python} {helpers}/forward_sim_validation.py ' \
+    '--input {numpy_basepath} ' \
+    '--validation {validation} ' \
+    '--simulation-dt {sim_dt} ' \
+    '--start None ' \
+    '--n-days None ' \
+    '--output-basepath {fsim_basepath} ' \
+    '--save-intermediate-times 0'
+
+_HELPERS = os.path.dirname(os.path.abspath(__file__))
+
+
+def make_folds(dataset, input_basepath, leave_out_subjects=None):
+    '''Load the dataset once and save the training and validation datasets of each
+    fold.
+
+    Parameters
+    ----------
+    dataset : str
+        Location of the `md2.Study` to do cross validation on
+    input_basepath : str
+        Folder to save the cv datasets in
+    leave_out_subjects : list(str), None
+        Names of the subjects to leave out. If None, every subject.
+
+    Returns
+    -------
+    list((str, str, str))
+        Name of the subject left out, name of the training study and path of the
+        validation study for each fold
+    '''
+    logger.info('Loading dataset {}'.format(dataset))
+    study_master = md2.Study.load(dataset)
+    if leave_out_subjects is None:
+        leave_out_subjects = [subj.name for subj in study_master]
+
+    folds = []
+    for subjname in leave_out_subjects:
+        subj = study_master[subjname]
+        logger.info('Leave out {}'.format(subj.name))
+        study = copy.deepcopy(study_master)
+        val_study = study.pop_subject(subj.name)
+        study.name = study.name + '-cv{}'.format(subj.name)
+        val_study.name = study.name + '-validate'
+
+        # Save the datasets
+        study_fname = os.path.join(input_basepath, study.name + '.pkl')
+        val_fname = os.path.join(input_basepath, val_study.name + '.pkl')
+        study.save(study_fname)
+        val_study.save(val_fname)
+        folds.append((subj.name, study.name, val_fname))
+    return folds
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(usage=__doc__)
     parser.add_argument('--dataset', '-d', type=str, dest='dataset',
@@ -34,7 +103,9 @@ if __name__ == '__main__':
     parser.add_argument('--dset-basepath', '-db', type=str, dest='input_basepath',
         help='This is the basepath to load and save the cv datasets')
     parser.add_argument('--leave-out-subject', '-lo', type=str, dest='leave_out_subj',
-        help='This is the subject to leave out')
+        nargs='+', default=None,
+        help='These are the subjects to leave out (one fold each). If not specified, ' \
+             'every subject is left out once')
     parser.add_argument('--negbin', type=str, dest='negbin',
         help='This is the MCMC object that was run to learn a0 and a1')
     parser.add_argument('--seed', '-s', type=int, dest='seed',
@@ -56,34 +127,67 @@ if __name__ == '__main__':
         help='Prior of the indicator of the interactions')
     parser.add_argument('--perturbation-ind-prior', '-pp', type=str, dest='perturbation_prior',
         help='Prior of the indicator of the perturbations')
+    parser.add_argument('--max-workers', '-w', type=int, dest='max_workers',
+        help='Maximum number of jobs (inference, trace conversion or forward ' \
+             'simulation) running at once', default=1)
+    parser.add_argument('--fwsim-basepath', type=str, dest='fwsim_basepath',
+        help='If specified, convert the trace of each fold into numpy arrays and ' \
+             'forward simulate the held out subject into this folder', default=None)
+    parser.add_argument('--simulation-dt', type=float, dest='simulation_dt',
+        help='Timesteps we go in during forward simulation', default=0.01)
 
     args = parser.parse_args()
 
     input_basepath = args.input_basepath
     os.makedirs(input_basepath, exist_ok=True)
     os.makedirs(args.output_basepath, exist_ok=True)
+    if args.fwsim_basepath is not None:
+        os.makedirs(args.fwsim_basepath, exist_ok=True)
+
+    folds = make_folds(args.dataset, input_basepath, leave_out_subjects=args.leave_out_subj)
+
+    # Chain the steps of each fold
+    graph = js.JobGraph(state_dir=os.path.join(args.output_basepath, 'job_state'))
+    fold_tasks = {}
+    for subjname, cv_name, val_fname in folds:
+        chain = os.path.join(args.output_basepath, cv_name, 'mcmc.pkl')
+        numpy_basepath = os.path.join(args.output_basepath, cv_name, 'numpy_trace')
+        command = command_fmt.format(
+            dset=os.path.join(input_basepath, cv_name + '.pkl'), negbin=args.negbin,
+            seed=args.seed, burnin=args.burnin, n_samples=args.n_samples,
+            checkpoint=args.checkpoint, basepath=args.output_basepath, mp=args.mp,
+            interaction_prior=args.interaction_prior,
+            perturbation_prior=args.perturbation_prior)
+        logger.info(command)
+        tasks = [graph.add(js.Task(cv_name, command)).name]
+
+        if args.fwsim_basepath is not None:
+            tasks.append(graph.add(js.Task(cv_name + '-numpy',
+                numpy_command_fmt.format(python=sys.executable, helpers=_HELPERS,
+                    chain=chain, numpy_basepath=numpy_basepath),
+                dependencies=[cv_name])).name)
+            tasks.append(graph.add(js.Task(cv_name + '-fwsim',
+                fsim_command_fmt.format(python=sys.executable, helpers=_HELPERS,
+                    numpy_basepath=numpy_basepath, validation=val_fname,
+                    sim_dt=args.simulation_dt, fsim_basepath=args.fwsim_basepath),
+                dependencies=[cv_name + '-numpy'])).name)
+        fold_tasks[subjname] = tasks
+
+    logger.info('Run inference for {} folds'.format(len(folds)))
+    backend = js.LocalBackend(max_workers=args.max_workers, max_retries=0,
+        log_basepath=os.path.join(args.output_basepath, 'job_logs'))
+    failed = graph.run(backend)
 
-    logger.info('Loading dataset {}'.format(args.dataset))
-    study_master = md2.Study.load(args.dataset)
-    subj = study_master[args.leave_out_subj]
-
-    logger.info('Leave out {}'.format(subj.name))
-    study = md2.Study.load(args.dataset)
-    val_study = study.pop_subject(subj.name)
-    study.name = study.name + '-cv{}'.format(subj.name)
-    val_study.name = study.name + '-validate'
-
-    # Save the datasets
-    study_fname = os.path.join(input_basepath, study.name + '.pkl')
-    study.save(study_fname)
-    val_study.save(os.path.join(input_basepath, val_study.name + '.pkl'))
-
-    logger.info('Run inference')
-    command = command_fmt.format(
-        dset=study_fname, negbin=args.negbin, seed=args.seed,
-        burnin=args.burnin, n_samples=args.n_samples, checkpoint=args.checkpoint,
-        basepath=args.output_basepath, mp=args.mp,
-        interaction_prior=args.interaction_prior,
-        perturbation_prior=args.perturbation_prior)
-    logger.info(command)
-    os.system(command)
+    for subjname, tasks in fold_tasks.items():
+        if any(name in failed for name in tasks):
+            logger.info('Fold {}: failed'.format(subjname))
+            continue
+        ran = [name for name in tasks if name in backend.timings]
+        if len(ran) == 0:
+            logger.info('Fold {}: already complete'.format(subjname))
+        else:
+            start = min(backend.timings[name][0] for name in ran)
+            end = max(backend.timings[name][1] for name in ran)
+            logger.info('Fold {}: {:.1f}s'.format(subjname, end - start))
+    if len(failed) > 0:
+        sys.exit(1)
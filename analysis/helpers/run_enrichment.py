@@ -1,5 +1,6 @@
 import enrichment as enrich
 import argparse
+import os
 import mdsine2 as md2
 
 def parse_args():
@@ -14,6 +15,14 @@ def parse_args():
         help = "directory(folder name) where the output is saved")
     parser.add_argument("-o_name", "--output_name", required="True",
         help = "name of the output")
+    parser.add_argument("-p_loc", "--posterior_mcmc_loc", default=None,
+        help = "a pl.BaseMCMC pkl file with a learned clustering. If given, the "\
+        "posterior probabilities of enrichment of the modules in mcmc_loc over the "\
+        "Gibbs samples of this clustering are also saved")
+    parser.add_argument("-n", "--n_samples", type=int, default=1000,
+        help = "number of Gibbs samples used for the posterior enrichment")
+    parser.add_argument("-w", "--n_workers", type=int, default=1,
+        help = "number of processes used for the posterior enrichment")
 
     return parser.parse_args()
 
@@ -29,3 +38,11 @@ if __name__ =="__main__":
     
     enrich.simple_plot(df_enrich, df_members, mcmc.graph.data.subjects.name, args.level,
        args.output_loc, args.output_name)
+
+    if args.posterior_mcmc_loc is not None:
+        df_posterior = enrich.posterior_enrichment_level(
+            md2.BaseMCMC.load(args.posterior_mcmc_loc), args.level,
+            consensus_mcmc=mcmc, n_samples=args.n_samples, n_workers=args.n_workers)
+        os.makedirs(args.output_loc, exist_ok=True)
+        df_posterior.to_csv("{}/{}_posterior.csv".format(args.output_loc,
+            args.output_name), sep=",")
@@ -3,9 +3,10 @@
 import pandas as pd
 #import mdsine2 as md2
 import numpy as np
-from Bio import SeqIO
 import mdsine2 as md2
 
+import sequence_matrix
+
 def get_sequences_scratch(otu_li, path):
     """
     obtains the aligned consensus sequence
@@ -20,23 +21,10 @@ def get_sequences_scratch(otu_li, path):
 
     print("Loading sequences \n")
 
-    seqs = SeqIO.to_dict(SeqIO.parse(path, format = "stockholm"))
-    to_delete = []
-    M = []
-    #print(otu_li)
-    for otu in otu_li:
-        seq = list(str(seqs[otu].seq))
-        M.append(seq)
-
-    M = np.asarray(M)
-    gaps = M == "-"
-    n_gaps = np.sum(gaps, axis = 0)
-    idxs = np.where(n_gaps == 0)[0]
-    M = M[:, idxs]
-    seq_dict = {}
+    M = sequence_matrix.read_alignment(path, otu_li, format = "stockholm")
+    M = M[:, sequence_matrix.gap_free_columns(M)]
+    seq_dict = dict(zip(otu_li, sequence_matrix.to_strings(M)))
 
-    for i, otu in enumerate(otu_li):
-        seq_dict[otu] = ''.join(M[i])
     #for keys in seq_dict:
     #    print(keys, seq_dict[keys])
     return seq_dict
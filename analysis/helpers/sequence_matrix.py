@@ -0,0 +1,106 @@
+'''Aligned sequences as a matrix of bytes.
+
+The sequences of an alignment (which all have the same length) are read into a
+single (n_seqs, n_positions) uint8 matrix of their ASCII codes, instead of a
+(n_seqs, n_positions) object array of one-character strings. Finding the
+columns without gaps, slicing them out and computing Hamming distances are
+then vectorized comparisons on that matrix.
+
+The pairwise Hamming distances are computed in blocks of rows, so that the
+(block_size, n_seqs, n_positions) comparison array stays under
+`max_block_bytes`.
+'''
+import numpy as np
+from Bio import SeqIO
+
+GAP = '-'
+_MAX_BLOCK_BYTES = 1 << 27
+
+
+def sequence_matrix(seqs):
+    '''Stack aligned sequences into a uint8 matrix.
+
+    Parameters
+    ----------
+    seqs : iterable(str)
+        Sequences, all of the same length
+
+    Returns
+    -------
+    np.ndarray(n_seqs, n_positions), uint8
+    '''
+    seqs = [str(seq) for seq in seqs]
+    if len(seqs) == 0:
+        return np.zeros((0, 0), dtype=np.uint8)
+    lengths = set(len(seq) for seq in seqs)
+    if len(lengths) > 1:
+        raise ValueError('The sequences are not aligned (lengths {})'.format(sorted(lengths)))
+    return np.frombuffer(''.join(seqs).encode('ascii'), dtype=np.uint8).reshape(
+        len(seqs), lengths.pop())
+
+
+def read_alignment(path, names, format='fasta'):
+    '''Read the aligned sequences of `names` from an alignment file.
+
+    Parameters
+    ----------
+    path : str
+        Location of the alignment
+    names : list(str)
+        Names of the sequences to read, in the order of the rows of the matrix
+    format : str
+        Format of the file (as in `Bio.SeqIO`), e.g. 'fasta' or 'stockholm'
+
+    Returns
+    -------
+    np.ndarray(len(names), n_positions), uint8
+    '''
+    seqs = SeqIO.to_dict(SeqIO.parse(path, format=format))
+    return sequence_matrix(str(seqs[name].seq) for name in names)
+
+
+def to_strings(M):
+    '''The rows of a sequence matrix as strings.'''
+    M = np.ascontiguousarray(M, dtype=np.uint8)
+    if M.shape[1] == 0:
+        return [''] * M.shape[0]
+    return [row.decode('ascii') for row in M.view('S{}'.format(M.shape[1])).ravel()]
+
+
+def gap_free_columns(M, gap=GAP):
+    '''Indices of the columns of `M` that have no gap in any sequence.'''
+    return np.flatnonzero(~np.any(M == ord(gap), axis=0))
+
+
+def _block_size(n_rows, n_cols, max_block_bytes):
+    return max(1, min(n_rows, max_block_bytes // max(1, n_rows * n_cols)))
+
+
+def pairwise_hamming(M, max_block_bytes=_MAX_BLOCK_BYTES):
+    '''Hamming distance between every pair of rows of `M`.
+
+    Parameters
+    ----------
+    M : np.ndarray(n_seqs, n_positions), uint8
+    max_block_bytes : int
+        Maximum size of the comparison array of a block of rows
+
+    Returns
+    -------
+    np.ndarray(n_seqs, n_seqs), int
+    '''
+    n = M.shape[0]
+    D = np.zeros((n, n), dtype=np.int64)
+    block = _block_size(n, M.shape[1], max_block_bytes)
+    for start in range(0, n, block):
+        stop = min(n, start + block)
+        D[start:stop] = np.count_nonzero(M[start:stop, None, :] != M[None, :, :], axis=2)
+    return D
+
+
+def max_pairwise_hamming(M, max_block_bytes=_MAX_BLOCK_BYTES):
+    '''Largest Hamming distance between two rows of `M` (0 if there are less
+    than two rows).'''
+    if M.shape[0] < 2:
+        return 0
+    return int(pairwise_hamming(M, max_block_bytes=max_block_bytes).max())
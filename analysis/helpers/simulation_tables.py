@@ -0,0 +1,214 @@
+'''Columnar storage of the forward simulation tables.
+
+The stability simulations write one row per (trial, Gibbs sample, taxa), yet
+the figures only use a handful of columns of one perturbation strength. The
+tables are therefore stored as Parquet datasets that are partitioned by the
+perturbation parameters (one folder per `PerturbedFrac`/`Perturbation` pair,
+hive style), with the OTU names stored once per file as a dictionary
+(categorical) column:
+
+    fwsim.parquet/PerturbedFrac=0.1/Perturbation=-2.0/<part>.parquet
+
+`read_table` only reads the requested columns, and the partitions (and row
+groups) that can match the filters are the only ones read from disk.
+
+`RandomPertArrays` turns the random perturbation tables into dense arrays
+indexed by (alpha, trial, Gibbs sample, OTU), so that the differences from the
+baseline and the diversities are computed by broadcasting instead of joins.
+'''
+import shutil
+from pathlib import Path
+from typing import List, Sequence, Tuple, Union
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+# Perturbation parameters the simulation tables are partitioned by
+PARTITION_COLS = ['PerturbedFrac', 'Perturbation']
+_PARTITIONING = ds.partitioning(
+    pa.schema([(col, pa.float64()) for col in PARTITION_COLS]),
+    flavor='hive')
+
+Filter = Tuple[str, str, object]
+
+
+class TableWriter(object):
+    '''Write a partitioned table one chunk at a time.
+
+    Any table that already exists at `path` is removed when the writer is
+    created, so that chunks of a previous run are not mixed with the new ones.
+    '''
+
+    def __init__(self, path: Union[str, Path], categorical: Sequence[str] = ('OTU',)):
+        self.path = Path(path)
+        self.categorical = list(categorical)
+        if self.path.exists():
+            shutil.rmtree(self.path)
+        self.path.mkdir(parents=True)
+        self.n_chunks = 0
+
+    def append(self, df: pd.DataFrame):
+        '''Write the rows of `df` into their partitions.'''
+        df = df.copy(deep=False)
+        for col in self.categorical:
+            if col in df.columns and not isinstance(df[col].dtype, pd.CategoricalDtype):
+                df[col] = pd.Categorical(df[col])
+        pq.write_to_dataset(
+            pa.Table.from_pandas(df, preserve_index=False),
+            root_path=str(self.path),
+            partitioning=_PARTITIONING,
+            basename_template='chunk{}-{{i}}.parquet'.format(self.n_chunks),
+            existing_data_behavior='overwrite_or_ignore')
+        self.n_chunks += 1
+
+
+def read_table(path: Union[str, Path],
+               columns: List[str] = None,
+               filters: Union[List[Filter], List[List[Filter]]] = None) -> pd.DataFrame:
+    '''Read the given columns of the rows of a partitioned table that match the filters.
+
+    Parameters
+    ----------
+    path : str, Path
+        Location of the table (written by `TableWriter`)
+    columns : list(str), None
+        Columns to read. If None, all of them.
+    filters : list((str, str, value)), list(list((str, str, value))), None
+        Rows to read, in the `pyarrow.parquet` format: a list of
+        (column, operator, value) conditions that must all hold, or a list of
+        such lists of which any must hold. E.g.
+        `[[('Perturbation', '==', -2.0)], [('PerturbedFrac', '==', 0.0)]]`.
+        If None, all of the rows.
+
+    Returns
+    -------
+    pd.DataFrame
+    '''
+    return pq.read_table(
+        str(path),
+        columns=columns,
+        filters=filters,
+        partitioning=_PARTITIONING
+    ).to_pandas()
+
+
+class RandomPertArrays(object):
+    '''The steady states of the random perturbation simulations as dense arrays.
+
+    Attributes
+    ----------
+    alphas : np.ndarray(n_alpha)
+        Fractions of the OTUs that were perturbed (excluding the baseline)
+    trials : np.ndarray(n_trials)
+    sample_idx : np.ndarray(n_gibbs)
+        The Gibbs samples that were simulated
+    otus : np.ndarray(n_otus)
+    steady_states : np.ndarray(n_alpha, n_trials, n_gibbs, n_otus)
+        Steady states of the perturbed simulations (NaN where not simulated)
+    baseline_trials : np.ndarray(n_baseline_trials)
+    baseline : np.ndarray(n_baseline_trials, n_gibbs, n_otus)
+        Steady states of the unperturbed (PerturbedFrac = 0) simulations. There is usually a single baseline
+        trial; if there are more, each perturbed simulation is compared to all of them.
+    is_perturbed : np.ndarray(n_alpha, n_trials, n_otus), None
+        Whether each OTU was perturbed in each trial
+    '''
+
+    def __init__(self, fwsim_df: pd.DataFrame, metadata_df: pd.DataFrame = None, perturbation: float = -2.0):
+        '''
+        Parameters
+        ----------
+        fwsim_df : pd.DataFrame
+            Long-format steady states (OTU, PerturbedFrac, Perturbation, Trial, SampleIdx, SteadyState). Rows of
+            other perturbation strengths (except the baseline) are ignored.
+        metadata_df : pd.DataFrame, None
+            Long-format perturbations (OTU, PerturbedFrac, Perturbation, Trial, IsPerturbed)
+        '''
+        is_base = fwsim_df["PerturbedFrac"].to_numpy() == 0.0
+        is_pert = ~is_base & (fwsim_df["Perturbation"].to_numpy() == perturbation)
+
+        otus = fwsim_df["OTU"]
+        if not isinstance(otus.dtype, pd.CategoricalDtype):
+            otus = otus.astype("category")
+        self.otus = np.asarray(otus.cat.categories)
+        otu_codes = otus.cat.codes.to_numpy()
+        self.sample_idx, gibbs_codes = np.unique(fwsim_df["SampleIdx"].to_numpy(), return_inverse=True)
+        self.alphas, alpha_codes = np.unique(fwsim_df["PerturbedFrac"].to_numpy()[is_pert], return_inverse=True)
+        self.trials, trial_codes = np.unique(fwsim_df["Trial"].to_numpy()[is_pert], return_inverse=True)
+        self.perturbation = perturbation
+        steady_state = fwsim_df["SteadyState"].to_numpy()
+
+        self.steady_states = np.full((len(self.alphas), len(self.trials), len(self.sample_idx), len(self.otus)),
+                                     np.nan)
+        self.steady_states[alpha_codes, trial_codes, gibbs_codes[is_pert], otu_codes[is_pert]] = steady_state[is_pert]
+
+        self.baseline_trials, base_trial_codes = np.unique(fwsim_df["Trial"].to_numpy()[is_base],
+                                                           return_inverse=True)
+        base_index = (base_trial_codes * len(self.sample_idx) + gibbs_codes[is_base]) * len(self.otus) + \
+            otu_codes[is_base]
+        if len(base_index) > len(np.unique(base_index)):
+            raise ValueError("There is more than one baseline steady state of an OTU in a (Trial, SampleIdx).")
+        self.baseline = np.full((len(self.baseline_trials), len(self.sample_idx), len(self.otus)), np.nan)
+        self.baseline[base_trial_codes, gibbs_codes[is_base], otu_codes[is_base]] = steady_state[is_base]
+
+        self.is_perturbed = None
+        if metadata_df is not None:
+            rows = (metadata_df["Perturbation"].to_numpy() == perturbation) & \
+                np.isin(metadata_df["PerturbedFrac"].to_numpy(), self.alphas) & \
+                np.isin(metadata_df["Trial"].to_numpy(), self.trials)
+            meta = metadata_df.loc[rows]
+            self.is_perturbed = np.zeros((len(self.alphas), len(self.trials), len(self.otus)), dtype=bool)
+            self.is_perturbed[
+                np.searchsorted(self.alphas, meta["PerturbedFrac"].to_numpy()),
+                np.searchsorted(self.trials, meta["Trial"].to_numpy()),
+                pd.Categorical(meta["OTU"], categories=self.otus).codes
+            ] = meta["IsPerturbed"].to_numpy()
+
+    def steady_state_diff(self, offset: float = 1e5) -> np.ndarray:
+        '''
+        Mean (over the OTUs and the baseline trials, then over the Gibbs samples) absolute log10 difference of the
+        perturbed steady states from the baselines of the same Gibbs sample.
+
+        Returns
+        -------
+        np.ndarray(n_alpha, n_trials)
+        '''
+        log_states = np.log10(self.steady_states + offset)
+        total = np.zeros(self.steady_states.shape[:3])
+        count = np.zeros(self.steady_states.shape[:3])
+        for baseline in self.baseline:
+            diff = np.abs(log_states - np.log10(baseline + offset))
+            total += np.nansum(diff, axis=3)
+            count += np.sum(~np.isnan(diff), axis=3)
+        with np.errstate(invalid="ignore"):
+            return np.nanmean(total / count, axis=2)
+
+    def diversity(self) -> np.ndarray:
+        '''
+        Mean (over the Gibbs samples) normalized entropy of the perturbed steady states.
+
+        Returns
+        -------
+        np.ndarray(n_alpha, n_trials)
+        '''
+        return np.nanmean(normalized_entropy(self.steady_states), axis=2)
+
+    def baseline_diversity(self) -> float:
+        '''Mean (over the Gibbs samples) normalized entropy of the baseline steady states (of all of the
+        baseline trials of a Gibbs sample together).'''
+        baseline = np.moveaxis(self.baseline, 0, 1).reshape(len(self.sample_idx), -1)
+        return np.nanmean(normalized_entropy(baseline))
+
+
+def normalized_entropy(x: np.ndarray) -> np.ndarray:
+    '''
+    Entropy of the abundances over the last axis divided by the entropy of the uniform distribution (over the
+    non-NaN entries). NaN where all of the entries are NaN.
+    '''
+    n = np.sum(~np.isnan(x), axis=-1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        p = x / np.nansum(x, axis=-1, keepdims=True)
+        plogp = np.where(p > 0, p * np.log(np.where(p > 0, p, 1.0)), 0.0)
+        return np.where(n > 0, -np.nansum(plogp, axis=-1) / np.log(n), np.nan)
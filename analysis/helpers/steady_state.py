@@ -0,0 +1,303 @@
+'''Steady-state solvers for the gLV dynamics learned by MDSINE2.
+
+The keystoneness and stability simulations only use the final state of a
+forward simulation, yet `md2.integrate` always runs for the full number of days
+and keeps every timepoint. This module provides two cheaper ways of getting
+the same quantity:
+
+    1) `integrate_to_steady_state`: The same log-space Euler scheme that
+       `md2.integrate` uses for `md2.model.gLVDynamicsSingleClustering`, but it
+       only keeps the current state and stops as soon as the log-abundance of
+       every taxon changes by less than a tolerance per day (after any
+       perturbation has ended).
+    2) `solve_fixed_point`: Solve the fixed point of the unperturbed dynamics
+       directly. The gLV fixed points reachable from a positive initial condition
+       are the solutions of the linear complementarity problem (LCP)
+            x >= 0,   w = -(r + A x) >= 0,   x * w = 0
+       which we solve with Murty's least-index principal pivoting method.
+
+`steady_state` combines the two: it uses the fixed point when the dynamics are
+autonomous and the fixed point is feasible and stable, and integrates otherwise.
+
+The integrator works on a single sample (`x` of shape (n_taxa,)), on a batch
+of samples (`x` of shape (n_batch, n_taxa), `interactions` of shape
+(n_batch, n_taxa, n_taxa)), or on a batch of samples that each have several
+trials sharing the same interactions (`x` of shape (n_batch, n_trials, n_taxa)).
+'''
+import numpy as np
+
+
+def _interact(interactions, x):
+    '''Computes `interactions @ x` over the last axis of `x`. If `x` has an extra
+    (trial) axis, every trial of a sample uses the same interaction matrix.
+    '''
+    if x.ndim == interactions.ndim:
+        return np.matmul(x, np.swapaxes(interactions, -1, -2))
+    return np.einsum('...ij,...j->...i', interactions, x)
+
+
+def integrate_to_steady_state(growth, interactions, initial_conditions, dt, n_days,
+    perturbation=None, pert_start_day=None, pert_end_day=None, sim_max=None,
+    rel_tol=1e-6, extinction_tol=1e-12, average_last=None):
+    '''Forward simulate the gLV dynamics until they stop changing.
+
+    Parameters
+    ----------
+    growth : np.ndarray([n_batch,] [n_trials,] n_taxa)
+        Growth rates
+    interactions : np.ndarray([n_batch,] n_taxa, n_taxa)
+        Interaction matrix (self-interactions on the diagonal)
+    initial_conditions : np.ndarray([n_batch,] [n_trials,] n_taxa)
+        Initial abundances. Taxa that start at 0 stay at 0.
+    dt : float
+        Step size of the forward simulation
+    n_days : float
+        Maximum number of days to simulate for
+    perturbation : np.ndarray([n_batch,] [n_trials,] n_taxa), None
+        Perturbation effect. While it is on, the growth rate is `growth * (1 + perturbation)`
+    pert_start_day, pert_end_day : float, None
+        Window in which the perturbation is on
+    sim_max : float, None
+        Maximum clip for forward sim
+    rel_tol : float, None
+        A sample has converged once |log x_i(t+dt) - log x_i(t)| / dt < rel_tol for
+        every taxon i that is present, so that taxa at a low abundance that are still
+        growing or decaying are not frozen. Converged samples are frozen. If None,
+        always simulate for `n_days`.
+    extinction_tol : float
+        A taxon that is decreasing and whose abundance is below `extinction_tol`
+        times the total abundance of the sample is going extinct, and is not held
+        to `rel_tol` (its log-abundance keeps decreasing at a constant rate).
+    average_last : int, None
+        If specified, return the average of the last `average_last` states instead of
+        the final state (a converged sample stays at its final state until `n_days`).
+
+    Returns
+    -------
+    dict
+        'X' : np.ndarray([n_batch,] [n_trials,] n_taxa)
+            The final state of each sample
+        'converged' : np.ndarray([n_batch,] [n_trials]), bool
+            Whether the sample met the tolerance before `n_days`
+        'n_steps' : np.ndarray([n_batch,] [n_trials]), int
+            Number of steps taken by each sample
+        'rel_change' : np.ndarray([n_batch,] [n_trials]), float
+            The last largest change of the log-abundance per day of the present
+            taxa of each sample
+    '''
+    growth = np.asarray(growth, dtype=float)
+    if perturbation is not None:
+        if pert_start_day is None or pert_end_day is None:
+            raise ValueError('`pert_start_day` and `pert_end_day` must be specified with a perturbation')
+        perturbed_growth = growth * (1 + np.asarray(perturbation, dtype=float))
+        settle_day = pert_end_day
+    else:
+        perturbed_growth = growth
+        settle_day = 0
+
+    # Every sample (and trial) gets its own copy of the state.
+    x = np.array(np.broadcast_to(initial_conditions, perturbed_growth.shape), dtype=float)
+    batch_shape = x.shape[:-1]
+
+    converged = np.zeros(batch_shape, dtype=bool)
+    n_steps = np.zeros(batch_shape, dtype=int)
+    rel_change = np.full(batch_shape, np.inf)
+
+    n_total_steps = int(n_days / dt)
+    if average_last is not None:
+        x_sum = np.zeros(x.shape)
+        n_summed = 0
+    with np.errstate(divide='ignore'):
+        for step in range(n_total_steps):
+            t = step * dt
+            if perturbation is not None and pert_start_day <= t < pert_end_day:
+                r = perturbed_growth
+            else:
+                r = growth
+
+            dlogx = r + _interact(interactions, x)
+            x_next = np.exp(np.log(x) + dt * dlogx)
+            if sim_max is not None:
+                x_next[x_next >= sim_max] = sim_max
+
+            active = ~converged
+            n_steps[active] += 1
+            if rel_tol is not None and t + dt >= settle_day:
+                # The change is computed from the clipped state, so taxa held at
+                # `sim_max` do not change. Absent taxa (and taxa going extinct) are
+                # left out, so a state where every taxon is extinct has converged.
+                present = x > 0
+                extinct = (x_next < x) & (x < extinction_tol * x.sum(axis=-1, keepdims=True))
+                with np.errstate(invalid='ignore'):
+                    dlog = np.abs(np.log(x_next) - np.log(x)) / dt
+                dlog = np.where(present & ~extinct, dlog, 0.)
+                change = dlog.max(axis=-1)
+                rel_change = np.where(active, change, rel_change)
+                newly_converged = active & (change < rel_tol)
+            else:
+                newly_converged = np.zeros(batch_shape, dtype=bool)
+
+            x = np.where(active[..., None], x_next, x)
+            converged |= newly_converged
+            if average_last is not None and step >= n_total_steps - average_last:
+                x_sum += x
+                n_summed += 1
+            if np.all(converged):
+                break
+
+    if average_last is not None:
+        # Samples that stopped early stay at their final state for the rest of the window.
+        n_remaining = min(average_last, n_total_steps) - n_summed
+        x = (x_sum + n_remaining * x) / min(average_last, n_total_steps)
+
+    return {'X': x, 'converged': converged, 'n_steps': n_steps, 'rel_change': rel_change}
+
+
+def solve_fixed_point(growth, interactions, support=None, tol=1e-9, max_iter=None):
+    '''Solve the gLV fixed point as a linear complementarity problem.
+
+    Finds `x` such that `x >= 0`, `w = -(growth + interactions @ x) >= 0` and
+    `x * w = 0` over the taxa in `support` (every other taxa is fixed to 0). Uses
+    Murty's least-index principal pivoting method, which terminates when
+    `-interactions` is a P-matrix (e.g. when its symmetric part is positive definite).
+
+    Parameters
+    ----------
+    growth : np.ndarray(n_taxa)
+        Growth rates
+    interactions : np.ndarray(n_taxa, n_taxa)
+        Interaction matrix (self-interactions on the diagonal)
+    support : np.ndarray(n_taxa), bool, None
+        Which taxa are present. If None, all of the taxa are present.
+    tol : float
+        Relative tolerance for the sign checks
+    max_iter : int, None
+        Maximum number of pivots. If None, defaults to 10 * n_taxa.
+
+    Returns
+    -------
+    np.ndarray(n_taxa), None
+        The fixed point, or None if the pivoting did not terminate.
+    '''
+    n_taxa = len(growth)
+    if support is None:
+        support = np.ones(n_taxa, dtype=bool)
+    candidates = np.flatnonzero(support)
+    x = np.zeros(n_taxa)
+    if len(candidates) == 0:
+        return x
+    if max_iter is None:
+        max_iter = 10 * n_taxa
+
+    M = -interactions[np.ix_(candidates, candidates)]
+    q = -growth[candidates]
+    w_tol = tol * max(1., np.max(np.abs(q)))
+
+    # Start from the full complementary basis, which is the answer when every taxa coexists.
+    basis = np.ones(len(candidates), dtype=bool)
+    for _ in range(max_iter):
+        z = np.zeros(len(candidates))
+        if np.any(basis):
+            try:
+                z[basis] = np.linalg.solve(M[np.ix_(basis, basis)], -q[basis])
+            except np.linalg.LinAlgError:
+                return None
+        w = M @ z + q
+        z_tol = tol * max(1., np.max(np.abs(z)))
+        infeasible = np.flatnonzero((basis & (z < -z_tol)) | (~basis & (w < -w_tol)))
+        if len(infeasible) == 0:
+            z[~basis] = 0
+            x[candidates] = np.maximum(z, 0)
+            return x
+        basis[infeasible[0]] = ~basis[infeasible[0]]
+    return None
+
+
+def is_globally_stable(interactions, support=None):
+    '''Checks if the symmetric part of the interaction matrix is negative definite
+    over the taxa in `support`. In that case the LCP has a unique solution which is
+    the globally stable fixed point of the dynamics (Takeuchi & Adachi, 1980), so
+    the fixed point is the steady state reached from any positive initial condition.
+    '''
+    if support is not None:
+        interactions = interactions[np.ix_(support, support)]
+    if interactions.shape[0] == 0:
+        return True
+    return bool(np.all(np.linalg.eigvalsh(interactions + interactions.T) < 0))
+
+
+def is_locally_stable(x, interactions):
+    '''Checks if the fixed point `x` is locally stable, i.e. the Jacobian
+    diag(x) A of the surviving taxa only has eigenvalues with negative real part.
+    '''
+    alive = x > 0
+    if not np.any(alive):
+        return True
+    jacobian = x[alive, None] * interactions[np.ix_(alive, alive)]
+    return bool(np.all(np.real(np.linalg.eigvals(jacobian)) < 0))
+
+
+def steady_state(growth, interactions, initial_conditions, dt, n_days, method='auto',
+    perturbation=None, pert_start_day=None, pert_end_day=None, sim_max=None,
+    rel_tol=1e-6, extinction_tol=1e-12):
+    '''Compute the steady state of a single sample.
+
+    Parameters
+    ----------
+    growth : np.ndarray(n_taxa)
+        Growth rates
+    interactions : np.ndarray(n_taxa, n_taxa)
+        Interaction matrix (self-interactions on the diagonal)
+    initial_conditions : np.ndarray(n_taxa)
+        Initial abundances. Taxa that start at 0 stay at 0.
+    dt, n_days, perturbation, pert_start_day, pert_end_day, sim_max, rel_tol, extinction_tol
+        Passed to `integrate_to_steady_state`
+    method : str
+        'integrate'
+            Always integrate (with early termination)
+        'fixed_point'
+            Use the fixed point if it is feasible and locally stable, otherwise integrate
+        'auto'
+            Use the fixed point only if it is guaranteed to be the point the
+            integration converges to (`is_globally_stable`), otherwise integrate.
+        If there is a perturbation the dynamics are not autonomous and we always integrate.
+
+    Returns
+    -------
+    np.ndarray(n_taxa), dict
+        The steady state and the convergence diagnostics:
+        'method' : str
+            Either 'fixed_point' or 'integrate'
+        'converged' : bool
+        'n_steps' : int
+            Number of integration steps (0 for the fixed point)
+        'rel_change' : float
+            Largest change of the log-abundance per day of the present taxa at the
+            steady state
+    '''
+    if method not in ['auto', 'fixed_point', 'integrate']:
+        raise ValueError('`method` ({}) not recognized'.format(method))
+
+    initial_conditions = np.asarray(initial_conditions, dtype=float)
+    if method != 'integrate' and perturbation is None:
+        support = initial_conditions > 0
+        if method == 'fixed_point' or is_globally_stable(interactions, support):
+            x = solve_fixed_point(growth, interactions, support=support)
+            if x is not None and (sim_max is None or np.all(x < sim_max)) and \
+                    is_locally_stable(x, interactions):
+                dlogx = (growth + interactions @ x)[x > 0]
+                return x, {
+                    'method': 'fixed_point',
+                    'converged': True,
+                    'n_steps': 0,
+                    'rel_change': float(np.max(np.abs(dlogx), initial=0.))}
+
+    ret = integrate_to_steady_state(growth, interactions, initial_conditions, dt=dt,
+        n_days=n_days, perturbation=perturbation, pert_start_day=pert_start_day,
+        pert_end_day=pert_end_day, sim_max=sim_max, rel_tol=rel_tol,
+        extinction_tol=extinction_tol)
+    return ret['X'], {
+        'method': 'integrate',
+        'converged': bool(ret['converged']),
+        'n_steps': int(ret['n_steps']),
+        'rel_change': float(ret['rel_change'])}
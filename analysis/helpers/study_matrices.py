@@ -0,0 +1,238 @@
+'''Array views of the data of a study.
+
+`md2.Subject.matrix()` rebuilds the read count, relative and absolute
+abundance matrices of a subject from its per-timepoint dictionaries every time
+it is called, and `md2.Study.matrix` does so for every subject. The scripts
+call them over and over for the same study.
+
+`SubjectMatrices` holds the matrices of a subject (and its qPCR measurements)
+as arrays, built once. `subject_matrices(subj)` returns the one of a subject
+(building it the first time), so every consumer shares it. `StudyMatrices`
+holds the ones of all of the subjects of a study and also remembers the
+aggregated matrices of `md2.Study.matrix` for every set of arguments it is
+called with. `study_matrices(study)` returns the one of a study.
+
+The arrays are read-only since they are shared; copy them before modifying
+them in place. The views are not updated if the data of a study changes (e.g.
+if subjects or timepoints are popped) after they are built.
+
+The views can be saved next to the study pickle (`<study>.pkl.matrices.npz`)
+with `load_study`, so that the next time the study is loaded the matrices are
+read from that file instead of being rebuilt. The file is rebuilt if the study
+pickle changes.
+'''
+import os
+import weakref
+
+import mdsine2 as md2
+import numpy as np
+
+DTYPES = ['raw', 'rel', 'abs']
+CACHE_SUFFIX = '.matrices.npz'
+
+# id of the Subject/Study -> (weak reference to it, its view)
+_VIEWS = {}
+
+
+def _readonly(a):
+    a = np.asarray(a)
+    a.setflags(write=False)
+    return a
+
+
+def _get_view(obj):
+    entry = _VIEWS.get(id(obj))
+    if entry is not None and entry[0]() is obj:
+        return entry[1]
+    return None
+
+
+def _set_view(obj, view):
+    key = id(obj)
+    _VIEWS[key] = (weakref.ref(obj, lambda _: _VIEWS.pop(key, None)), view)
+
+
+class SubjectMatrices(object):
+    '''The data of a subject as arrays.
+
+    Attributes
+    ----------
+    name : str
+        Name of the subject
+    times : np.ndarray(n_times)
+    raw, rel, abs : np.ndarray(n_taxa, n_times)
+        Read counts, relative and absolute abundances (as in `md2.Subject.matrix()`)
+    qpcr : np.ndarray(n_times)
+        Mean qPCR measurement at each time
+    '''
+    def __init__(self, name, times, raw, rel, abs, qpcr):
+        self.name = name
+        self.times = _readonly(np.asarray(times, dtype=float))
+        self.raw = _readonly(raw)
+        self.rel = _readonly(rel)
+        self.abs = _readonly(abs)
+        self.qpcr = _readonly(qpcr)
+
+    @classmethod
+    def from_subject(cls, subj):
+        matrices = subj.matrix()
+        times = np.asarray(subj.times, dtype=float)
+        qpcr = np.asarray([subj.qpcr[t].mean() for t in subj.times], dtype=float)
+        return cls(subj.name, times, matrices['raw'], matrices['rel'], matrices['abs'], qpcr)
+
+    def matrix(self):
+        '''Same as `md2.Subject.matrix()`'''
+        return {dtype: getattr(self, dtype) for dtype in DTYPES}
+
+    def time_index(self, times):
+        '''Indices of `times` in the times of the subject'''
+        times = np.atleast_1d(np.asarray(times, dtype=float))
+        idx = np.searchsorted(self.times, times)
+        if np.any(idx >= len(self.times)) or np.any(self.times[np.minimum(idx, len(self.times) - 1)] != times):
+            raise ValueError('Times {} are not all in the times of subject {}'.format(
+                times, self.name))
+        return idx
+
+
+class StudyMatrices(object):
+    '''The data of all of the subjects of a study as arrays.
+
+    Parameters
+    ----------
+    study : md2.Study
+    subjects : list(SubjectMatrices), None
+        The views of the subjects. If None, they are built from `study`.
+    '''
+    def __init__(self, study, subjects=None):
+        self.study = study
+        if subjects is None:
+            subjects = [subject_matrices(subj) for subj in study]
+        else:
+            for subj, view in zip(study, subjects):
+                if subj.name != view.name:
+                    raise ValueError('Subject {} does not match the view of {}'.format(
+                        subj.name, view.name))
+                _set_view(subj, view)
+        self.subjects = list(subjects)
+        self._names = {view.name: view for view in self.subjects}
+        self._aggregates = {}
+
+    def __getitem__(self, name):
+        return self._names[name]
+
+    def __iter__(self):
+        return iter(self.subjects)
+
+    def __len__(self):
+        return len(self.subjects)
+
+    def matrix(self, dtype, agg, times, qpcr_unnormalize=False):
+        '''`md2.Study.matrix`, computed once for every set of arguments.
+
+        Returns
+        -------
+        np.ndarray(n_taxa, n_times), read-only
+        '''
+        key = (dtype, agg, str(times), bool(qpcr_unnormalize))
+        if key not in self._aggregates:
+            self._aggregates[key] = _readonly(self.study.matrix(dtype=dtype, agg=agg,
+                times=times, qpcr_unnormalize=qpcr_unnormalize))
+        return self._aggregates[key]
+
+    def save(self, path, study_path=None):
+        '''Save the arrays to `path` (npz). If `study_path` is given, its size
+        and modification time are saved so that `load` can tell if the study
+        changed.'''
+        arrays = {'names': np.asarray([view.name for view in self.subjects], dtype=str)}
+        for i, view in enumerate(self.subjects):
+            for attr in ['times', 'qpcr'] + DTYPES:
+                arrays['{}/{}'.format(i, attr)] = getattr(view, attr)
+        for i, (key, M) in enumerate(self._aggregates.items()):
+            arrays['aggregate{}/key'.format(i)] = np.asarray(
+                [key[0], key[1], key[2], str(int(key[3]))], dtype=str)
+            arrays['aggregate{}/matrix'.format(i)] = M
+        if study_path is not None:
+            st = os.stat(study_path)
+            arrays['stamp'] = np.asarray([st.st_size, st.st_mtime_ns], dtype=np.int64)
+
+        tmp = '{}.{}.tmp.npz'.format(path, os.getpid())
+        np.savez(tmp, **arrays)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, study, path, study_path=None):
+        '''Load the arrays of `study` saved with `save`. Returns None if they do
+        not match the study (or `study_path` changed since they were saved).'''
+        with np.load(path, allow_pickle=False) as f:
+            if study_path is not None:
+                st = os.stat(study_path)
+                if 'stamp' not in f or list(f['stamp']) != [st.st_size, st.st_mtime_ns]:
+                    return None
+            names = list(f['names'])
+            if names != [subj.name for subj in study]:
+                return None
+            subjects = [SubjectMatrices(name, *[f['{}/{}'.format(i, attr)]
+                for attr in ['times'] + DTYPES + ['qpcr']]) for i, name in enumerate(names)]
+            view = cls(study, subjects=subjects)
+            i = 0
+            while 'aggregate{}/key'.format(i) in f:
+                dtype, agg, times, qpcr_unnormalize = f['aggregate{}/key'.format(i)]
+                view._aggregates[(dtype, agg, times, qpcr_unnormalize == '1')] = _readonly(
+                    f['aggregate{}/matrix'.format(i)])
+                i += 1
+        return view
+
+
+def subject_matrices(subj):
+    '''The `SubjectMatrices` of a subject, built the first time it is asked for.'''
+    view = _get_view(subj)
+    if view is None:
+        view = SubjectMatrices.from_subject(subj)
+        _set_view(subj, view)
+    return view
+
+
+def study_matrices(study):
+    '''The `StudyMatrices` of a study, built the first time it is asked for.'''
+    view = _get_view(study)
+    if view is None:
+        view = StudyMatrices(study)
+        _set_view(study, view)
+    return view
+
+
+def load_study(path, save=True):
+    '''Load a study pickle together with the matrices saved next to it.
+
+    Parameters
+    ----------
+    path : str
+        Location of the `md2.Study` pickle
+    save : bool
+        If True, the matrices are (re)built and saved next to the pickle if
+        they are missing or out of date
+
+    Returns
+    -------
+    md2.Study
+        Use `study_matrices(study)` (and `subject_matrices(subj)`) to get the
+        matrices.
+    '''
+    study = md2.Study.load(path)
+    cache_path = path + CACHE_SUFFIX
+    view = None
+    if os.path.isfile(cache_path):
+        try:
+            view = StudyMatrices.load(study, cache_path, study_path=path)
+        except (OSError, ValueError, KeyError):
+            view = None
+    if view is None:
+        view = StudyMatrices(study)
+        if save:
+            try:
+                view.save(cache_path, study_path=path)
+            except OSError:
+                # The saved matrices are only an optimization
+                pass
+    _set_view(study, view)
+    return study
@@ -0,0 +1,115 @@
+'''Aggregate the abundances of the taxa of a study at a taxonomic level.
+
+Every taxon is mapped to the index of its group (the name of the taxon at the
+taxonomic level, as formatted by `md2.taxaname_formatter`) once. The matrices of
+all of the subjects are then summed into a single (n_groups, n_times) matrix
+over the union of their timepoints with `np.add.at`, instead of aggregating
+each subject separately and aligning the resulting tables.
+
+`top_groups` keeps the most abundant groups and sums all of the others into a
+single row.
+'''
+import mdsine2 as md2
+import numpy as np
+import pandas as pd
+
+import study_matrices
+
+
+def taxlevel_groups(taxa, index_formatter):
+    '''Group the taxa by their name at a taxonomic level.
+
+    Parameters
+    ----------
+    taxa : md2.TaxaSet
+    index_formatter : str
+        Format of the name of the groups (see `md2.taxaname_formatter`), e.g.
+        '%(order)s %(family)s'
+
+    Returns
+    -------
+    np.ndarray(n_taxa), int
+        Index of the group of each taxon
+    list(str)
+        Name of each group, in order of first appearance
+    dict (str) -> list(str)
+        Maps the name of each group to the names of its taxa
+    '''
+    group_idx = {}
+    groups = np.empty(len(taxa), dtype=int)
+    taxaname_map = {}
+    for i, taxon in enumerate(taxa):
+        label = md2.taxaname_formatter(format=index_formatter, taxon=taxon, taxa=taxa)
+        if label not in group_idx:
+            group_idx[label] = len(group_idx)
+            taxaname_map[label] = []
+        groups[i] = group_idx[label]
+        taxaname_map[label].append(taxon.name)
+    return groups, list(group_idx), taxaname_map
+
+
+def aggregate_taxlevel(taxa, subjects, index_formatter, dtype='abs'):
+    '''Sum the abundances of the subjects at a taxonomic level.
+
+    Parameters
+    ----------
+    taxa : md2.TaxaSet
+        The taxa of the subjects
+    subjects : iterable(md2.Subject)
+    index_formatter : str
+        Format of the name of the groups (see `taxlevel_groups`)
+    dtype : str
+        Which matrix of the subjects to use ('raw', 'rel' or 'abs')
+
+    Returns
+    -------
+    pd.DataFrame(n_groups, n_times)
+        Abundance of each group summed over the subjects. The columns are the
+        sorted union of the timepoints of the subjects.
+    dict (str) -> list(str)
+        Maps the name of each group to the names of its taxa
+    '''
+    subjects = list(subjects)
+    groups, labels, taxaname_map = taxlevel_groups(taxa, index_formatter)
+    times = np.unique(np.concatenate([np.asarray(subj.times, dtype=float)
+        for subj in subjects]))
+
+    matrix = np.zeros((len(labels), len(times)))
+    for subj in subjects:
+        tidx = np.searchsorted(times, np.asarray(subj.times, dtype=float))
+        np.add.at(matrix, (groups[:, None], tidx[None, :]),
+            getattr(study_matrices.subject_matrices(subj), dtype))
+    return pd.DataFrame(matrix, index=labels, columns=times), taxaname_map
+
+
+def top_groups(df, cutoff_frac_abundance, other_label):
+    '''Keep the groups whose fraction of the total abundance is at least
+    `cutoff_frac_abundance` and sum the others into a single row.
+
+    Parameters
+    ----------
+    df : pd.DataFrame(n_groups, n_times)
+    cutoff_frac_abundance : float
+    other_label : str
+        Name of the row of the other groups
+
+    Returns
+    -------
+    pd.DataFrame(n_top + 1, n_times)
+        The top groups, from the most to the least abundant, then the others
+    '''
+    matrix = df.to_numpy()
+    abunds = np.sum(matrix, axis=1)
+    order = np.argsort(abunds)
+    frac = abunds[order[::-1]] / abunds.sum()
+
+    below = np.flatnonzero(frac < cutoff_frac_abundance)
+    if len(below) == 0:
+        raise ValueError('All of the groups are at or above the cutoff ({})'.format(
+            cutoff_frac_abundance))
+    top = order[len(order) - below[0]:][::-1]
+
+    other = np.ones(len(abunds), dtype=bool)
+    other[top] = False
+    return pd.DataFrame(np.vstack((matrix[top], matrix[other].sum(axis=0))),
+        index=list(df.index[top]) + [other_label], columns=df.columns)
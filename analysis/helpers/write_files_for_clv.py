@@ -1,66 +1,102 @@
-'''Write the contents of the Study object into 3 files that are used to 
+'''Write the contents of the Study object into 3 files that are used to
 pass data into the clv paper: metadata.txt, counts.txt, biomass.txt
 
+The samples are numbered from 1 in the order of the subjects and their times.
+The counts of every sample are the columns of the read count matrices of the
+subjects (`study_matrices`) concatenated together, and the perturbation of
+every sample is found for all of the times of a subject at once. Several
+studies can be written in one call (one output folder for each).
 '''
-import mdsine2 as md2
+from mdsine2.logger import logger
+import numpy as np
 import pandas as pd
 import argparse
 import os
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(usage=__doc__)
-    parser.add_argument('--dataset', '-d', type=str, dest='dataset',
-        help='This is the Gibson dataset we want to do cross validation on')
-    parser.add_argument('--basepath', '-o', type=str, dest='basepath',
-        help='This is the folder you want to save the documents')
-    args = parser.parse_args()
+import study_matrices
+
+
+def perturbation_ids(study, subj, times):
+    '''Index (starting at 1) of the first perturbation that is active at each
+    time of the subject, 0 if there is none.
+
+    A perturbation is active in the interval (start, end] of the subject.
+
+    Returns
+    -------
+    np.ndarray(n_times), int
+    '''
+    times = np.asarray(times, dtype=float)
+    ids = np.zeros(len(times), dtype=int)
+    if study.perturbations is None:
+        return ids
+    for pidx in reversed(range(len(study.perturbations))):
+        perturbation = study.perturbations[pidx]
+        if subj.name not in perturbation.starts:
+            continue
+        active = (times > perturbation.starts[subj.name]) & \
+            (times <= perturbation.ends[subj.name])
+        ids[active] = pidx + 1
+    return ids
+
+
+def clv_tables(study):
+    '''The tables of metadata.txt, counts.txt and biomass.txt of a study.
 
-    os.makedirs(args.basepath, exist_ok=True)
-    study = md2.Study.load(args.dataset)
+    Returns
+    -------
+    pd.DataFrame, pd.DataFrame, pd.DataFrame
+    '''
+    subjects = [study_matrices.subject_matrices(subj) for subj in study]
 
     # metadata.txt
-    columns = ['sampleID', 'isIncluded', 'subjectID', 'measurementid', 'perturbid']
-    data = []
-    sampleid = 0
-    for subj in study:
-        for t in subj.times:
-            sampleid += 1
-            ppp = 0
-            for pidx, perturbation in enumerate(study.perturbations):
-                if perturbation.isactive(time=t, subj=subj.name):
-                    ppp = pidx+1
-                    break
-
-            temp = [sampleid, 1, int(subj.name), t, ppp]
-            data.append(temp)
-
-    df = pd.DataFrame(data, columns=columns)
-    df.to_csv(os.path.join(args.basepath, 'metadata.txt'), 
-        sep='\t', index=False, header=True)
+    subject_ids = np.concatenate([np.full(len(view.times), int(subj.name))
+        for subj, view in zip(study, subjects)])
+    times = np.concatenate([view.times for view in subjects])
+    n_samples = len(times)
+    metadata = pd.DataFrame({
+        'sampleID': np.arange(1, n_samples + 1),
+        'isIncluded': np.ones(n_samples, dtype=int),
+        'subjectID': subject_ids,
+        'measurementid': times,
+        'perturbid': np.concatenate([perturbation_ids(study, subj, view.times)
+            for subj, view in zip(study, subjects)])})
 
     # counts.txt
-    columns = ['#OTU ID'] + [a+1 for a in range(sampleid)]
-    data = []
-    for taxon in study.taxa:
-        temp = [taxon.name]
-        sampleid = 1
-        for subj in study:
-            for t in subj.times:
-                temp.append(subj.reads[t][taxon.idx])
-        data.append(temp)
-
-    
-    df = pd.DataFrame(data, columns=columns)
-    df.to_csv(os.path.join(args.basepath, 'counts.txt'), 
-        sep='\t', index=False, header=True)
+    counts = pd.DataFrame(np.hstack([view.raw for view in subjects]).astype(np.int64),
+        columns=np.arange(1, n_samples + 1))
+    counts.insert(0, '#OTU ID', [taxon.name for taxon in study.taxa])
 
     # biomass.txt
-    columns = ['mass1', 'mass2', 'mass3']
-    data = []
-    for subj in study:
-        for t in subj.times:
-            data.append(subj.qpcr[t].data)
-    
-    df = pd.DataFrame(data, columns=columns)
-    df.to_csv(os.path.join(args.basepath, 'biomass.txt'), 
-        sep='\t', index=False, header=True)
+    biomass = pd.DataFrame(np.vstack([subj.qpcr[t].data for subj in study for t in subj.times]),
+        columns=['mass1', 'mass2', 'mass3'])
+    return metadata, counts, biomass
+
+
+def write_clv_files(study, basepath):
+    '''Write metadata.txt, counts.txt and biomass.txt of the study into `basepath`.'''
+    os.makedirs(basepath, exist_ok=True)
+    metadata, counts, biomass = clv_tables(study)
+    for fname, df in [('metadata.txt', metadata), ('counts.txt', counts),
+            ('biomass.txt', biomass)]:
+        df.to_csv(os.path.join(basepath, fname), sep='\t', index=False, header=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(usage=__doc__)
+    parser.add_argument('--dataset', '-d', type=str, dest='datasets', nargs='+',
+        help='This is the Gibson dataset we want to do cross validation on. ' \
+            'Several datasets can be given.')
+    parser.add_argument('--basepath', '-o', type=str, dest='basepaths', nargs='+',
+        help='This is the folder you want to save the documents. Give one ' \
+            'folder for each dataset.')
+    args = parser.parse_args()
+
+    if len(args.datasets) != len(args.basepaths):
+        raise ValueError('There are {} datasets but {} output folders'.format(
+            len(args.datasets), len(args.basepaths)))
+
+    for dataset, basepath in zip(args.datasets, args.basepaths):
+        logger.info('Writing {} into {}'.format(dataset, basepath))
+        study = study_matrices.load_study(dataset)
+        write_clv_files(study, basepath)
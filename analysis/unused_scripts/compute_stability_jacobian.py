@@ -19,6 +19,11 @@ import argparse
 from mdsine2.names import STRNAMES
 from mdsine2.logger import logger
 import time
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1] / 'helpers'))
+import study_matrices
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(usage=__doc__)
@@ -48,7 +53,7 @@ if __name__ == '__main__':
     study = mcmc.graph.data.subjects
     steady_state = []
     for subj in study:
-        M = subj.matrix()['abs']
+        M = study_matrices.subject_matrices(subj).abs
         tidx_start = np.searchsorted(subj.times, 14)
         tidx_end = np.searchsorted(subj.times, 20)
         steady_state.append(np.mean(M[:, tidx_start:tidx_end], axis=1))